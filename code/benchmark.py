@@ -0,0 +1,346 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import contextlib
+import tracemalloc
+from itertools import accumulate
+
+from reading_assistant import *
+
+
+def write_synthetic_file(path, paragraphs, words_per_paragraph=60, vocabulary_size=5000, seed=0):
+    """
+    Writes a text file of random words, one paragraph per line with blank lines in between
+    """
+    rng = random.Random(seed)
+    vocabulary = ["word{}".format(i) for i in range(vocabulary_size)]
+    with open(path, 'w') as f:
+        for _ in range(paragraphs):
+            f.write(" ".join(rng.choice(vocabulary) for _ in range(words_per_paragraph)) + ".\n\n")
+
+
+def bench_reader(sizes=(1000, 2000, 4000, 8000)):
+    """
+    Times reading + tokenizing synthetic files of growing size at both LSI levels
+    Linear scaling shows as a roughly constant time per paragraph
+    """
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    for paragraphs in sizes:
+        path = os.path.join(tmp_dir, "synthetic_{}.txt".format(paragraphs))
+        write_synthetic_file(path, paragraphs)
+        row = {'paragraphs': paragraphs, 'bytes': os.path.getsize(path)}
+        for level in ('document', 'paragraph'):
+            start = time.perf_counter()
+            for _ in ReadUnreadTxtFiles(path, level):
+                pass
+            row[level] = time.perf_counter() - start
+        start = time.perf_counter()
+        text_file = TextFile(path)
+        for level in ('document', 'paragraph'):
+            for _ in text_file.units(level):
+                pass
+        row['both_levels_one_read'] = time.perf_counter() - start
+        os.remove(path)
+        results.append(row)
+    os.rmdir(tmp_dir)
+    return results
+
+
+def print_reader_results(results):
+    print('{:>10} {:>12} {:>12} {:>12} {:>12} {:>14}'.format(
+        'paragraphs', 'bytes', 'document s', 'paragraph s', 'both s', 'us/paragraph'))
+    for row in results:
+        print('{:>10} {:>12} {:>12.3f} {:>12.3f} {:>12.3f} {:>14.1f}'.format(
+            row['paragraphs'], row['bytes'], row['document'], row['paragraph'], row['both_levels_one_read'],
+            1e6 * row['document'] / row['paragraphs']))
+
+
+def synthetic_paragraphs(articles, paragraphs_per_article, words_per_paragraph=60, vocabulary_size=20000, seed=0):
+    """
+    Paragraph-level Documents of random words, named like the real ones (article.txt_pgN)
+    """
+    rng = random.Random(seed)
+    vocabulary = ["word{}".format(i) for i in range(vocabulary_size)]
+    docs = []
+    for a in range(articles):
+        article_id = "synthetic-article-{}.txt".format(a)
+        for p in range(paragraphs_per_article):
+            words = [rng.choice(vocabulary) for _ in range(words_per_paragraph)]
+            docs.append(Document("{}_pg{}".format(article_id, p), [words], " ".join(words), article_id))
+    return docs
+
+
+def bench_index_memory(articles=(50, 100, 200), paragraphs_per_article=100):
+    """
+    Memory of the dict-of-dicts InvertedIndex postings, in total and per posting
+    """
+    results = []
+    for n in articles:
+        docs = synthetic_paragraphs(n, paragraphs_per_article)
+        inv_idx = InvertedIndex()
+        for doc in docs:
+            inv_idx.add_document(doc)
+        # size of the word -> {doc_id: tf} structure alone (the word and id strings are shared)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        postings_copy = dict((word, dict(postings)) for word, postings in inv_idx.index.items())
+        postings_bytes = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del postings_copy
+        results.append({'paragraphs': len(docs), 'postings': sum(len(p) for p in inv_idx.index.values()),
+                        'dict_bytes': postings_bytes})
+    return results
+
+
+def print_memory_results(results):
+    print('{:>10} {:>10} {:>14} {:>8}'.format('paragraphs', 'postings', 'dict bytes', 'B/post'))
+    for row in results:
+        print('{:>10} {:>10} {:>14} {:>8.1f}'.format(
+            row['paragraphs'], row['postings'], row['dict_bytes'], row['dict_bytes'] / row['postings']))
+
+
+class ZipfWords(object):
+    """
+    Random words from a vocabulary of word0 .. wordN, word i drawn with probability ~ 1 / (i + 1) ** skew
+    skew 0 is uniform; natural text is close to 1
+    """
+
+    def __init__(self, vocabulary_size=20000, skew=1.0, seed=0):
+        """
+        Initializes the sampler
+        """
+        self.vocabulary = ["word{}".format(i) for i in range(vocabulary_size)]
+        self.cum_weights = list(accumulate(1.0 / (i + 1) ** skew for i in range(vocabulary_size)))
+        self.rng = random.Random(seed)
+
+    def sample(self, n):
+        return self.rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=n)
+
+
+def write_synthetic_corpus(directory, documents, paragraphs_per_document, prefix="synthetic", words_per_paragraph=60,
+                           words_per_sentence=12, words=None):
+    """
+    Writes documents text files of paragraphs_per_document paragraphs (one per line, blank lines
+    in between) of sentences of words drawn from words (a ZipfWords). Returns the file paths
+    """
+    words = words or ZipfWords()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for d in range(documents):
+        path = os.path.join(directory, "{}-{}.txt".format(prefix, d))
+        with open(path, 'w') as f:
+            for _ in range(paragraphs_per_document):
+                paragraph = words.sample(words_per_paragraph)
+                sentences = [" ".join(paragraph[i:i + words_per_sentence])
+                             for i in range(0, len(paragraph), words_per_sentence)]
+                f.write(". ".join(sentences) + ".\n\n")
+        paths.append(path)
+    return paths
+
+
+def measure(stages, name, function, *args, memory=False):
+    """
+    Runs function(*args) once, records its wall time in stages[name], and with memory its traced
+    peak allocation in a second run under tracemalloc (so function must not depend on the first
+    run's side effects); returns the result of the first run
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    stages[name] = {'seconds': time.perf_counter() - start}
+    if memory:
+        tracemalloc.start()
+        function(*args)
+        stages[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def bench_suite(documents=50, paragraphs=40, unread=5, vocabulary_size=20000, skew=1.0, seed=0, memory=True):
+    """
+    Times the main paths of the reading assistant on a synthetic corpus of documents read and
+    unread files of paragraphs paragraphs each: load_documents, InvertedIndex add / remove,
+    score_document at both levels, LSI training and queries, and html report writing.
+    Returns a JSON-able dict of the configuration, the environment and {stage: seconds [, peak_bytes]}
+    """
+    tmp_dir = tempfile.mkdtemp()
+    read_path = os.path.join(tmp_dir, "read", "")
+    unread_path = os.path.join(tmp_dir, "unread", "")
+    words = ZipfWords(vocabulary_size, skew, seed)
+    write_synthetic_corpus(read_path, documents, paragraphs, "read", words=words)
+    unread_files = write_synthetic_corpus(unread_path, unread, paragraphs, "unread", words=words)
+    stages = {}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            bench_stages(stages, read_path, unread_files, os.path.join(tmp_dir, "report.html"), memory)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    import numpy, scipy, gensim
+    return {'config': {'documents': documents, 'paragraphs': paragraphs, 'unread': unread,
+                       'vocabulary_size': vocabulary_size, 'skew': skew, 'seed': seed},
+            'environment': {'python': platform.python_version(), 'numpy': numpy.__version__,
+                            'scipy': scipy.__version__, 'gensim': gensim.__version__, 'cpus': os.cpu_count(),
+                            'machine': platform.machine()},
+            'stages': stages,
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def bench_stages(stages, read_path, unread_files, report, memory=True):
+    """
+    The stages of bench_suite, recorded in stages
+    """
+    assistants = {}
+    for level in ("document", "paragraph"):
+        def load(level=level):
+            assistant = ReadingAssistant(read_path, level)
+            assistant.load_documents()
+            return assistant
+        assistants[level] = measure(stages, "load_documents {}".format(level), load, memory=memory)
+
+    # the unread files' paragraphs added to the paragraph index, then removed again
+    new_docs = [doc for f in unread_files for doc in DocumentProcessor(f, "paragraph").get_docs()]
+    inv_idx = assistants["paragraph"].inv_idx
+
+    def add_all():
+        for doc in new_docs:
+            inv_idx.add_document(doc)
+
+    def remove_all():
+        for doc in new_docs:
+            inv_idx.remove_document(doc)
+
+    for name, function in (("InvertedIndex.add_document", add_all), ("InvertedIndex.remove_document", remove_all)):
+        measure(stages, name, function)
+        stages[name]['per_call_us'] = 1e6 * stages[name]['seconds'] / max(len(new_docs), 1)
+
+    # the ranking caches are emptied before each run, so that every run scores every unit
+    def score_all(level, engine):
+        assistants[level].ranking_cache.clear()
+        return [assistants[level].score_document(f, engine=engine) for f in unread_files]
+
+    for level, engine in (("document", "taat"), ("paragraph", "maxscore"), ("paragraph", "taat"),
+                          ("paragraph", "matrix")):
+        rankings = measure(stages, "score_document {} {}".format(level, engine), score_all, level, engine,
+                           memory=memory)
+
+    # maxscore right after a read and a forget, with no idf, norm or weight sum cached for the new index
+    if new_docs:
+        inv_idx.add_document(new_docs[0])
+        inv_idx.remove_document(new_docs[0])
+    measure(stages, "score_document paragraph maxscore after change", score_all, "paragraph", "maxscore",
+            memory=memory)
+
+    for level in ("document", "paragraph"):
+        def train(level=level):
+            service = LsiService(read_path, level)
+            service.current()
+            return service
+        service = measure(stages, "lsi train {}".format(level), train, memory=memory)
+
+        def query_all(service=service):
+            service.current().ranking_cache.clear()
+            return [service.query(f) for f in unread_files]
+        measure(stages, "lsi query {}".format(level), query_all, memory=memory)
+
+    # report of the last paragraph-level rankings
+    measure(stages, "html report", lambda: write_report(report, "benchmark", [("BM25 Paragraph", rankings[-1])],
+                                                         -1, {'lazy_text': True}), memory=memory)
+    stages["html report"]['bytes'] = os.path.getsize(report)
+
+
+def clustered_unit_vectors(units, features=200, clusters=2000, spread=0.6, seed=0):
+    """
+    Random unit vectors around clusters random directions, standing in for LSI vectors of paragraphs
+    """
+    random_state = numpy.random.RandomState(seed)
+    centers = random_state.standard_normal((clusters, features))
+    vectors = centers[random_state.randint(clusters, size=units)] + spread * random_state.standard_normal((units, features))
+    vectors /= numpy.linalg.norm(vectors, axis=1)[:, None]
+    return vectors.astype(numpy.float32)
+
+
+def bench_similarity(units=100000, features=200, queries=200, k=10, seed=0, backends=None):
+    """
+    Builds every LSI similarity backend over the same clustered unit vectors and reports its build
+    time, recall@k against brute force and query time (see recall_at_k); queries are held-out vectors
+    """
+    backends = backends or [('dense', {}), ('sharded', {}), ('lsh', {}), ('lsh', {'tables': 16}), ('ivf', {}),
+                            ('ivf', {'probes': 8})]
+    vectors = clustered_unit_vectors(units + queries, features, seed=seed)
+    data, held_out = vectors[:units], vectors[units:]
+    results = []
+    for name, options in backends:
+        start = time.perf_counter()
+        backend = SIMILARITY_BACKENDS[name]((data[i:i + 4096] for i in range(0, units, 4096)), features, **options)
+        row = {'backend': name, 'options': options, 'build_seconds': time.perf_counter() - start}
+        row.update(recall_at_k(backend, held_out, k))
+        results.append(row)
+    return results
+
+
+def print_similarity_results(results):
+    print('{:<8} {:<16} {:>10} {:>8} {:>12} {:>16}'.format('backend', 'options', 'build s', 'recall', 'search ms',
+                                                         'brute force ms'))
+    for row in results:
+        print('{:<8} {:<16} {:>10.2f} {:>8.3f} {:>12.3f} {:>16.3f}'.format(
+            row['backend'], ",".join("{}={}".format(*option) for option in row['options'].items()),
+            row['build_seconds'], row['recall'], row['search_ms'], row['brute_force_ms']))
+
+
+def print_suite_results(results):
+    print('{:<48} {:>10} {:>14}'.format('stage', 'seconds', 'peak MB'))
+    for name, stage in results['stages'].items():
+        peak = '{:.1f}'.format(stage['peak_bytes'] / 1e6) if 'peak_bytes' in stage else ''
+        print('{:<48} {:>10.3f} {:>14}'.format(name, stage['seconds'], peak))
+    print('max rss {:.1f} MB'.format(results['max_rss_bytes'] / 1e6))
+
+
+if __name__ == "__main__":
+    """
+    Run from the command line: python benchmark.py reader|memory [sizes ...], python benchmark.py suite [options]
+    or python benchmark.py lsi [units]
+    """
+    if len(sys.argv) < 2 or sys.argv[1] not in ('reader', 'memory', 'suite', 'lsi'):
+        print("\nUsage: python benchmark.py reader|memory [sizes ...]\n"
+              "       python benchmark.py suite [--documents 50] [--paragraphs 40] [--unread 5] [--vocabulary 20000]\n"
+              "                                 [--skew 1.0] [--seed 0] [--no-memory] [--out benchmark.json]\n"
+              "       python benchmark.py lsi [units]\n"
+              "    ... reader : read + tokenize synthetic files of growing size (LSI readers), sizes in paragraphs\n"
+              "    ... memory : size of the dict-of-dicts postings, sizes in articles of 100 paragraphs\n"
+              "    ... suite  : times the BM25, LSI and report paths on a synthetic Zipf corpus, results as JSON\n"
+              "    ... lsi    : recall@10 and query time of the LSI similarity backends, default 100000 units\n")
+    elif sys.argv[1] == 'lsi':
+        print_similarity_results(bench_similarity(int(sys.argv[2]) if len(sys.argv) > 2 else 100000))
+    elif sys.argv[1] == 'suite':
+        args = sys.argv[2:]
+        options = {'--documents': '50', '--paragraphs': '40', '--unread': '5', '--vocabulary': '20000',
+                   '--skew': '1.0', '--seed': '0', '--out': 'benchmark.json'}
+        memory = '--no-memory' not in args
+        if not memory:
+            args.remove('--no-memory')
+        for option in list(options):
+            if option in args:
+                i = args.index(option)
+                options[option] = args.pop(i + 1)
+                args.pop(i)
+        results = bench_suite(int(options['--documents']), int(options['--paragraphs']), int(options['--unread']),
+                              int(options['--vocabulary']), float(options['--skew']), int(options['--seed']), memory)
+        with open(options['--out'], 'w') as f:
+            json.dump(results, f, indent=2)
+        print_suite_results(results)
+        print('results written to', options['--out'])
+    elif sys.argv[1] == 'reader':
+        sizes = [int(x) for x in sys.argv[2:]] or (1000, 2000, 4000, 8000)
+        print_reader_results(bench_reader(sizes))
+    elif sys.argv[1] == 'memory':
+        sizes = [int(x) for x in sys.argv[2:]] or (50, 100, 200)
+        print_memory_results(bench_index_memory(sizes))
@@ -0,0 +1,334 @@
+import math
+import heapq
+from collections import OrderedDict
+import numpy
+from scipy import sparse
+from instrumentation import instruments
+
+
+def count_query_terms(processed_text):
+    """
+    Counts the words of a processed document (list of sentences), keeping first-seen order
+    """
+    counts = OrderedDict()
+    for sentence in processed_text:
+        for word in sentence:
+            counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+class BM25Scorer(object):
+    """
+    Term-at-a-time BM25 scorer over an InvertedIndex
+
+    Only the posting lists of the distinct query terms are walked. IDF values and
+    document-length norms are cached until the index changes. The MaxScore upper bounds
+    of top_k come from the per-word (highest tf, shortest document) the index keeps up to
+    date (InvertedIndex.term_bounds), so they never walk a posting list.
+    """
+
+    def __init__(self, inv_idx):
+        """
+        Initializes the scorer for an inverted index
+        """
+        self.inv_idx = inv_idx
+        self.generation = None
+        self.idf_cache = {}
+        self.norm_cache = {}
+        self.norm_params = None
+        # word -> sum of its weights over its postings, for the exact mean of top_k
+        self.weight_sum_cache = {}
+
+    def refresh(self, k1, b):
+        """
+        Drops the cached values if the index or the BM25 parameters changed since they were computed
+        """
+        if self.generation != self.inv_idx.generation:
+            self.idf_cache = {}
+            self.norm_cache = {}
+            self.weight_sum_cache = {}
+            self.generation = self.inv_idx.generation
+        if self.norm_params != (k1, b):
+            self.norm_cache = {}
+            self.weight_sum_cache = {}
+            self.norm_params = (k1, b)
+
+    def idf(self, word):
+        """
+        Inverse document frequency of a word, cached per index generation
+        """
+        idf = self.idf_cache.get(word)
+        if idf is None:
+            N = self.inv_idx.number_of_documents
+            docs_containing_keyword = len(self.inv_idx.index.get(word, ()))
+            numerator = N - docs_containing_keyword + 0.5
+            denominator = docs_containing_keyword + 0.5
+            idf = max(0, math.log((numerator / denominator) + 1))
+            self.idf_cache[word] = idf
+        return idf
+
+    def norm(self, doc_id, k1, b):
+        """
+        The document-length part of the BM25 denominator, cached per document
+        """
+        norm = self.norm_cache.get(doc_id)
+        if norm is None:
+            document_length = self.inv_idx.document_lengths[doc_id]
+            norm = k1 * (1 - b + (b * (document_length / self.inv_idx.average_document_length)))
+            self.norm_cache[doc_id] = norm
+        return norm
+
+    def weight(self, word, doc_id, tf, k1, b):
+        """
+        BM25 contribution of one occurrence of word in the query to doc_id
+        """
+        numerator = tf * (k1 + 1)
+        denominator = tf + self.norm(doc_id, k1, b)
+        return self.idf(word) * (numerator / denominator)
+
+    def upper_bound(self, word, k1, b):
+        """
+        Upper bound of the weight of a word in any document: the BM25 weight grows with tf and
+        shrinks with the document length, so the highest tf in the shortest document bounds it
+        """
+        bound = self.inv_idx.term_bounds.get(word)
+        if bound is None:
+            return 0.0
+        max_tf, min_length = bound
+        return self.idf(word) * ((max_tf * (k1 + 1)) /
+                                 (max_tf + k1 * (1 - b + (b * (min_length / self.inv_idx.average_document_length)))))
+
+    def weight_sum(self, word, k1, b):
+        """
+        Total weight of a word over its posting list, cached per index generation
+        """
+        total = self.weight_sum_cache.get(word)
+        if total is None:
+            postings = self.inv_idx.index.get(word, {})
+            norms = self.norm_cache
+            total = 0.0
+            for doc_id, tf in postings.items():
+                norm = norms.get(doc_id)
+                if norm is None:
+                    norm = self.norm(doc_id, k1, b)
+                total += tf / (tf + norm)
+            total *= self.idf(word) * (k1 + 1)
+            self.weight_sum_cache[word] = total
+        return total
+
+    def score(self, processed_text, k1=1.2, b=0.75):
+        """
+        Scores a processed query against every indexed document in one pass over the postings
+        Returns a dict of doc_id -> score for documents sharing at least one word with the query
+        """
+        self.refresh(k1, b)
+        scores = {}
+        touched = 0
+        for word, query_count in count_query_terms(processed_text).items():
+            postings = self.inv_idx.index.get(word)
+            if not postings:
+                continue
+            touched += len(postings)
+            idf = self.idf(word)
+            for doc_id, tf in postings.items():
+                numerator = tf * (k1 + 1)
+                denominator = tf + self.norm(doc_id, k1, b)
+                scores[doc_id] = scores.get(doc_id, 0.0) + query_count * (idf * (numerator / denominator))
+        instruments.count('postings touched', touched)
+        return scores
+
+    def top_k(self, processed_text, k=10, threshold=None, k1=1.2, b=0.75):
+        """
+        MaxScore top-k retrieval
+
+        Query words are visited from the highest to the lowest upper-bound score. A document
+        first seen in the posting list of word i can only contain words i..m, so once their
+        summed upper bounds cannot beat the current k-th best score (or the threshold) no
+        new candidates are opened, and a candidate is dropped as soon as its partial score
+        plus the remaining upper bounds falls below it.
+
+        Returns (hits, moments): hits is a list of (doc_id, score) sorted by decreasing score,
+        moments a StreamingMoments over all indexed documents (see StreamingMoments)
+        """
+        self.refresh(k1, b)
+        terms = []
+        exact_total = 0.0
+        for word, query_count in count_query_terms(processed_text).items():
+            postings = self.inv_idx.index.get(word)
+            if postings:
+                terms.append((query_count * self.upper_bound(word, k1, b), query_count, word, postings))
+                exact_total += query_count * self.weight_sum(word, k1, b)
+        terms.sort(key=lambda t: -t[0])
+        # remaining[i] is the best score a document containing only words i..m can reach
+        remaining = [0.0] * (len(terms) + 1)
+        for i in range(len(terms) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + terms[i][0]
+
+        heap = []  # bounded min-heap of (score, doc_id)
+        floor = threshold if threshold is not None else float('-inf')
+        moments = StreamingMoments()
+        seen = set()
+        touched = 0
+        for i, (_, query_count, word, postings) in enumerate(terms):
+            theta = heap[0][0] if k is not None and len(heap) >= k else floor
+            theta = max(theta, floor)
+            if remaining[i] <= theta:
+                break
+            touched += len(postings)
+            for doc_id in postings:
+                if doc_id in seen:
+                    continue
+                seen.add(doc_id)
+                doc_score = 0.0
+                for j in range(i, len(terms)):
+                    if doc_score + remaining[j] <= theta:
+                        break
+                    tf = terms[j][3].get(doc_id)
+                    if tf:
+                        doc_score += terms[j][1] * self.weight(terms[j][2], doc_id, tf, k1, b)
+                moments.add(doc_score)
+                if doc_score <= floor:
+                    continue
+                if k is None or len(heap) < k:
+                    heapq.heappush(heap, (doc_score, doc_id))
+                elif doc_score > heap[0][0]:
+                    heapq.heapreplace(heap, (doc_score, doc_id))
+                if k is not None and len(heap) >= k:
+                    theta = max(heap[0][0], floor)
+        instruments.count('postings touched', touched)
+        instruments.count('documents scored', len(seen))
+        moments.add_zeros(self.inv_idx.number_of_documents - moments.count)
+        moments.total = exact_total
+        hits = sorted(((doc_id, doc_score) for doc_score, doc_id in heap), key=lambda x: x[1], reverse=True)
+        return hits, moments
+
+
+class StreamingMoments(object):
+    """
+    Running count, sum and sum of squares of scores, giving mean and (population) standard deviation
+
+    In a pruned top-k query the total is set exactly from the per-word weight sums, while
+    the sum of squares only sees the visited candidates (with their possibly partial
+    scores), so the mean is always exact and the sd is exact when nothing was pruned
+    and a lower bound otherwise.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty accumulator
+        """
+        self.count = 0
+        self.total = 0.0
+        self.squared_total = 0.0
+
+    def add(self, x):
+        """
+        Adds one value
+        """
+        self.count += 1
+        self.total += x
+        self.squared_total += x * x
+
+    def add_zeros(self, n):
+        """
+        Adds n zero values at once
+        """
+        if n > 0:
+            self.count += n
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def sd(self):
+        if not self.count:
+            return 0.0
+        return math.sqrt(max(0.0, self.squared_total / self.count - self.mean ** 2))
+
+
+class BM25Matrix(object):
+    """
+    Batched BM25 as a sparse matrix product
+
+    Keeps a CSR matrix of BM25-saturated word weights (read documents x vocabulary)
+    built from an InvertedIndex, so that any number of queries is scored with one
+    product against a matrix of query word counts.
+    """
+
+    def __init__(self, inv_idx):
+        """
+        Initializes the (lazily built) weight matrix for an inverted index
+        """
+        self.inv_idx = inv_idx
+        self.key = None
+        self.doc_ids = []
+        self.vocabulary = {}
+        self.weights = None
+        self.column_lengths = None  # postings per vocabulary column, for the instruments
+
+    def build(self, doc_ids, k1=1.2, b=0.75):
+        """
+        (Re)builds the weight matrix with one row per doc_id, in the given order
+        Does nothing if the index, the rows and the BM25 parameters are unchanged
+        """
+        doc_ids = list(doc_ids)
+        key = (self.inv_idx.generation, k1, b, len(doc_ids))
+        if key == self.key and doc_ids == self.doc_ids:
+            return
+        row_of = dict((doc_id, i) for i, doc_id in enumerate(doc_ids))
+        self.vocabulary = dict((word, i) for i, word in enumerate(self.inv_idx.index.keys()))
+
+        N = self.inv_idx.number_of_documents
+        rows, cols, tfs, idfs = [], [], [], []
+        for word, postings in self.inv_idx.index.items():
+            if not postings:
+                continue
+            col = self.vocabulary[word]
+            idf = max(0, math.log(((N - len(postings) + 0.5) / (len(postings) + 0.5)) + 1))
+            for doc_id, tf in postings.items():
+                rows.append(row_of[doc_id])
+                cols.append(col)
+                tfs.append(tf)
+            idfs.append(numpy.full(len(postings), idf))
+
+        lengths = numpy.array([self.inv_idx.document_lengths[doc_id] for doc_id in doc_ids], dtype=numpy.float64)
+        norms = k1 * (1 - b + (b * (lengths / self.inv_idx.average_document_length))) if len(doc_ids) else lengths
+        rows = numpy.array(rows, dtype=numpy.int64)
+        tfs = numpy.array(tfs, dtype=numpy.float64)
+        idfs = numpy.concatenate(idfs) if idfs else numpy.zeros(0)
+        values = idfs * ((tfs * (k1 + 1)) / (tfs + norms[rows]))
+        self.weights = sparse.csr_matrix((values, (rows, numpy.array(cols, dtype=numpy.int64))),
+                                         shape=(len(doc_ids), len(self.vocabulary)))
+        self.column_lengths = None
+        self.doc_ids = doc_ids
+        self.key = key
+
+    def query_matrix(self, processed_texts):
+        """
+        Builds a CSR matrix of word counts (queries x vocabulary), ignoring unknown words
+        """
+        rows, cols, counts = [], [], []
+        for i, processed_text in enumerate(processed_texts):
+            for word, count in count_query_terms(processed_text).items():
+                col = self.vocabulary.get(word)
+                if col is not None:
+                    rows.append(i)
+                    cols.append(col)
+                    counts.append(count)
+        return sparse.csr_matrix((numpy.array(counts, dtype=numpy.float64), (rows, cols)),
+                                 shape=(len(processed_texts), len(self.vocabulary)))
+
+    def score(self, processed_texts):
+        """
+        Scores all queries at once
+        Returns a dense array of shape (queries x read documents), rows in build() order
+        """
+        if not processed_texts or not self.doc_ids:
+            return numpy.zeros((len(processed_texts), len(self.doc_ids)))
+        queries = self.query_matrix(processed_texts)
+        if instruments.enabled:
+            if self.column_lengths is None:
+                self.column_lengths = numpy.bincount(self.weights.indices, minlength=len(self.vocabulary))
+            instruments.count('postings touched', int(self.column_lengths[queries.indices].sum()))
+        return (queries @ self.weights.T).toarray()
@@ -1,167 +1,649 @@
+import io
 import os
+import copy
+import pickle
+import threading
+import numpy
 from gensim.utils import simple_preprocess
 from gensim.parsing.preprocessing import remove_stopwords
 from smart_open import smart_open
 from gensim import corpora
 from collections import defaultdict
 from gensim import models
-from gensim import similarities
+from gensim import matutils
+from itertools import islice
+from text_store import TextStore, MmapTextStore
+from similarity_index import top_positions, unit_vector_chunks, SIMILARITY_BACKENDS, recall_at_k
+from instrumentation import instruments
+from ranking_cache import RankingCache, content_key
 
 import logging
 # logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
-# contains the names of the files, and corresponding text, for reference later.
-read_docs = []
-read_paragraphs = []
-read_docs_txt = {}
-read_paragraphs_txt = {}
-unread_docs = []
-unread_paragraphs = []
-unread_docs_txt = {}
-unread_paragraphs_txt = {}
+class TextFile(object):
+    """
+    A text file read once and tokenized for LSI, giving both its document and its paragraphs
+
+    Every non-blank line is a paragraph; the document's words are the paragraphs' words in order.
+    """
+
+    def __init__(self, path, text=None):
+        """
+        Reads and tokenizes the file in one linear pass
+        text is the already decoded content of the file, if any
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        self.paragraphs = []  # (paragraph name, list of words, raw line)
+        lines = []
+        with (smart_open(path, encoding='latin') if text is None else io.StringIO(text)) as doc:
+            for line in doc:
+                lines.append(line)
+                if (len(line.strip()) == 0):
+                    continue  # skip blank lines
+                para_name = "{}_pg{}".format(self.name, str(len(self.paragraphs)))
+                self.paragraphs.append((para_name, simple_preprocess(remove_stopwords(line), deacc=True), line))
+        self.txt = "".join(lines)
+
+    @classmethod
+    def restore(cls, path, paragraphs, txt):
+        """
+        TextFile of path from its paragraphs and text, as cached by read_text_file
+        """
+        text_file = cls.__new__(cls)
+        text_file.path = path
+        text_file.name = os.path.basename(path)
+        text_file.paragraphs = [tuple(paragraph) for paragraph in paragraphs]
+        text_file.txt = txt
+        return text_file
+
+    @property
+    def words(self):
+        """
+        All words of the document
+        """
+        words = []
+        for _, paragraph_words, _ in self.paragraphs:
+            words.extend(paragraph_words)
+        return words
+
+    def units(self, level='document'):
+        """
+        Yields the file as (name, words, raw text) units of the given level
+        """
+        if level == 'document':
+            yield self.name, self.words, self.txt
+        elif level == 'paragraph':
+            for paragraph in self.paragraphs:
+                yield paragraph
+
+
+def iter_text_units(path, level='document'):
+    """
+    Yields the (name, words, raw text) units of a file like TextFile.units, reading it lazily
+    At paragraph level only the current line is in memory
+    """
+    if level == 'document':
+        for unit in TextFile(path).units(level):
+            yield unit
+        return
+    if level != 'paragraph':
+        return
+    name = os.path.basename(path)
+    para_idx = 0
+    with smart_open(path, encoding='latin') as doc:
+        for line in doc:
+            if (len(line.strip()) == 0):
+                continue  # skip blank lines
+            para_name = "{}_pg{}".format(name, str(para_idx))
+            para_idx += 1
+            yield para_name, simple_preprocess(remove_stopwords(line), deacc=True), line
+
+
+def read_text_file(path, token_cache=None):
+    """
+    TextFile of path, through token_cache (a TokenCache) when there is one
+    """
+    if token_cache is None:
+        return TextFile(path)
+
+    def parts(cached):
+        # the cache keeps plain data, see CachedFile.get
+        text_file = TextFile(path, cached.text('latin'))
+        return text_file.paragraphs, text_file.txt
+    return TextFile.restore(path, *token_cache.open(path).get('lsi', parts))
+
 
 class ListOfWords(object):
-     def __init__(self, list_of_words):
+     def __init__(self, list_of_words, name=None, txt=None, article=None):
         self.list = list_of_words
+        self.name = name
+        self.txt = txt
+        self.article = article
 
 class ReadTxtFiles(object):
-    def __init__(self, dirname, level='document'):
+    def __init__(self, dirname, level='document', fnames=None, token_cache=None):
         self.dirname = dirname
         self.level = level
+        # only read these files of the directory (default: all of them)
+        self.fnames = fnames
+        self.token_cache = token_cache
 
     def __iter__(self):
-        for fname in os.listdir(self.dirname):
-            path = os.path.join(self.dirname, fname)
-            self.doc = smart_open(path, encoding='latin')
-            # read_docs.append(fname)
-
-            if self.level == 'document':
-                self.list = []
-                doc_txt = ""
-                for line in self.doc:
-                    doc_txt += line + "\n"
-                    if (len(line.strip()) == 0):
-                        continue  # skip blank lines
-                    self.list = self.list + simple_preprocess(remove_stopwords(line), deacc=True)
-                read_docs.append(fname)
-                read_docs_txt[fname] = doc_txt
-                yield ListOfWords(self.list)
-
-            elif self.level == 'paragraph':
-                paragraph_idx = 0
-                for line in self.doc:
-                    if (len(line.strip()) == 0):
-                        continue  # skip blank lines
-                    para_name = "{}_pg{}".format(fname, str(paragraph_idx))
-                    # read_paragraphs.append("{}_pg{}".format(fname, str(paragreraph_idx)))
-                    read_paragraphs.append(para_name)
-                    read_paragraphs_txt[para_name] = line
-                    paragraph_idx += 1
-                    yield ListOfWords(simple_preprocess(remove_stopwords(line), deacc=True))
+        for fname in (self.fnames if self.fnames is not None else os.listdir(self.dirname)):
+            text_file = read_text_file(os.path.join(self.dirname, fname), self.token_cache)
+            for name, words, txt in text_file.units(self.level):
+                yield ListOfWords(words, name, txt, fname)
 
 class ListOfUnreadWords(object):
-    def __init__(self, list_of_wrods, name):
+    def __init__(self, list_of_wrods, name, txt=None):
         self.word_list = list_of_wrods
         self.name = name
+        self.txt = txt
 
 class ReadUnreadTxtFiles(object):
-    def __init__(self, fname, level='document'):
+    def __init__(self, fname, level='document', text_file=None):
         self.fname = fname
         self.level = level
+        # an already read TextFile of fname, so both levels can share one read
+        self.text_file = text_file
 
     def __iter__(self):
-        # iterator isn't really needed, left over from when this pointed to a directory rather than a file
-        # for fname in os.listdir(self.dirname):
-        self.doc = smart_open(self.fname, encoding='latin')
-
-        if self.level == 'document':
-            self.word_list = []  # list of all words in the doc
-            doc_txt = ""
-            for line in self.doc:
-                doc_txt += line
-                if (len(line.strip()) == 0):
-                    continue  # skip blank lines
-                self.word_list = self.word_list + simple_preprocess(remove_stopwords(line), deacc=True)
-            name = self.fname.split("/")[-1]
-            unread_docs.append(name)
-            unread_docs_txt[name] = doc_txt
-            yield ListOfUnreadWords(self.word_list, name)
-        elif self.level == 'paragraph':
-            self.word_list = []  # list of all words in the doc
-            paragraph_idx  = 0
-            for line in self.doc:
-                if (len(line.strip()) == 0):
-                    continue  # skip blank lines
-                name = "{}_pg{}".format(self.fname.split("/")[-1], str(paragraph_idx))
-                unread_paragraphs.append(name)
-                unread_paragraphs_txt[name] = line
-                paragraph_idx += 1
-                yield ListOfUnreadWords(simple_preprocess(remove_stopwords(line), deacc=True), name)
+        units = self.text_file.units(self.level) if self.text_file is not None else iter_text_units(self.fname, self.level)
+        for name, words, txt in units:
+            yield ListOfUnreadWords(words, name, txt)
 
 
-def gensim_lsi(arg_read_path, arg_unread_file, level='document'):
+class LsiIndex(object):
+    """
+    A trained LSI model over a fixed set of read units
 
-    list_of_list_of_words = ReadTxtFiles(arg_read_path, level)
-    list_of_list_of_unread_docs = ReadUnreadTxtFiles(arg_unread_file, level)
+    The index owns everything a query needs: dictionary, tf-idf and LSI models, the
+    similarity index, the names of its units by position and their raw texts by name
+    (memory mapped from disk for a loaded index, see MmapTextStore). The similarity index
+    is one of the SIMILARITY_BACKENDS: 'dense' brute force (the default), 'sharded' brute
+    force over memory-mapped shards, or the approximate 'lsh' and 'ivf' indexes, built
+    with similarity_options (see similarity_index). It is never
+    changed after it is built (folding in new units returns a new LsiIndex), so any
+    number of threads can query it at the same time, and it is freed as soon as the
+    last query holding it returns.
+    """
 
-    texts = []
-    for doc in list_of_list_of_words:  # each doc is a ListOfWords: list of all words for that doc/paragraph
-        texts.append(doc.list)
+    def __init__(self, names, texts, dictionary, tfidf, lsi, corpus, similarity='dense', similarity_options=None):
+        """
+        Initializes the index from trained models, see LsiIndex.train
+        """
+        self.names = names  # unit position -> document / paragraph name
+        self.texts = texts  # unit name -> raw text, a dict or a MmapTextStore
+        self.dictionary = dictionary
+        self.tfidf = tfidf
+        self.lsi = lsi
+        self.corpus = corpus
+        self.similarity = similarity
+        self.similarity_options = similarity_options or {}
+        # transform corpus to LSI space and index it
+        self.index = SIMILARITY_BACKENDS[similarity](unit_vector_chunks(lsi[corpus], lsi.num_topics), lsi.num_topics,
+                                                     **self.similarity_options)
+        # rankings entries of the units queried so far, by content; valid as long as the index, since it never changes
+        self.ranking_cache = RankingCache()
 
-    # remove words that appear only once
-    frequency = defaultdict(int) # defaultdict never raises keyError
-    for text in texts:
-        for token in text:
-            frequency[token] += 1
-    texts = [
-        [token for token in text if frequency[token] > 1]
-        for text in texts
-    ]
+    @classmethod
+    def train(cls, units, num_topics=200, similarity='dense', similarity_options=None):
+        """
+        Trains dictionary, tf-idf, LSI and similarity index from (name, article, words, raw text) units
+        """
+        texts = [words for _, _, words, _ in units]
 
-    dictionary = corpora.Dictionary(texts) # create gensim dictionary structure from words
+        # remove words that appear only once
+        frequency = defaultdict(int) # defaultdict never raises keyError
+        for text in texts:
+            for token in text:
+                frequency[token] += 1
+        texts = [
+            [token for token in text if frequency[token] > 1]
+            for text in texts
+        ]
 
-    corpus = [dictionary.doc2bow(text) for text in texts] # turn all words into the general corpus
+        dictionary = corpora.Dictionary(texts) # create gensim dictionary structure from words
+        corpus = [dictionary.doc2bow(text) for text in texts] # turn all words into the general corpus
+        tfidf = models.TfidfModel(corpus)  # initialize a model
+        lsi = models.LsiModel(tfidf[corpus], id2word=dictionary, num_topics=num_topics)  # initialize an LSI transformation
+        return cls([unit[0] for unit in units], dict((unit[0], unit[3]) for unit in units), dictionary, tfidf, lsi,
+                   corpus, similarity, similarity_options)
 
-    tfidf = models.TfidfModel(corpus)  # initialize a model
+    def fold_in(self, units):
+        """
+        Returns a new LsiIndex with units added through LsiModel.add_documents
+        Words outside the dictionary are ignored, and the tf-idf weights are not updated
+        The texts of a loaded (memory mapped) index are read back into memory
+        """
+        lsi = copy.deepcopy(self.lsi)
+        bows = [self.dictionary.doc2bow(words) for _, _, words, _ in units]
+        lsi.add_documents(self.tfidf[bows])
+        texts = dict(self.texts.items())
+        texts.update((unit[0], unit[3]) for unit in units)
+        return LsiIndex(self.names + [unit[0] for unit in units], texts, self.dictionary, self.tfidf, lsi,
+                        self.corpus + bows, self.similarity, self.similarity_options)
 
-    corpus_tfidf = tfidf[corpus]  # use the model to transform vectors
+    def query(self, arg_unread_file, level='document', text_file=None, duplicates=None):
+        """
+        Ranks the indexed units against an unread file
+        text_file is an optional already read TextFile of arg_unread_file
+        """
+        return dict(self.iter_query(arg_unread_file, level, text_file, duplicates=duplicates))
 
-    lsi = models.LsiModel(corpus_tfidf, id2word=dictionary, num_topics=200)  # initialize an LSI transformation
+    def iter_query(self, arg_unread_file, level='document', text_file=None, top_k=None, verbose=True,
+                   batch_size=256, duplicates=None, cache=True):
+        """
+        Ranks the indexed units against each unit of an unread file, yielding (name, rankings entry)
+        pairs one unit at a time (the file itself is read lazily when text_file is not given)
+        With top_k, only the top_k most similar units are listed and the entry carries the
+        'moments' (mean, sd) of all similarities. An approximate similarity index only lists
+        (the top_k of) its candidates, and always gives the exact moments
+        Rankings are lists of (name, similarity); the entry's 'texts' holds the raw texts by name
+        verbose prints the name of each unit as it is ranked
+        Units are projected and compared batch_size at a time, see query_vectors and search_batch;
+        units queried before (with the same top_k) come from the ranking cache, the others are added
+        to it unless cache is False (a one-off stream)
+        duplicates is an optional function of a unit's raw text giving the rankings entry of a unit
+        that need not be ranked, or None (see ReadingAssistant.duplicate_entry)
+        """
+        units = iter(ReadUnreadTxtFiles(arg_unread_file, level, text_file))
+        while True:
+            batch = list(islice(units, batch_size))
+            if not batch:
+                return
+            skipped = [duplicates(doc.txt) for doc in batch] if duplicates is not None else [None] * len(batch)
+            keys = [content_key(doc.txt, top_k) for doc in batch]
+            for i, key in enumerate(keys):
+                if skipped[i] is None:
+                    skipped[i] = self.ranking_cache.get(key)
+                    if skipped[i] is not None:
+                        skipped[i].update(raw_txt=batch[i].txt, texts=self.texts)
+            ranked = [doc for doc, entry in zip(batch, skipped) if entry is None]
+            instruments.count('lsi ranking cache hits', len(batch) - len(ranked))
+            with instruments.stage('lsi query'):
+                # convert the queries to LSI space
+                queries = self.query_vectors([doc.word_list for doc in ranked])
 
-    index = similarities.MatrixSimilarity(lsi[corpus])  # transform corpus to LSI space and index it
+                # perform the similarity queries against the corpus, a block of queries per matrix product
+                entries = []
+                found = []  # positions of each ranking, for the recall counts
+                for doc, (positions, sims, moments) in zip(ranked, self.index.search_batch(queries, top_k)):
+                    entry = {'raw_txt': doc.txt}
+                    if moments is not None:
+                        entry['moments'] = moments
 
-    ### Now we have the model.  We need to query it with the unread documents.
+                    # sort the most similar documents to the top (ties in position order)
+                    order = numpy.argsort(-sims, kind='stable')
 
-    # this iterates, but for our purposes, this is always just one document...
-    rankings = {}
-    for doc in list_of_list_of_unread_docs:
-        print("unread document = ", doc.name.upper())
+                    # create the ranking array
+                    entry['ranking'] = list(zip([self.names[i] for i in positions[order].tolist()], sims[order]))
+                    entry['texts'] = self.texts
+                    entries.append(entry)
+                    found.append(positions)
+            if cache:
+                for key, entry in zip([key for key, entry in zip(keys, skipped) if entry is None], entries):
+                    self.ranking_cache.put(key, entry)
 
-        # create the vectors for the bag of words from all the words in the document
-        vec_bow = dictionary.doc2bow(doc.word_list)
+            if instruments.enabled:
+                instruments.count('lsi units ranked', len(ranked))
+                instruments.count('lsi tokens processed', sum(len(doc.word_list) for doc in ranked))
+                if self.index.approximate:
+                    for query, positions in zip(queries, found):
+                        k = min(top_k or 10, len(self.index))
+                        exact = top_positions(self.index.similarities(query), k)
+                        instruments.count('lsi recall hits', len(numpy.intersect1d(positions, exact)))
+                        instruments.count('lsi recall wanted', k)
+                else:
+                    instruments.count('lsi documents scored', len(ranked) * len(self.names))
 
-        # convert the query to LSI space
-        vec_lsi = lsi[vec_bow]
+            entries = iter(entries)
+            for doc, skipped_entry in zip(batch, skipped):
+                entry = skipped_entry if skipped_entry is not None else next(entries)
+                if verbose:
+                    print("unread document = ", doc.name.upper())
+                yield doc.name, entry
 
-        # perform a similarity query against the corpus
-        sims = index[vec_lsi]
+    def query_vectors(self, word_lists):
+        """
+        Unit-length float32 LSI vectors of several queries, one row per list of words
+        The same as query_vector(lsi[bow]) of each, but all projected with one sparse-dense product
+        """
+        bows = [self.dictionary.doc2bow(words) for words in word_lists]
+        counts = matutils.corpus2csc(bows, num_terms=self.lsi.num_terms, dtype=self.lsi.projection.u.dtype,
+                                     num_docs=len(bows))
+        # a model of few units has fewer topics than num_topics, the rest are zeros as in sparse2full
+        topics = numpy.zeros((len(bows), self.lsi.num_topics))
+        projection = self.lsi.projection.u[:, :self.lsi.num_topics]
+        topics[:, :projection.shape[1]] = counts.T @ projection
+        norms = numpy.sqrt(numpy.einsum('ij,ij->i', topics, topics))
+        norms[norms == 0] = 1.0
+        return (topics / norms[:, None]).astype(numpy.float32)
 
-        # sort the most similar documents to the top
-        sims = sorted(enumerate(sims), key=lambda item: -item[1])
+    def recall(self, word_lists, k=10):
+        """
+        Recall of the similarity index against brute force (see recall_at_k), querying with word lists
+        """
+        return recall_at_k(self.index, self.query_vectors(word_lists), k)
 
-        # create the ranking array
-        ranking = []
-        for i, doc_score in sims:
-            if level == 'document':
-                ranking.append((read_docs[i], doc_score, read_docs_txt[read_docs[i]]))
-            elif level == 'paragraph':
-                ranking.append((read_paragraphs[i], doc_score, read_paragraphs_txt[read_paragraphs[i]]))
+    def save(self, prefix):
+        """
+        Saves the models and unit store next to prefix, the similarity index is rebuilt on load
+        """
+        self.dictionary.save(prefix + '.dictionary')
+        self.tfidf.save(prefix + '.tfidf')
+        self.lsi.save(prefix + '.model')
+        MmapTextStore.write(prefix + '.texts', self.texts.items())
+        with open(prefix + '.units', 'wb') as f:
+            pickle.dump({'names': self.names, 'corpus': self.corpus}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, prefix, similarity='dense', similarity_options=None):
+        """
+        Loads an index saved with save(), its texts stay on disk until asked for
+        """
+        with open(prefix + '.units', 'rb') as f:
+            saved = pickle.load(f)
+        if 'texts' in saved:
+            # saved before the texts moved to their own file
+            texts = dict(zip(saved['names'], saved['texts']))
+        else:
+            texts = MmapTextStore(prefix + '.texts')
+        return cls(saved['names'], texts, corpora.Dictionary.load(prefix + '.dictionary'),
+                   models.TfidfModel.load(prefix + '.tfidf'), models.LsiModel.load(prefix + '.model'),
+                   saved['corpus'], similarity, similarity_options)
+
+
+class LsiService(object):
+    """
+    Keeps the current LsiIndex of the read documents at one level, reused across queries
+
+    Documents that are read are folded into a copy of the model with LsiModel.add_documents.
+    Documents that are forgotten, or too many folded-in additions (whose words outside the
+    original dictionary are ignored), make the model stale; it is then retrained in a
+    background thread from the tokens kept in memory, so the read folder is never re-read.
+    Until the retrained index is swapped in (under the lock), queries keep getting the
+    previous one, with the units of forgotten files taken out of its rankings. Queries run
+    on the LsiIndex that is current when they start, without holding the lock.
+    With a model_dir the model is saved to disk and reused on the next start as long as
+    the read folder has not changed.
+    """
+
+    def __init__(self, read_path, level='document', num_topics=200, model_dir=None, refresh_ratio=0.25,
+                 token_cache=None, similarity='dense', similarity_options=None):
+        """
+        Initializes the service, the model is built (or loaded) on first use
+        token_cache is an optional TokenCache shared with other services / assistants
+        similarity names the similarity index of the model (see LsiIndex), 'sharded' keeps its
+        shards under model_dir unless similarity_options give another directory
+        """
+        self.read_path = read_path
+        self.token_cache = token_cache
+        self.level = level
+        self.num_topics = num_topics
+        self.model_dir = model_dir
+        # retrain once folded-in units exceed this fraction of the collection
+        self.refresh_ratio = refresh_ratio
+        self.similarity = similarity
+        self.similarity_options = dict(similarity_options or {})
+        if similarity == 'sharded' and model_dir is not None:
+            self.similarity_options.setdefault('directory', model_dir)
+
+        # one entry per read document / paragraph: (name, article, words, raw text)
+        self.units = []
+        self.lsi_index = None
+        self.folded_in = 0
+        self.stale = True
+        # the texts saved in model_dir, opened by texts() while no model is loaded
+        self.saved_texts = None
+        # names of the units of forgotten files that the current (stale) LsiIndex still has; they
+        # are left out of its rankings until the retrained index is swapped in
+        self.removed_names = set()
+        # bumped whenever self.units change, so a retrain can tell if its units are still the current ones
+        self.version = 0
+
+        self.lock = threading.RLock()
+        self.rebuild_thread = None
+
+    def current(self):
+        """
+        The current LsiIndex, building or loading it if there is none yet
+        A stale one is still returned, while it is retrained in the background
+        """
+        with self.lock:
+            if self.lsi_index is None:
+                if not self.load():
+                    self.units = [(u.name, u.article, u.list, u.txt) for u in ReadTxtFiles(self.read_path, self.level, token_cache=self.token_cache)]
+                    self.version += 1
+                    self.train()
+            elif self.stale:
+                self.refresh_in_background()
+            return self.lsi_index
+
+    def train(self):
+        """
+        Retrains the LsiIndex from self.units
+        """
+        with self.lock, instruments.stage('lsi train'):
+            self.lsi_index = LsiIndex.train(self.units, self.num_topics, self.similarity, self.similarity_options)
+            self.folded_in = 0
+            self.stale = False
+            self.removed_names = set()
+            self.save()
+
+    def add_document(self, path, text_file=None):
+        """
+        Folds a newly read file into the model, text_file is an optional already read TextFile of path
+        """
+        if text_file is None:
+            text_file = read_text_file(path, self.token_cache)
+        new_units = [(name, text_file.name, words, txt) for name, words, txt in text_file.units(self.level)]
+        with self.lock:
+            self.units.extend(new_units)
+            self.removed_names.difference_update(unit[0] for unit in new_units)
+            self.version += 1
+            if self.lsi_index is None or self.stale:
+                self.stale = True
+                return
+            self.folded_in += len(new_units)
+            if self.folded_in > self.refresh_ratio * len(self.units):
+                self.refresh_in_background()
+            else:
+                self.lsi_index = self.lsi_index.fold_in(new_units)
+                self.save()
+
+    def remove_document(self, path):
+        """
+        Drops a forgotten file; the model is retrained in the background
+        """
+        fname = os.path.split(path)[1]
+        with self.lock:
+            self.removed_names.update(unit[0] for unit in self.units if unit[1] == fname)
+            self.units = [unit for unit in self.units if unit[1] != fname]
+            self.version += 1
+            if self.lsi_index is not None:
+                self.refresh_in_background()
+
+    def refresh_in_background(self):
+        """
+        Marks the model stale and retrains it in a background thread, unless one is already running
+        The units are copied under the lock and the model trained without it; the new LsiIndex is
+        swapped in only if the units did not change meanwhile, otherwise it is trained again
+        """
+        with self.lock:
+            self.stale = True
+            if self.rebuild_thread is not None and self.rebuild_thread.is_alive():
+                return
+
+            def refresh():
+                while True:
+                    with self.lock:
+                        units = list(self.units)
+                        version = self.version
+                    with instruments.stage('lsi train'):
+                        lsi_index = LsiIndex.train(units, self.num_topics, self.similarity, self.similarity_options)
+                    with self.lock:
+                        if version == self.version:
+                            self.lsi_index = lsi_index
+                            self.folded_in = 0
+                            self.stale = False
+                            self.removed_names = set()
+                            self.rebuild_thread = None
+                            self.save()
+                            return
+
+            self.rebuild_thread = threading.Thread(target=refresh)
+            self.rebuild_thread.daemon = True
+            self.rebuild_thread.start()
+
+    def wait(self):
+        """
+        Waits for background retraining to finish
+        """
+        while True:
+            with self.lock:
+                thread = self.rebuild_thread
+            if thread is None or thread is threading.current_thread():
+                return
+            thread.join()
+            with self.lock:
+                if self.rebuild_thread is thread:
+                    self.rebuild_thread = None
+
+    def read_folder_signature(self):
+        """
+        (file name, size, mtime) of every file in the read folder, to tell if a saved model is still current
+        """
+        signature = []
+        for fname in sorted(os.listdir(self.read_path)):
+            stat = os.stat(os.path.join(self.read_path, fname))
+            signature.append((fname, stat.st_size, stat.st_mtime))
+        return signature
+
+    def model_path(self, name):
+        return os.path.join(self.model_dir, "lsi-{}.{}".format(self.level, name))
+
+    def save(self):
+        """
+        Saves the model to model_dir, if there is one
+        """
+        if self.model_dir is None or self.lsi_index is None:
+            return
+        with self.lock:
+            if not os.path.isdir(self.model_dir):
+                os.makedirs(self.model_dir)
+            self.lsi_index.save(self.model_path('index'))
+            self.saved_texts = None
+            with open(self.model_path('service'), 'wb') as f:
+                pickle.dump({'signature': self.read_folder_signature(), 'num_topics': self.num_topics,
+                             'units': self.units, 'folded_in': self.folded_in},
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        """
+        Loads the model saved in model_dir, returns False if there is none or the read folder changed since
+        """
+        if self.model_dir is None or not os.path.isfile(self.model_path('service')):
+            return False
+        with open(self.model_path('service'), 'rb') as f:
+            saved = pickle.load(f)
+        if saved['signature'] != self.read_folder_signature() or saved['num_topics'] != self.num_topics:
+            return False
+        try:
+            lsi_index = LsiIndex.load(self.model_path('index'), self.similarity, self.similarity_options)
+        except (ValueError, OSError):
+            # damaged, or written in an older layout: train again
+            return False
+        self.units = saved['units']
+        self.folded_in = saved['folded_in']
+        self.lsi_index = lsi_index
+        self.stale = False
+        return True
+
+    def texts(self):
+        """
+        Raw texts of the read units by name, for rankings taken from a ResultCache, without
+        loading or training the model: those of the current LsiIndex if there is one, else those
+        saved in model_dir; failing both, the model is only built when a text is asked for
+        """
+        lsi_index = self.lsi_index
+        if lsi_index is not None:
+            return lsi_index.texts
+        if self.model_dir is not None:
+            with self.lock:
+                if self.saved_texts is None and os.path.isfile(self.model_path('index') + '.texts'):
+                    try:
+                        self.saved_texts = MmapTextStore(self.model_path('index') + '.texts')
+                    except (ValueError, OSError):
+                        pass
+                if self.saved_texts is not None:
+                    return self.saved_texts
+
+        def lookup(name):
+            text = self.current().texts.get(name)
+            if text is None:
+                raise KeyError(name)
+            return text
+        return TextStore(lookup)
+
+    def settled(self):
+        """
+        True unless the current model is stale: retrained (or waiting to be) after a read or forget,
+        so that its rankings are not those of a model trained on the read files alone. With no model
+        yet it is True, the first query loads or trains one on the read files
+        """
+        with self.lock:
+            if self.lsi_index is None:
+                return True
+            return not self.stale and (self.rebuild_thread is None or not self.rebuild_thread.is_alive())
+
+    def serving(self):
+        """
+        (current LsiIndex, names of the forgotten units it still ranks), see current and removed_names
+        """
+        with self.lock:
+            return self.current(), frozenset(self.removed_names)
+
+    def query(self, arg_unread_file, text_file=None, duplicates=None):
+        """
+        Ranks the read documents against an unread file, only projecting the file and comparing it
+        text_file is an optional already read TextFile of arg_unread_file
+        duplicates skips the units it gives an entry for, see LsiIndex.iter_query
+        Units of forgotten files are left out, even while the model is being retrained without them
+        """
+        if text_file is None:
+            text_file = read_text_file(arg_unread_file, self.token_cache)
+        lsi_index, removed = self.serving()
+        return dict(without_units(lsi_index.iter_query(arg_unread_file, self.level, text_file, duplicates=duplicates),
+                                  removed))
+
+    def iter_query(self, arg_unread_file, top_k=None, text_file=None, verbose=True, duplicates=None, cache=True):
+        """
+        Yields (name, rankings entry) pairs one unit at a time, keeping the top_k matches of each
+        Without text_file (an already read TextFile of arg_unread_file) the file is read lazily,
+        not through the token cache, for very large unread files
+        cache=False keeps the rankings out of the ranking cache, see LsiIndex.iter_query
+        Units of forgotten files are left out, as in query
+        """
+        lsi_index, removed = self.serving()
+        return without_units(lsi_index.iter_query(arg_unread_file, self.level, text_file, top_k, verbose,
+                                                  duplicates=duplicates, cache=cache), removed)
+
+
+def without_units(pairs, removed):
+    """
+    (name, rankings entry) pairs with the units named in removed taken out of each ranking
+    Near duplicate entries (already_read) list read units of the bm25 index and are left as they are
+    """
+    for name, entry in pairs:
+        if removed and not entry.get('already_read'):
+            entry = dict(entry, ranking=[x for x in entry['ranking'] if x[0] not in removed])
+        yield name, entry
 
-        rankings[doc.name] = ranking
-        if level == 'document':
-            rankings[doc.name] = {'raw_txt': unread_docs_txt[doc.name], 'ranking': ranking}
-        elif level == 'paragraph':
-            rankings[doc.name] = {'raw_txt': unread_paragraphs_txt[doc.name], 'ranking': ranking}
-        # rankings[doc.name] = {'raw_txt': doc.name, 'ranking': ranking}
 
-    return rankings
+def gensim_lsi(arg_read_path, arg_unread_file, level='document', similarity='dense'):
+    """
+    One-off LSI ranking of an unread file, training a fresh model (see LsiService to reuse one)
+    """
+    return LsiService(arg_read_path, level, similarity=similarity).query(arg_unread_file)
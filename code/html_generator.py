@@ -1,25 +1,27 @@
+import os
+import threading
+from html import escape
+from instrumentation import instruments
 
-class HTML_Generator:
 
-    def write_it(self, it, how):
-        """
-        Opens the file (name set during object creation), writes, and closes
-        """
-        f = open(self.outfile, how)
-        f.write(it)
-        f.close()
-
-    def __init__(self, outfile, name):
-        """
-        As part of the creation process, the output file is started
-        """
-        self.outfile = outfile
-        self.name = name
-        outstr = '''
+class HTML_Generator:
+    """
+    Writes an html report through one buffered file handle
+
+    Use it as a context manager (or call close_file) so the footer is written and the file
+    closed. Text is html-escaped. With page_size, the report is split into several files
+    of at most page_size titled sections each (outfile, then outfile-2.html, ...), linked
+    to each other. With lazy_text, the text of each match is kept in an inert <template>
+    and only turned into page content when its drop-down is first opened.
+    Each generator has its own handle and lock, so several reports can be written at once.
+    """
+
+    header = '''
             <!-- source: W3 Schools https://www.w3schools.com/howto/howto_js_collapsible.asp -->
             <!DOCTYPE html>
             <html>
             <head>
+            <meta charset="utf-8">
             <meta name="viewport" content="width=device-width, initial-scale=1">
             <style>
             .collapsible {
@@ -61,43 +63,8 @@ class HTML_Generator:
             </head>
             <body>
             '''
-        outstr += "<h2>Rank for: " + self.name + "</h2>"
-        self.write_it(outstr, "w")
-
-    def add_divide(self, text):
-        """
-        A major header
-        """
-        outstr = "<hr/><hr/><hr/><h1>" + str(text) + "</h1>"
-        self.write_it(outstr, "a")
-
-    def add_title(self, text):
-        """
-        A minor header
-        """
-        outstr = "<h3>" + str(text) + "</h3>"
-        self.write_it(outstr, "a")
 
-    def add_text(self, text):
-        """
-        <paragraph> text
-        """
-        outstr = "<p>" + str(text) + "</p>"
-        self.write_it(outstr, "a")
-
-    def add_match(self, match_name, match_score, match_text):
-        """
-        Adds text inside a drop-down
-        """
-        outstr = "<button class=\"collapsible\"> similarity found: " + str(match_name) + "(score=" + str(match_score) + ") " + "</button>"
-        outstr += "<div class=\"content\"><p>" + str(match_text) + "</p></div>"
-        self.write_it(outstr, "a")
-
-    def close_file(self):
-        """
-        Adds footer HTML
-        """
-        outstr = '''
+    footer = '''
             <script>
             var coll = document.getElementsByClassName("collapsible");
             var i;
@@ -106,11 +73,16 @@ class HTML_Generator:
               coll[i].addEventListener("click", function() {
                 this.classList.toggle("active");
                 var content = this.nextElementSibling;
+                var template = content.querySelector("template");
+                if (template) {
+                  content.appendChild(template.content.cloneNode(true));
+                  template.remove();
+                }
                 if (content.style.maxHeight){
                   content.style.maxHeight = null;
                 } else {
                   content.style.maxHeight = content.scrollHeight + "px";
-                } 
+                }
               });
             }
             </script>
@@ -119,12 +91,117 @@ class HTML_Generator:
             </html>
             '''
 
-        self.write_it(outstr, "a")
-        
-        #print("\nDropping your pen and rubbing your temples, you look over", self.outfile, "and smile knowing the analysis is done.  ")
+    def __init__(self, outfile, name, page_size=None, lazy_text=False, buffer_size=1 << 16):
+        """
+        As part of the creation process, the output file is started
+        """
+        self.outfile = outfile
+        self.name = name
+        self.page_size = page_size
+        self.lazy_text = lazy_text
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.f = None
+        self.page = 0
+        self.titles = 0  # titled sections on the current page
+        self.divide = None  # the last major header, repeated at the top of a new page
+        self.open_page()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close_file()
+
+    def page_file(self, page):
+        """
+        File name of a page, the first page is outfile itself
+        """
+        if page == 1:
+            return self.outfile
+        root, ext = os.path.splitext(self.outfile)
+        return "{}-{}{}".format(root, page, ext or '.html')
 
+    def open_page(self):
+        """
+        Starts the next page file
+        """
+        self.page += 1
+        self.titles = 0
+        self.f = open(self.page_file(self.page), 'w', encoding='utf8', buffering=self.buffer_size)
+        self.f.write(self.header)
+        self.f.write("<h2>Rank for: " + escape(str(self.name), quote=False) + "</h2>")
+        if self.page > 1:
+            self.f.write('<p><a href="{}">&larr; page {}</a></p>'.format(
+                escape(os.path.basename(self.page_file(self.page - 1))), self.page - 1))
+            if self.divide is not None:
+                self.f.write("<h1>" + escape(self.divide, quote=False) + " (continued)</h1>")
+
+    def end_page(self, last):
+        """
+        Writes the footer of the current page (with a link to the next one) and closes it
+        """
+        if not last:
+            self.f.write('<p><a href="{}">page {} &rarr;</a></p>'.format(
+                escape(os.path.basename(self.page_file(self.page + 1))), self.page + 1))
+        self.f.write(self.footer)
+        if instruments.enabled:
+            self.f.flush()
+            instruments.count('bytes written', self.f.tell())
+        self.f.close()
+        self.f = None
 
+    def add_divide(self, text):
+        """
+        A major header
+        """
+        with self.lock:
+            self.divide = str(text)
+            self.f.write("<hr/><hr/><hr/><h1>" + escape(self.divide, quote=False) + "</h1>")
 
+    def add_title(self, text):
+        """
+        A minor header, starting a new page first if the current one is full
+        """
+        with self.lock:
+            if self.page_size and self.titles >= self.page_size:
+                self.end_page(last=False)
+                self.open_page()
+            self.titles += 1
+            self.f.write("<h3>" + escape(str(text), quote=False) + "</h3>")
 
+    def add_text(self, text):
+        """
+        <paragraph> text
+        """
+        with self.lock:
+            self.f.write("<p>" + escape(str(text), quote=False) + "</p>")
+
+    def add_lines(self, lines):
+        """
+        <paragraph> with one line per text of lines, separated by blank lines
+        """
+        with self.lock:
+            self.f.write("<p>" + "<br><br>".join(escape(str(line), quote=False) for line in lines) + "</p>")
+
+    def add_match(self, match_name, match_score, match_text):
+        """
+        Adds text inside a drop-down
+        """
+        outstr = "<button class=\"collapsible\"> similarity found: " + escape(str(match_name), quote=False) + "(score=" + str(match_score) + ") " + "</button>"
+        if self.lazy_text:
+            outstr += "<div class=\"content\"><template><p>" + escape(str(match_text), quote=False) + "</p></template></div>"
+        else:
+            outstr += "<div class=\"content\"><p>" + escape(str(match_text), quote=False) + "</p></div>"
+        with self.lock:
+            self.f.write(outstr)
 
+    def close_file(self):
+        """
+        Adds footer HTML and closes the file
+        """
+        with self.lock:
+            if self.f is not None:
+                self.end_page(last=True)
 
+        #print("\nDropping your pen and rubbing your temples, you look over", self.outfile, "and smile knowing the analysis is done.  ")
@@ -0,0 +1,91 @@
+import os
+import json
+import pickle
+import struct
+import hashlib
+
+# on-disk layout: MAGIC, format version, header length, JSON header, pickled index state
+SNAPSHOT_MAGIC = b'RAIDX'
+SNAPSHOT_VERSION = 3
+SNAPSHOT_PREAMBLE = struct.Struct('>5sHI')
+
+
+def file_signature(path):
+    """
+    (mtime, size, sha1) of a file, used to detect changes between runs
+    """
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size, file_hash(path)]
+
+
+def file_hash(path):
+    """
+    sha1 hex digest of a file's content
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def changed_files(directory, signatures):
+    """
+    Compares the files in directory against stored {file name: signature}
+    Returns (added, changed, deleted, refreshed) lists of file names; files whose mtime
+    changed but whose content did not are refreshed: their signature is updated in place
+    """
+    current = set(os.listdir(directory))
+    added, changed, refreshed = [], [], []
+    for fname in sorted(current):
+        path = os.path.join(directory, fname)
+        if fname not in signatures:
+            added.append(fname)
+            continue
+        stat = os.stat(path)
+        mtime, size, sha1 = signatures[fname]
+        if stat.st_mtime == mtime and stat.st_size == size:
+            continue
+        if stat.st_size != size or file_hash(path) != sha1:
+            changed.append(fname)
+        else:
+            signatures[fname] = [stat.st_mtime, stat.st_size, sha1]
+            refreshed.append(fname)
+    deleted = sorted(fname for fname in signatures if fname not in current)
+    return added, changed, deleted, refreshed
+
+
+def write_snapshot(path, header, state):
+    """
+    Writes a snapshot: a small JSON header (level, read path, file signatures) and the pickled index state
+    The file is written next to its destination and moved into place, so a crash never leaves half a snapshot
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    header_bytes = json.dumps(header).encode('utf8')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """
+    Reads a snapshot, unpickling the index state straight from the file
+    Returns (header, state), or None if the file is missing, damaged or of another format version
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) < SNAPSHOT_PREAMBLE.size:
+        return None
+    with open(path, 'rb') as f:
+        try:
+            magic, version, header_length = SNAPSHOT_PREAMBLE.unpack(f.read(SNAPSHOT_PREAMBLE.size))
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                return None
+            header = json.loads(f.read(header_length).decode('utf8'))
+            state = pickle.load(f)
+        except (ValueError, EOFError, struct.error, pickle.UnpicklingError):
+            return None
+    return header, state
@@ -0,0 +1,183 @@
+import io
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+from collections import OrderedDict
+
+# switched on by these environment variables, or by the --instrument / --profile / --metrics-log command line flags
+INSTRUMENT_ENV = 'READING_ASSISTANT_INSTRUMENT'
+PROFILE_ENV = 'READING_ASSISTANT_PROFILE'  # one of PROFILE_MODES
+METRICS_LOG_ENV = 'READING_ASSISTANT_METRICS_LOG'  # JSON lines file
+
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+
+# returned by Instruments.stage when disabled, so a disabled stage costs one attribute test
+NULL_STAGE = contextlib.nullcontext()
+
+
+class Stage(object):
+    """
+    Times one run of a named stage into an Instruments
+    """
+
+    __slots__ = ('instruments', 'name', 'start')
+
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instruments.add_time(self.name, time.perf_counter() - self.start)
+
+
+class Instruments(object):
+    """
+    Stage timers and counters for the rank pipeline
+
+    Code marks its stages with `with instruments.stage('bm25 score'):` and its work with
+    instruments.count('postings touched', n). Both do nothing unless enabled; counts that
+    cost something to compute are guarded with `if instruments.enabled:`. Stages run in
+    several threads at once add up, so a stage total can exceed the wall time.
+    """
+
+    def __init__(self, enabled=False):
+        """
+        Initializes empty timers and counters
+        """
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the timers and counters, e.g. before each rank
+        """
+        with self.lock:
+            self.timers = OrderedDict()  # stage -> [calls, seconds]
+            self.counters = OrderedDict()  # counter -> total
+
+    def stage(self, name):
+        """
+        Context manager timing one run of the stage name
+        """
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def count(self, name, n=1):
+        """
+        Adds n to the counter name
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """
+        The timers and counters as a JSON-able dict
+        """
+        with self.lock:
+            return {'stages': OrderedDict((name, {'calls': calls, 'seconds': seconds})
+                                          for name, (calls, seconds) in self.timers.items()),
+                    'counters': OrderedDict(self.counters)}
+
+    def summary(self):
+        """
+        The timers and counters as a few lines of text
+        """
+        report = self.report()
+        lines = ['{:<28} {:>7} {:>10}'.format('stage', 'calls', 'seconds')]
+        for name, stage in report['stages'].items():
+            lines.append('{:<28} {:>7} {:>10.3f}'.format(name, stage['calls'], stage['seconds']))
+        for name, total in report['counters'].items():
+            lines.append('{:<28} {:>18}'.format(name, total))
+        return "\n".join(lines)
+
+    def log(self, path, **fields):
+        """
+        Appends the report, with fields (command, file, ...) and a timestamp, as one JSON line to path
+        """
+        record = OrderedDict([('time', time.time())])
+        record.update(fields)
+        record.update(self.report())
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+
+instruments = Instruments(enabled=bool(os.environ.get(INSTRUMENT_ENV) or os.environ.get(METRICS_LOG_ENV)))
+
+
+@contextlib.contextmanager
+def profiled(mode=None, out_path=None, limit=25):
+    """
+    Runs the body under cProfile (mode 'cprofile') or tracemalloc (mode 'tracemalloc') and prints
+    the top limit entries; with out_path the cProfile stats are also dumped there. mode None does nothing
+    cProfile only sees the calling thread: stages run on a RankJob's workers show up as its waits,
+    their own times are in the instruments' 'job: ...' stages
+    """
+    if mode is None:
+        yield
+        return
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if out_path is not None:
+                profile.dump_stats(out_path)
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(limit)
+            print(stream.getvalue())
+    elif mode == 'tracemalloc':
+        already_tracing = tracemalloc.is_tracing()
+        if not already_tracing:
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if not already_tracing:
+                tracemalloc.stop()
+            print("traced memory: {:.1f} MB now, {:.1f} MB peak".format(current / 1e6, peak / 1e6))
+            for stat in snapshot.statistics('lineno')[:limit]:
+                print("  ", stat)
+    else:
+        raise ValueError("unknown profile mode: {} (use {})".format(mode, " or ".join(PROFILE_MODES)))
+
+
+@contextlib.contextmanager
+def instrumented(profile=None, metrics_log=None, **fields):
+    """
+    One instrumented run (a rank, a batch): resets the instruments, runs the body under profiled(profile),
+    then, if the instruments are enabled, prints their summary and appends it with fields to metrics_log
+    cProfile stats are dumped to profile-<command>.prof
+    """
+    instruments.reset()
+    start = time.perf_counter()
+    out_path = "profile-{}.prof".format(fields.get('command', 'run')) if profile == 'cprofile' else None
+    with profiled(profile, out_path):
+        yield
+    if instruments.enabled:
+        instruments.add_time('total', time.perf_counter() - start)
+        print(instruments.summary())
+        if metrics_log:
+            instruments.log(metrics_log, **fields)
@@ -0,0 +1,107 @@
+import sys
+import json
+import time
+import asyncio
+from urllib.parse import quote
+
+
+async def request(reader, writer, method, target, host):
+    """
+    Sends one HTTP/1.1 request on an open connection, returns (status, decoded JSON body)
+    """
+    writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: 0\r\n\r\n".format(method, target, host).encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+def percentile(sorted_values, p):
+    """
+    p-th percentile (0-100) of sorted values, nearest rank
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def run(host, port, concurrency, requests, targets):
+    """
+    concurrency clients, each on its own kept-alive connection, send requests GETs in total,
+    cycling through targets; returns the latencies of successful requests and the error count
+    """
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in counter:
+                start = time.perf_counter()
+                status, _ = await request(reader, writer, 'GET', targets[i % len(targets)], host)
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+        finally:
+            writer.close()
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, errors
+
+
+async def unread_targets(host, port):
+    """
+    /rank targets for every unread file the server lists
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        _, files = await request(reader, writer, 'GET', '/files', host)
+    finally:
+        writer.close()
+    return ['/rank?file=' + quote(fname) for fname in files['unread']]
+
+
+def load_test(host='127.0.0.1', port=8642, concurrency=4, requests=100, targets=None):
+    """
+    Runs the load test and prints throughput and latency percentiles, returns them as a dict
+    """
+    targets = targets or asyncio.run(unread_targets(host, port))
+    start = time.perf_counter()
+    latencies, errors = asyncio.run(run(host, port, concurrency, requests, targets))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    stats = {'requests': requests, 'errors': errors, 'concurrency': concurrency, 'seconds': elapsed,
+             'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+             'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+             'p99': percentile(latencies, 99), 'max': latencies[-1] if latencies else 0.0}
+    print('{requests} requests ({errors} errors), {concurrency} clients: {requests_per_second:.1f} req/s, '
+          'p50 {p50:.3f}s, p90 {p90:.3f}s, p99 {p99:.3f}s, max {max:.3f}s'.format(**stats))
+    return stats
+
+
+if __name__ == "__main__":
+    """
+    Run from the command line against a running server.py:
+    python loadgen.py [--host h] [--port p] [--concurrency c] [--requests n] [target ...]
+    Targets default to /rank of every unread file.
+    """
+    args = sys.argv[1:]
+    options = {'--host': '127.0.0.1', '--port': '8642', '--concurrency': '4', '--requests': '100'}
+    for option in list(options):
+        if option in args:
+            i = args.index(option)
+            options[option] = args.pop(i + 1)
+            args.pop(i)
+    load_test(options['--host'], int(options['--port']), int(options['--concurrency']), int(options['--requests']),
+              args or None)
@@ -0,0 +1,111 @@
+import re
+import zlib
+import numpy
+
+WORD = re.compile("[a-z]+")
+
+# universal hashing (a * x + b) mod a Mersenne prime; with x < 2 ** 32 and a < PRIME, a * x fits in 64 bits
+PRIME = (1 << 31) - 1
+
+
+def shingle_hashes(text, size=3):
+    """
+    32-bit hashes of the distinct size-word shingles of a text, words being its lowercase letter runs
+    A text shorter than size words is one shingle; a text without words has none
+    """
+    words = WORD.findall(text.lower())
+    if not words:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    shingles = set(" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1)))
+    return numpy.fromiter((zlib.crc32(shingle.encode('utf8')) for shingle in shingles), dtype=numpy.uint64,
+                          count=len(shingles))
+
+
+class MinHashIndex(object):
+    """
+    MinHash signatures of texts with LSH banding, to find near duplicates without comparing every pair
+
+    The signature of a text is, for each of num_perm random hash functions, the smallest hash
+    of its word shingles; two texts agree on a signature entry with probability equal to the
+    Jaccard similarity of their shingle sets. Signatures are cut into bands of num_perm / bands
+    entries and a text is filed under each of its bands: texts sharing any band are candidates,
+    and a candidate is a near duplicate if the share of equal signature entries (the Jaccard
+    estimate) is at least threshold. With the defaults (16 bands of 4) a pair at Jaccard 0.8
+    is a candidate with probability > 0.999, a pair at 0.3 with probability ~ 0.12.
+    """
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.9, shingle_size=3, seed=1):
+        """
+        Initializes an empty index
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        random_state = numpy.random.RandomState(seed)
+        self.a = random_state.randint(1, PRIME, size=num_perm).astype(numpy.uint64)[:, None]
+        self.b = random_state.randint(0, PRIME, size=num_perm).astype(numpy.uint64)[:, None]
+        self.signatures = {}  # unit id -> signature
+        self.buckets = [{} for _ in range(bands)]  # band -> band bytes -> set of unit ids
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def signature(self, text):
+        """
+        MinHash signature (num_perm uint32) of a text, or None if it has no words
+        """
+        hashes = shingle_hashes(text, self.shingle_size)
+        if not len(hashes):
+            return None
+        return ((self.a * (hashes % PRIME) + self.b) % PRIME).min(axis=1).astype(numpy.uint32)
+
+    def band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, unit_id, text):
+        """
+        Indexes the text of a unit (replacing its previous text, if any)
+        """
+        self.remove(unit_id)
+        signature = self.signature(text)
+        if signature is None:
+            return
+        self.signatures[unit_id] = signature
+        for bucket, key in zip(self.buckets, self.band_keys(signature)):
+            bucket.setdefault(key, set()).add(unit_id)
+
+    def remove(self, unit_id):
+        """
+        Drops a unit, if it is indexed
+        """
+        signature = self.signatures.pop(unit_id, None)
+        if signature is None:
+            return
+        for bucket, key in zip(self.buckets, self.band_keys(signature)):
+            units = bucket.get(key)
+            if units is not None:
+                units.discard(unit_id)
+                if not units:
+                    del bucket[key]
+
+    def query(self, text):
+        """
+        The indexed units that are near duplicates of text, as (unit id, Jaccard estimate) pairs,
+        most similar first
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return []
+        candidates = set()
+        for bucket, key in zip(self.buckets, self.band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        matches = []
+        for unit_id in candidates:
+            estimate = float(numpy.count_nonzero(self.signatures[unit_id] == signature)) / self.num_perm
+            if estimate >= self.threshold:
+                matches.append((unit_id, estimate))
+        return sorted(matches, key=lambda x: (-x[1], x[0]))
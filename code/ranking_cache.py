@@ -0,0 +1,237 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy
+
+
+def content_key(text, *settings):
+    """
+    Cache key of a unit: the sha1 of its text, and the settings its ranking depends on (engine, k1, b, top_k, ...)
+    """
+    return (hashlib.sha1(text.encode('utf8', 'surrogatepass')).hexdigest(),) + settings
+
+
+class RankingCache(object):
+    """
+    Rankings of single units by content (see content_key), for one index generation
+
+    An unread file that is a new revision of one ranked before shares most of its paragraphs
+    with it; their rankings are taken from here and only the changed paragraphs are scored.
+    BM25 scores depend on the whole collection (idf, average length), so reading or forgetting
+    anything changes every score: an entry is only valid at the index generation it was
+    computed at, and the cache empties itself when asked about another generation.
+
+    Only the ranking (its ids and an array of its scores) and the 'moments' of an entry are
+    kept, not its texts: the caller attaches those again to what get returns. Eviction is LRU,
+    bounded by the estimated size of the kept rankings (max_bytes, see entry_bytes).
+    """
+
+    # estimated bytes of an entry besides its ranking: the key, the tuple holding it, the arrays' headers
+    ENTRY_OVERHEAD = 400
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        Initializes an empty cache
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (ids, scores, moments, estimated bytes)
+        self.bytes = 0
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def entry_bytes(cls, ids, scores):
+        # ids are references to strings the index holds already, 8 bytes each
+        return cls.ENTRY_OVERHEAD + 8 * len(ids) + scores.nbytes
+
+    def at_generation(self, generation):
+        # must hold the lock
+        if generation != self.generation:
+            self.entries.clear()
+            self.bytes = 0
+            self.generation = generation
+
+    def get(self, key, generation=None):
+        """
+        A new entry holding the cached 'ranking' (and 'moments') of key at generation, or None
+        """
+        with self.lock:
+            self.at_generation(generation)
+            cached = self.entries.get(key)
+            if cached is None:
+                return None
+            self.entries.move_to_end(key)
+        ids, scores, moments, _ = cached
+        # float64 scores were python floats, float32 ones (lsi similarities) stay numpy scalars
+        entry = {'ranking': list(zip(ids, scores.tolist() if scores.dtype == numpy.float64 else scores))}
+        if moments is not None:
+            entry['moments'] = moments
+        return entry
+
+    def put(self, key, entry, generation=None):
+        """
+        Caches the ranking and moments of the entry of key, computed at generation
+        """
+        ids = tuple(x[0] for x in entry['ranking'])
+        scores = numpy.array([x[1] for x in entry['ranking']])
+        size = self.entry_bytes(ids, scores)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.at_generation(generation)
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[3]
+            self.entries[key] = (ids, scores, entry.get('moments'), size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted[3]
+
+    def clear(self):
+        """
+        Drops every entry
+        """
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
+def pack_rankings(rankings):
+    """
+    Compact, picklable copy of a rankings dict: the entries without their text stores, each
+    ranking as the list of its ids and an array of its scores
+    """
+    packed = OrderedDict()
+    for unit_id, entry in rankings.items():
+        entry = dict(entry)
+        entry.pop('texts', None)
+        ranking = entry.pop('ranking')
+        entry['ids'] = [x[0] for x in ranking]
+        entry['scores'] = numpy.array([x[1] for x in ranking])
+        packed[unit_id] = entry
+    return packed
+
+
+def unpack_rankings(packed, texts):
+    """
+    The rankings dict packed by pack_rankings, texts(entry) giving the text store of each entry
+    """
+    rankings = OrderedDict()
+    for unit_id, entry in packed.items():
+        entry = dict(entry)
+        ids = entry.pop('ids')
+        scores = entry.pop('scores')
+        # float64 scores were python floats, float32 ones (lsi similarities) stay numpy scalars
+        entry['ranking'] = list(zip(ids, scores.tolist() if scores.dtype == numpy.float64 else scores))
+        entry['texts'] = texts(entry)
+        rankings[unit_id] = entry
+    return rankings
+
+
+class ResultCache(object):
+    """
+    Rankings of whole unread files, LRU in memory with an optional disk tier
+
+    Keys are (file content hash, level, method, k1, b, collection generation) tuples, see
+    rank_concurrently. Ranking a file again with the same settings (say after 'set scope',
+    which only changes what the reports show) takes its rankings from here. With a cache_dir
+    the rankings are also pickled to disk, compactly and without their text stores (which
+    get(key, texts) attaches again), so they survive restarts; the max_disk_entries most
+    recently used files are kept.
+    """
+
+    def __init__(self, max_entries=8, cache_dir=None, max_disk_entries=64):
+        """
+        Initializes an empty cache
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, texts):
+        """
+        Rankings of key from memory, then disk, or None; texts(entry) is the text store of an entry read from disk
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        rankings = self.load(key, texts)
+        if rankings is not None:
+            self.remember(key, rankings)
+        return rankings
+
+    def put(self, key, rankings):
+        """
+        Caches the rankings of key, in memory and on disk
+        """
+        self.remember(key, rankings)
+        self.save(key, rankings)
+
+    def remember(self, key, rankings):
+        with self.lock:
+            self.entries[key] = rankings
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drops the rankings held in memory (the disk tier is keyed by content and stays valid)
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode('utf8')).hexdigest() + ".rankings")
+
+    def load(self, key, texts):
+        """
+        Rankings of key from the disk tier, or None
+        """
+        if self.cache_dir is None:
+            return None
+        path = self.disk_path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                stored_key, packed = pickle.load(f)
+        except Exception:
+            # damaged, or pickled by another version of the code: rank again
+            return None
+        if stored_key != key:
+            return None
+        os.utime(path)
+        return unpack_rankings(packed, texts)
+
+    def save(self, key, rankings):
+        """
+        Writes the rankings of key to the disk tier, if there is one, and drops its least recently used files
+        """
+        if self.cache_dir is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self.disk_path(key)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, pack_rankings(rankings)), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        paths = [os.path.join(self.cache_dir, fname) for fname in os.listdir(self.cache_dir)
+                 if fname.endswith(".rankings")]
+        if len(paths) > self.max_disk_entries:
+            paths.sort(key=os.path.getmtime)
+            for old_path in paths[:len(paths) - self.max_disk_entries]:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
@@ -1,9 +1,24 @@
 import re
 # import os
 import sys
+import hashlib
+import glob
 import math
+import time
+import threading
+import multiprocessing
+from itertools import islice
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, CancelledError
 from gensimlsi import *
 from html_generator import *
+from bm25 import *
+from index_snapshot import *
+from token_cache import *
+from text_store import *
+from instrumentation import *
+from near_duplicates import *
+from ranking_cache import *
 import numpy
 
 # Allow use of raw_input on python3
@@ -13,16 +28,32 @@ except NameError: pass
 from os import listdir
 from os.path import isfile, join
 
+# unread files larger than this are ranked in streaming mode (see stream_rank)
+STREAM_THRESHOLD_BYTES = 8 * 1024 * 1024
+
+# read folders smaller than this are indexed in this process: starting a pool costs more than it saves
+PARALLEL_LOAD_MIN_BYTES = 8 * 1024 * 1024
+
+def document_text(doc):
+    """
+    Raw text of a Document, its lines joined for the document level
+    """
+    return "\n".join(doc.unprocessed_text) if isinstance(doc.unprocessed_text, list) else doc.unprocessed_text
+
 def list_files(mypath):
     onlyfiles = [f for f in listdir(mypath) if (isfile(join(mypath, f)) and not f.startswith('.'))]
     return onlyfiles
 
 class Document(object):
-    def __init__(self, document_id, processed_text, unprocessed_text):
+    def __init__(self, document_id, processed_text, unprocessed_text, article_id=None, paragraph_id=None):
         """
         Initializes a document
         """
         self.document_id = document_id
+        # id of the whole text file this document (or paragraph, or sentence) comes from
+        self.article_id = article_id if article_id is not None else document_id
+        # id of the paragraph a sentence comes from
+        self.paragraph_id = paragraph_id
         self.unprocessed_text = unprocessed_text  # list of sentences
         self.processed_text = processed_text  # list of sentences
         self.document_length = sum([len(sentence) for sentence in self.processed_text])
@@ -36,18 +67,24 @@ class DocumentProcessor(object):
     A DocumentProcessor broken down an article by whole document, paragraphs, and sentences
     """
 
-    def __init__(self, document_path, level):
+    def __init__(self, document_path, level, unprocessed_text=None):
         """
         Initializes a document
+        unprocessed_text is the already loaded list of lines of the file, if any
         """
         self.document_path = document_path
         self.document_id = None
         self.unprocessed_text = None
         self.processed_text = []
         self.level = level
+        self.paragraph_idx = 0  # number of the next paragraph (paragraph and sentence levels)
 
         self.docs = []  # a list of Document objects
-        self.load_document()
+        if unprocessed_text is None:
+            self.load_document()
+        else:
+            self.unprocessed_text = unprocessed_text
+            self.document_id = self.document_path.split("/")[-1]
         self.preprocess_document()
 
     def load_document(self):
@@ -79,23 +116,46 @@ class DocumentProcessor(object):
 
             self.docs = [Document(self.document_id, self.processed_text, self.unprocessed_text)]
 
-        elif self.level == 'paragraph':
-            idx = 0
+        else:
             for paragraph in self.unprocessed_text:
-                document_id = self.document_id + '_pg' + str(idx)
-                 
-                text_by_sentence = [x for x in paragraph.split('.') if x is not []]
-                processed_paragraph = []
-                for sentence in text_by_sentence:
-                    if len(sentence) > 2:
-                        processed_sentence = re.sub("[^a-zA-Z -]+", "", sentence.lower().strip())
-                        processed_sentence = [w for w in processed_sentence.split(" ") if len(w) > 0]
-                        if len(processed_sentence) > 0:
-                            processed_paragraph.append(processed_sentence)
-                # print('Paragraph ' + document_id + ' processed.')
-                if processed_paragraph:
-                     self.docs.append(Document(document_id, processed_paragraph, paragraph))
-                     idx += 1
+                self.preprocess_paragraph(paragraph)
+
+    def preprocess_paragraph(self, paragraph):
+        """
+        Preprocesses one line of the file at paragraph or sentence level, appending its Documents to self.docs
+        Paragraphs are numbered across calls, so a file can be fed one line at a time
+        """
+        if self.level == 'paragraph':
+            document_id = self.document_id + '_pg' + str(self.paragraph_idx)
+
+            text_by_sentence = [x for x in paragraph.split('.') if x is not []]
+            processed_paragraph = []
+            for sentence in text_by_sentence:
+                if len(sentence) > 2:
+                    processed_sentence = re.sub("[^a-zA-Z -]+", "", sentence.lower().strip())
+                    processed_sentence = [w for w in processed_sentence.split(" ") if len(w) > 0]
+                    if len(processed_sentence) > 0:
+                        processed_paragraph.append(processed_sentence)
+            # print('Paragraph ' + document_id + ' processed.')
+            if processed_paragraph:
+                 self.docs.append(Document(document_id, processed_paragraph, paragraph, self.document_id))
+                 self.paragraph_idx += 1
+
+        elif self.level == 'sentence':
+            # paragraphs are numbered as at paragraph level, sentences within their paragraph
+            paragraph_id = self.document_id + '_pg' + str(self.paragraph_idx)
+            sentences = []
+            for sentence in paragraph.split('.'):
+                if len(sentence) > 2:
+                    processed_sentence = re.sub("[^a-zA-Z -]+", "", sentence.lower().strip())
+                    processed_sentence = [w for w in processed_sentence.split(" ") if len(w) > 0]
+                    if len(processed_sentence) > 0:
+                        sentences.append((sentence.strip(), processed_sentence))
+            for s_idx, (sentence, processed_sentence) in enumerate(sentences):
+                self.docs.append(Document(paragraph_id + '_s' + str(s_idx), [processed_sentence], sentence,
+                                          self.document_id, paragraph_id))
+            if sentences:
+                self.paragraph_idx += 1
 
     def get_docs(self):
         return self.docs
@@ -113,74 +173,199 @@ class InvertedIndex(object):
         self.index = {}
         self.number_of_documents = 0
         self.average_document_length = 0
+        # document_id -> document length, used for the BM25 length norms
+        self.document_lengths = {}
+        # bumped on every change so that cached scoring values can be invalidated
+        self.generation = 0
+        # forward index: document_id -> list of distinct words in the document
+        self.document_terms = {}
+        # article_id -> document_ids (the article itself, or its paragraphs), a dict used as an ordered set
+        self.article_documents = {}
+        # word -> (highest tf, shortest document length) over its postings, the MaxScore upper bounds
+        # of BM25Scorer; kept up to date on every add and remove so no query has to walk the postings
+        self.term_bounds = {}
 
     def add_document(self, document):
         """
         Adds Document to inverted index
         """
+        terms = []
         for sentence in document.processed_text:
             for word in sentence:
-                if word in self.index.keys():
-                    if document.document_id in self.index[word].keys():
+                if word in self.index:
+                    if document.document_id in self.index[word]:
                         self.index[word][document.document_id] += 1
                     else:
                         self.index[word][document.document_id] = 1
+                        terms.append(word)
                 else:
                     self.index[word] = {}
                     self.index[word][document.document_id] = 1
+                    terms.append(word)
+        self.document_terms[document.document_id] = terms
+        for word in terms:
+            tf = self.index[word][document.document_id]
+            bound = self.term_bounds.get(word)
+            if bound is None:
+                self.term_bounds[word] = (tf, document.document_length)
+            elif tf > bound[0] or document.document_length < bound[1]:
+                self.term_bounds[word] = (max(tf, bound[0]), min(document.document_length, bound[1]))
+        self.article_documents.setdefault(document.article_id, {})[document.document_id] = None
         new_total_length = (self.number_of_documents * self.average_document_length) + document.document_length
         self.number_of_documents += 1
         self.average_document_length = new_total_length / self.number_of_documents
+        self.document_lengths[document.document_id] = document.document_length
+        self.generation += 1
         #print('Document ' + document.document_id + ' added to inverted index.')
         #print('Current read document count: ' + str(self.number_of_documents))
 
+    def merge(self, other):
+        """
+        Adds all documents of another InvertedIndex (built over different documents) to this one
+        """
+        for word, postings in other.index.items():
+            if word in self.index:
+                self.index[word].update(postings)
+            else:
+                self.index[word] = dict(postings)
+        total_length = (self.number_of_documents * self.average_document_length) + \
+                       (other.number_of_documents * other.average_document_length)
+        self.number_of_documents += other.number_of_documents
+        if self.number_of_documents:
+            self.average_document_length = total_length / self.number_of_documents
+        self.document_lengths.update(other.document_lengths)
+        self.document_terms.update(other.document_terms)
+        for word, (max_tf, min_length) in other.term_bounds.items():
+            bound = self.term_bounds.get(word)
+            self.term_bounds[word] = (max_tf, min_length) if bound is None else \
+                (max(max_tf, bound[0]), min(min_length, bound[1]))
+        for article_id, document_ids in other.article_documents.items():
+            self.article_documents.setdefault(article_id, {}).update(document_ids)
+        self.generation += 1
+
     def remove_document(self, document):
         """
         Removes Document from inverted index given document id
+        Only the posting lists of the document's own words are touched
         """
-        for word in self.index.keys():
-            if document.document_id in self.index[word].keys():
-                del self.index[word][document.document_id]
+        document_length = self.document_lengths.get(document.document_id)
+        for word in self.document_terms.pop(document.document_id, []):
+            postings = self.index[word]
+            tf = postings.pop(document.document_id)
+            if not postings:
+                del self.index[word]
+                del self.term_bounds[word]
+            elif tf == self.term_bounds[word][0] or document_length == self.term_bounds[word][1]:
+                # the removed posting may have set a bound, which is then tightened again
+                self.term_bounds[word] = self.posting_bounds(postings)
+        article = self.article_documents.get(document.article_id)
+        if article is not None:
+            article.pop(document.document_id, None)
+            if not article:
+                del self.article_documents[document.article_id]
 
         new_total_length = (self.number_of_documents * self.average_document_length) - document.document_length
         self.number_of_documents -= 1
-        self.average_document_length = new_total_length / self.number_of_documents
+        # the last document gone, back to the empty index of __init__
+        self.average_document_length = new_total_length / self.number_of_documents if self.number_of_documents else 0
+        self.document_lengths.pop(document.document_id, None)
+        self.generation += 1
         print('Document ' + document.document_id + ' removed from inverted index.')
         print('Current read document count: ' + str(self.number_of_documents))
 
+    def posting_bounds(self, postings):
+        """
+        (highest tf, shortest document length) over a posting list, see term_bounds
+        """
+        return max(postings.values()), min(self.document_lengths[doc_id] for doc_id in postings)
+
 
 class ReadingAssistant(object):
     """
     An assistant that finds differences between what a user has and has not read
     """
 
-    def __init__(self, read_documents_path, level):
+    def __init__(self, read_documents_path, level, token_cache=None):
         """
         Initialize the ReadingAssistant
 
         Depending on the 'level' parameter, a document could either be the whole wikipeida article,
         a paragraph of the wikipeida article, or a sentence in the wikipeida article 
+        (sentence ids are the paragraph id + '_s' + index, e.g. covid-update-4.txt_pg37_s2)
+
+        token_cache is an optional TokenCache, so files that were split before are not tokenized again
         """
         self.read_documents_path = read_documents_path
-        # list of read documents / paragraphs / sentences
-        self.read_document_list = []
+        self.token_cache = token_cache
+        # read documents / paragraphs / sentences by document_id, in the order they were added
+        self.read_documents = {}
         # the inverted index is built based on analysis 'level'. i.e. document level, paragraph level, etc
         self.inv_idx = InvertedIndex()
         # the level at which the reading assistant does its analysis, choose from document|paragraph|sentence
         self.level = level
+        # term-at-a-time BM25 scorer with cached idf values and length norms
+        self.scorer = BM25Scorer(self.inv_idx)
+        # sparse weight matrix for scoring many queries with one product
+        self.matrix = BM25Matrix(self.inv_idx)
+        # read documents as a list, and the index generation it was made at
+        self.document_sequence = ([], None)
+        # file name -> (mtime, size, sha1) of every read file, to detect changes between runs
+        self.file_signatures = {}
+        # raw texts of the read documents, materialized only for the matches a report shows
+        self.text_store = TextStore(self.raw_text)
+        # rankings entries of the units ranked at the current index generation, by content
+        self.ranking_cache = RankingCache()
+        # MinHashIndex of the read documents' raw texts, built on first use, then kept up to date
+        self.near_duplicates = None
+        self.near_duplicates_lock = threading.Lock()
+
+    def raw_text(self, document_id):
+        """
+        Raw text of a read document / paragraph / sentence
+        """
+        return document_text(self.read_documents[document_id])
 
     def add_document(self, document_path):
         """
         Adds document to read collection, assumes path is to text file
         """
         # split article into documents based on level
-        docs = DocumentProcessor(document_path, level=self.level).get_docs()
+        self.index_documents(split_document(document_path, self.level, self.token_cache), document_path)
 
+    def index_documents(self, docs, document_path):
+        """
+        Adds the Documents of the file at document_path, already split (see split_document), to the read collection
+        """
         for doc in docs:
             # doc.load_document()
             # doc.preprocess_document()
             self.inv_idx.add_document(doc)
-            self.read_document_list.append(doc)
+            self.read_documents[doc.document_id] = doc
+            if self.near_duplicates is not None:
+                self.near_duplicates.add(doc.document_id, document_text(doc))
+        self.file_signatures[document_path.split("/")[-1]] = file_signature(document_path)
+
+    def merge_partial(self, docs, inv_idx, file_signatures):
+        """
+        Adds documents that were already indexed into a partial InvertedIndex (see index_read_files)
+        """
+        self.inv_idx.merge(inv_idx)
+        for doc in docs:
+            self.read_documents[doc.document_id] = doc
+            if self.near_duplicates is not None:
+                self.near_duplicates.add(doc.document_id, document_text(doc))
+        self.file_signatures.update(file_signatures)
+
+    @property
+    def read_document_list(self):
+        """
+        List of read documents / paragraphs / sentences
+        """
+        docs, generation = self.document_sequence
+        if generation != self.inv_idx.generation:
+            docs = list(self.read_documents.values())
+            self.document_sequence = (docs, self.inv_idx.generation)
+        return docs
 
     def remove_document(self, document_path):
         """
@@ -188,54 +373,301 @@ class ReadingAssistant(object):
         """
         doc_id = document_path.split("/")[-1]
 
-        removed_index = []
-        for i, doc in enumerate(self.read_document_list):
-            if doc.document_id == doc_id or "{}_pg".format(doc_id) in doc.document_id:
-                self.inv_idx.remove_document(doc)
-                removed_index.append(i)
-        if removed_index:
-            for r in sorted(removed_index, reverse=True): # so that indexes of the rest do not change after deleting the first one
-                del self.read_document_list[r]
+        # copy, the index updates the article's id list while removing
+        for document_id in list(self.inv_idx.article_documents.get(doc_id, {})):
+            self.inv_idx.remove_document(self.read_documents.pop(document_id))
+            if self.near_duplicates is not None:
+                self.near_duplicates.remove(document_id)
+        self.file_signatures.pop(doc_id, None)
+        self.text_store.clear()
 
-    def load_documents(self):
+    def load_documents(self, snapshot_path=None):
         """
         Loads all read documents 
         Assumes document path is path to directory containing text files
+
+        If snapshot_path is given the index is restored from that snapshot (when it matches
+        this level and read path), only the files added, changed or deleted since then are
+        re-indexed, and the snapshot is updated
         """
+        if snapshot_path is not None and self.load_snapshot(snapshot_path):
+            self.sync_documents(snapshot_path)
+            return
         for doc_path in os.listdir(self.read_documents_path):
             self.add_document(self.read_documents_path + doc_path)
+        if snapshot_path is not None:
+            self.save_snapshot(snapshot_path)
+
+    def sync_documents(self, snapshot_path=None):
+        """
+        Re-indexes the read files added, changed or deleted since the last snapshot was written
+        and rewrites the snapshot if anything changed, a refreshed file signature included (a
+        touched or checked out file would otherwise be hashed again at every start)
+        """
+        added, changed, deleted, refreshed = changed_files(self.read_documents_path, self.file_signatures)
+        for doc_path in deleted:
+            self.remove_document(self.read_documents_path + doc_path)
+        for doc_path in changed:
+            # the new version has the ids of the old one, so it is split first and indexed once the old one is out
+            docs = split_document(self.read_documents_path + doc_path, self.level, self.token_cache)
+            self.remove_document(self.read_documents_path + doc_path)
+            self.index_documents(docs, self.read_documents_path + doc_path)
+        for doc_path in added:
+            self.add_document(self.read_documents_path + doc_path)
+        if snapshot_path is not None and (added or changed or deleted or refreshed):
+            self.save_snapshot(snapshot_path)
 
-    def score_document(self, document_path, k1=1.2, b=0.75):
+    def save_snapshot(self, snapshot_path):
+        """
+        Writes the inverted index, document lengths and read documents to disk
+        """
+        header = {'level': self.level,
+                  'read_documents_path': os.path.abspath(self.read_documents_path),
+                  'file_signatures': self.file_signatures}
+        state = {'index': self.inv_idx.index,
+                 'number_of_documents': self.inv_idx.number_of_documents,
+                 'average_document_length': self.inv_idx.average_document_length,
+                 'document_lengths': self.inv_idx.document_lengths,
+                 'document_terms': self.inv_idx.document_terms,
+                 'article_documents': self.inv_idx.article_documents,
+                 'term_bounds': self.inv_idx.term_bounds,
+                 'documents': [(doc.document_id, doc.article_id, doc.paragraph_id, doc.processed_text,
+                                doc.unprocessed_text) for doc in self.read_documents.values()]}
+        write_snapshot(snapshot_path, header, state)
+
+    def load_snapshot(self, snapshot_path):
+        """
+        Restores the read collection from a snapshot written by save_snapshot
+        Returns False (and changes nothing) if there is no usable snapshot for this level and read path
+        """
+        snapshot = read_snapshot(snapshot_path)
+        if snapshot is None:
+            return False
+        header, state = snapshot
+        if header.get('level') != self.level or \
+                header.get('read_documents_path') != os.path.abspath(self.read_documents_path):
+            return False
+        self.inv_idx.index = state['index']
+        self.inv_idx.number_of_documents = state['number_of_documents']
+        self.inv_idx.average_document_length = state['average_document_length']
+        self.inv_idx.document_lengths = state['document_lengths']
+        self.inv_idx.document_terms = state['document_terms']
+        self.inv_idx.article_documents = state['article_documents']
+        self.inv_idx.term_bounds = state['term_bounds']
+        self.inv_idx.generation += 1
+        self.read_documents = {}
+        for document_id, article_id, paragraph_id, processed_text, unprocessed_text in state['documents']:
+            self.read_documents[document_id] = Document(document_id, processed_text, unprocessed_text, article_id,
+                                                        paragraph_id)
+        self.file_signatures = header['file_signatures']
+        self.text_store.clear()
+        self.near_duplicates = None
+        return True
+
+    def collection_hash(self):
+        """
+        sha1 of the names and content hashes of the read files: it changes with every read / forget,
+        and is the same for the same read files in another session
+        """
+        digest = hashlib.sha1()
+        for fname, signature in sorted(self.file_signatures.items()):
+            digest.update("{}\0{}\n".format(fname, signature[2]).encode('utf8'))
+        return digest.hexdigest()
+
+    def near_duplicate_index(self):
+        """
+        MinHashIndex of the raw texts of the read documents, built on first use
+        """
+        with self.near_duplicates_lock:
+            if self.near_duplicates is None:
+                index = MinHashIndex()
+                for document_id, doc in self.read_documents.items():
+                    index.add(document_id, document_text(doc))
+                self.near_duplicates = index
+            return self.near_duplicates
+
+    def duplicate_entry(self, raw_txt, processed_txt=None):
+        """
+        Rankings entry of a new unit that is a near duplicate of read units (None if it is not)
+        Its ranking lists those units with their estimated Jaccard similarity, and its 'moments'
+        are (0, 0) so that all of them match whatever the scope. It is marked 'already_read'
+        """
+        ranking = self.near_duplicate_index().query(raw_txt)
+        if not ranking:
+            return None
+        instruments.count('near duplicates skipped')
+        return {'raw_txt': raw_txt, 'processed_txt': processed_txt, 'ranking': ranking, 'moments': (0.0, 0.0),
+                'texts': self.text_store, 'already_read': True}
+
+    def score_document(self, document_path, k1=1.2, b=0.75, engine='taat', top_k=None, threshold=None,
+                       batch_size=256, skip_duplicates=False):
         """
         Scores new document against collection of already-read documents
         Returns list of most-similar and most different documents?
+
+        engine 'taat' walks only the posting lists of the query words, 'matrix' scores the
+        paragraphs of the new document batch_size at a time with one sparse matrix product,
+        'naive' scores every read document word by word (slow, kept for reference).
+
+        engine 'maxscore' only returns the top_k documents (and/or those scoring above
+        threshold), skipping most candidates. Its rankings carry a 'moments' entry with
+        the mean and standard deviation of all scores, since the ranking list is partial.
+        With top_k, the 'matrix' engine also keeps only the top_k documents
+        (and the 'moments' of all scores), which avoids building a tuple per read document.
+
+        Rankings are lists of (doc_id, score); each entry's 'texts' is the TextStore the raw
+        texts of the read documents are fetched from.
+
+        With skip_duplicates, units that are near duplicates of read units are not scored,
+        their entries are those of duplicate_entry.
         """
-        # new_document = Document(document_path)
-        # new_document.load_document()
-        # new_document.preprocess_document()
-        new_docs = DocumentProcessor(document_path, level=self.level).get_docs()
-
-        rankings = {}
-        for new_document in new_docs:
-            ranking = []
-            for doc in self.read_document_list:
-                doc_score = 0
-                for sentence in new_document.processed_text:
-                    for word in sentence:
-                        tf = self.TF_score_helper(word, doc.document_id)
-                        idf = self.IDF_score_helper(word)
-                        numerator = tf * (k1 + 1)
-                        denominator = tf + (
-                                    k1 * (1 - b + (b * (doc.document_length / self.inv_idx.average_document_length))))
-                        doc_score += idf * (numerator / denominator)
-                raw_txt = "\n".join(doc.unprocessed_text) if isinstance(doc.unprocessed_text, list) else doc.unprocessed_text
-                ranking.append((doc.document_id, doc_score, raw_txt))
-            rankings[new_document.document_id] = {}
-            raw_txt = "\n".join(new_document.unprocessed_text) if isinstance(doc.unprocessed_text, list) else new_document.unprocessed_text
-            rankings[new_document.document_id]['raw_txt'] = raw_txt
-            rankings[new_document.document_id]['processed_txt'] = new_document.processed_text
-            rankings[new_document.document_id]['ranking'] = sorted(ranking, key=lambda x: x[1], reverse=True)
-        return rankings
+        with instruments.stage('tokenize'):
+            new_docs = split_document(document_path, self.level, self.token_cache)
+        return dict(self.iter_rankings(new_docs, k1, b, engine, top_k, threshold, batch_size, skip_duplicates))
+
+    def score_document_stream(self, document_path, k1=1.2, b=0.75, top_k=25, batch_size=256, skip_duplicates=False):
+        """
+        Streaming version of score_document for very large unread files
+        The file is read lazily (paragraph and sentence levels) and scored batch_size units at a
+        time with the 'matrix' engine, keeping only the top_k matches per unit. Yields
+        (document_id, rankings entry) pairs as they are scored, so at most one batch is in memory.
+        Its rankings are not added to the ranking cache.
+        """
+        return self.iter_rankings(iter_documents(document_path, self.level), k1, b, 'matrix', top_k, None, batch_size,
+                                  skip_duplicates, cache=False)
+
+    def iter_rankings(self, new_docs, k1=1.2, b=0.75, engine='taat', top_k=None, threshold=None, batch_size=256,
+                      skip_duplicates=False, cache=True):
+        """
+        Scores an iterable of new Documents, batch_size at a time, see score_document
+        Yields (document_id, rankings entry) pairs in the order of new_docs
+        cache is as in rank_batch
+        """
+        new_docs = iter(new_docs)
+        while True:
+            batch = list(islice(new_docs, batch_size))
+            if not batch:
+                return
+            with instruments.stage('bm25 score'):
+                entries = self.rank_batch(batch, k1, b, engine, top_k, threshold, skip_duplicates, cache)
+            for new_document, entry in zip(batch, entries):
+                yield new_document.document_id, entry
+
+    def rank_batch(self, batch, k1=1.2, b=0.75, engine='taat', top_k=None, threshold=None, skip_duplicates=False,
+                   cache=True):
+        """
+        Rankings entries of a list of new Documents, in order, see score_document
+        Units ranked before with the same settings and index generation come from the ranking cache
+        (see RankingCache), only the others are scored; with cache=False (a one-off stream) they
+        are not added to it
+        """
+        generation = self.inv_idx.generation
+        entries = [None] * len(batch)
+        if skip_duplicates:
+            entries = [self.duplicate_entry(document_text(doc), doc.processed_text) for doc in batch]
+        keys = [content_key(document_text(doc), engine, k1, b, top_k, threshold) for doc in batch]
+        for i, key in enumerate(keys):
+            if entries[i] is None:
+                entries[i] = self.ranking_cache.get(key, generation)
+                if entries[i] is not None:
+                    entries[i].update(raw_txt=document_text(batch[i]), processed_txt=batch[i].processed_text,
+                                      texts=self.text_store)
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        instruments.count('ranking cache hits', len(batch) - len(missing))
+        if missing:
+            for i, entry in zip(missing, self.score_batch([batch[i] for i in missing], k1, b, engine, top_k, threshold)):
+                entries[i] = entry
+                if cache:
+                    self.ranking_cache.put(keys[i], entry, generation)
+        return entries
+
+    def score_batch(self, batch, k1=1.2, b=0.75, engine='taat', top_k=None, threshold=None):
+        """
+        Scores a list of new Documents, returns their rankings entries in order
+        """
+        if instruments.enabled:
+            instruments.count('units ranked', len(batch))
+            instruments.count('tokens processed', sum(len(sentence) for doc in batch for sentence in doc.processed_text))
+            if engine != 'maxscore':
+                instruments.count('documents scored', len(batch) * len(self.read_documents))
+        if engine == 'matrix':
+            batch_scores = self.score_matrix(batch, k1, b)
+        entries = []
+        for i, new_document in enumerate(batch):
+            entry = {}
+            if engine == 'matrix':
+                scores = batch_scores[i]
+                ranking = self.ranking_from_scores(scores, top_k)
+                if top_k is not None:
+                    entry['moments'] = (float(numpy.mean(scores)), float(numpy.std(scores)))
+            elif engine == 'taat':
+                ranking = self.score_taat(new_document, k1, b)
+            elif engine == 'naive':
+                ranking = self.score_naive(new_document, k1, b)
+            elif engine == 'maxscore':
+                ranking, moments = self.score_maxscore(new_document, top_k, threshold, k1, b)
+                entry['moments'] = (moments.mean, moments.sd)
+            else:
+                raise ValueError("unknown scoring engine: {}".format(engine))
+            entry['raw_txt'] = document_text(new_document)
+            entry['processed_txt'] = new_document.processed_text
+            entry['ranking'] = sorted(ranking, key=lambda x: x[1], reverse=True)
+            entry['texts'] = self.text_store
+            entries.append(entry)
+        return entries
+
+    def score_maxscore(self, new_document, top_k=None, threshold=None, k1=1.2, b=0.75):
+        """
+        Pruned BM25: returns a list of (doc_id, score) for the best documents only,
+        and the StreamingMoments of all scores
+        """
+        if top_k is None and threshold is None:
+            top_k = 10
+        return self.scorer.top_k(new_document.processed_text, top_k, threshold, k1, b)
+
+    def score_taat(self, new_document, k1=1.2, b=0.75):
+        """
+        Term-at-a-time BM25: returns an unsorted list of (doc_id, score) for every read document
+        """
+        scores = self.scorer.score(new_document.processed_text, k1, b)
+        return [(doc_id, scores.get(doc_id, 0.0)) for doc_id in self.read_documents]
+
+    def score_matrix(self, new_docs, k1=1.2, b=0.75):
+        """
+        Scores a batch of new documents at once, returns a (new documents x read documents) array
+        """
+        self.matrix.build(self.read_documents.keys(), k1, b)
+        return self.matrix.score([new_document.processed_text for new_document in new_docs])
+
+    def ranking_from_scores(self, scores, top_k=None):
+        """
+        Turns a row of scores (in read_document_list order) into an unsorted list of (doc_id, score)
+        With top_k, only the top_k best scoring documents are listed
+        """
+        docs = self.read_document_list
+        if top_k is not None and top_k < len(docs):
+            positions = top_positions(scores, top_k)
+        else:
+            positions = range(len(docs))
+        return [(docs[position].document_id, float(scores[position])) for position in positions]
+
+    def score_naive(self, new_document, k1=1.2, b=0.75):
+        """
+        Document-at-a-time BM25: returns an unsorted list of (doc_id, score) for every read document
+        """
+        ranking = []
+        for doc in self.read_documents.values():
+            doc_score = 0
+            for sentence in new_document.processed_text:
+                for word in sentence:
+                    tf = self.TF_score_helper(word, doc.document_id)
+                    idf = self.IDF_score_helper(word)
+                    numerator = tf * (k1 + 1)
+                    denominator = tf + (
+                                k1 * (1 - b + (b * (doc.document_length / self.inv_idx.average_document_length))))
+                    doc_score += idf * (numerator / denominator)
+            ranking.append((doc.document_id, doc_score))
+        return ranking
 
     def TF_score_helper(self, keyword, doc_id):
         """
@@ -259,48 +691,489 @@ class ReadingAssistant(object):
         denominator = docs_containing_keyword + 0.5
         return max(0, math.log((numerator / denominator) + 1))
 
+def split_document(document_path, level, token_cache=None):
+    """
+    Documents of a text file at the given level, through token_cache (a TokenCache) when there is one
+    """
+    if token_cache is None:
+        return DocumentProcessor(document_path, level=level).get_docs()
+    return parse_read_file(document_path, [level], token_cache)[level]
+
+def iter_documents(document_path, level):
+    """
+    Yields the Documents of a text file one at a time
+    At paragraph and sentence level the file is read line by line, so only the current
+    paragraph is in memory; a document-level unit needs the whole file anyway.
+    """
+    if level == 'document':
+        for doc in DocumentProcessor(document_path, level=level).get_docs():
+            yield doc
+        return
+    processor = DocumentProcessor(document_path, level, unprocessed_text=[])
+    with open(document_path, 'r', encoding="utf8", errors='ignore') as f:
+        for line in f:
+            processor.preprocess_paragraph(line.rstrip('\n'))
+            for doc in processor.docs:
+                yield doc
+            processor.docs = []
+
+def document_rows(document_path, level, cached_file):
+    """
+    The Documents of a file at one level as tuples of their constructor arguments, the plain
+    data a TokenCache keeps (see CachedFile.get)
+    """
+    docs = DocumentProcessor(document_path, level, cached_file.text("utf8", errors='ignore').split('\n')).get_docs()
+    return [(doc.document_id, doc.processed_text, doc.unprocessed_text, doc.article_id, doc.paragraph_id)
+            for doc in docs]
+
+def parse_read_file(document_path, levels, token_cache=None):
+    """
+    Reads a text file once and splits it into Documents for every level
+    Returns {level: list of Document}
+    """
+    if token_cache is not None:
+        cached = token_cache.open(document_path)
+        return dict((level, [Document(*row) for row in cached.get(('bm25', level), lambda f: document_rows(
+            document_path, level, f))]) for level in levels)
+    with open(document_path, 'r', encoding="utf8", errors='ignore') as f:
+        unprocessed_text = f.read().split('\n')
+    return dict((level, DocumentProcessor(document_path, level, unprocessed_text).get_docs()) for level in levels)
+
+def index_read_files(document_paths, levels, token_cache=None):
+    """
+    Parses and indexes a batch of read files, run in a worker process
+    Returns {level: (list of Document, partial InvertedIndex)} and {file name: signature}
+    """
+    partial = dict((level, ([], InvertedIndex())) for level in levels)
+    file_signatures = {}
+    for document_path in document_paths:
+        for level, docs in parse_read_file(document_path, levels, token_cache).items():
+            for doc in docs:
+                partial[level][1].add_document(doc)
+            partial[level][0].extend(docs)
+        file_signatures[document_path.split("/")[-1]] = file_signature(document_path)
+    return partial, file_signatures
+
+def load_reading_assistants(read_documents_path, levels=("document", "paragraph"), workers=None, snapshot_dir=None,
+                            token_cache=None):
+    """
+    Builds one ReadingAssistant per level over the read folder
+    Levels with a usable snapshot in snapshot_dir are restored from it. The other levels are
+    built together: each file is read and tokenized once, in a pool of worker processes
+    that each index a contiguous slice of the files; the partial indexes are merged in
+    file order, so the result is the same as calling load_documents on each assistant.
+    Workers share only the disk tier of token_cache. They are started by a forkserver, not
+    forked, since this runs next to other threads (LSI retrains, the server's executor) whose
+    locks a forked child could inherit held. On one CPU, or for a read folder under
+    PARALLEL_LOAD_MIN_BYTES, the files are indexed here instead.
+    """
+    assistants = dict((level, ReadingAssistant(read_documents_path, level, token_cache)) for level in levels)
+    cold_levels = []
+    for level in levels:
+        if snapshot_dir is not None and assistants[level].load_snapshot(snapshot_path(snapshot_dir, level)):
+            assistants[level].sync_documents(snapshot_path(snapshot_dir, level))
+        else:
+            cold_levels.append(level)
+    if not cold_levels:
+        return [assistants[level] for level in levels]
+
+    document_paths = [read_documents_path + doc_path for doc_path in os.listdir(read_documents_path)]
+    workers = min(workers or os.cpu_count() or 1, max(len(document_paths), 1))
+    if (os.cpu_count() or 1) == 1 or sum(os.path.getsize(path) for path in document_paths) < PARALLEL_LOAD_MIN_BYTES:
+        workers = 1
+    chunk_size = -(-len(document_paths) // workers) if document_paths else 1
+    chunks = [document_paths[i:i + chunk_size] for i in range(0, len(document_paths), chunk_size)]
+    if workers > 1:
+        context = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            results = list(executor.map(index_read_files, chunks, [cold_levels] * len(chunks),
+                                        [token_cache] * len(chunks)))
+    else:
+        results = [index_read_files(chunk, cold_levels, token_cache) for chunk in chunks]
+
+    for partial, file_signatures in results:
+        for level in cold_levels:
+            docs, inv_idx = partial[level]
+            assistants[level].merge_partial(docs, inv_idx, file_signatures)
+    if snapshot_dir is not None:
+        for level in cold_levels:
+            assistants[level].save_snapshot(snapshot_path(snapshot_dir, level))
+    return [assistants[level] for level in levels]
+
+def ranking_moments(ranking_entry):
+    """
+    Mean and standard deviation of the scores of one rankings entry
+    """
+    if 'moments' in ranking_entry:
+        return ranking_entry['moments']
+    scores = [x[1] for x in ranking_entry['ranking']]
+    return numpy.mean(scores), numpy.std(scores)
+
+def ranking_matches(entry, scope):
+    """
+    The (id, score) pairs of one rankings entry scoring more than scope standard deviations above the mean
+    """
+    mean, sd = ranking_moments(entry)
+    return [x for x in entry['ranking'] if x[1] > mean + (scope * sd)]
+
 def print_rankings(method, level, rankings, scope):
     """
     Prints a rankings dict to the console
     """
     for i in rankings.keys():
-        print("---------------------\n")
-        print(method, level, "ranking of", str(i))
-        mean = numpy.mean([x[1] for x in rankings[i]['ranking']])
-        sd = numpy.std([x[1] for x in rankings[i]['ranking']])
-        for x in rankings[i]['ranking']:
-            if x[1] > (mean + (scope * sd)):
-                print('   {:<23}{:50}'.format(x[1], x[0]))
+        print_ranking_entry(method, level, i, rankings[i], scope)
+
+def print_ranking_entry(method, level, document_id, entry, scope):
+    """
+    Prints the ranking of one unread unit to the console
+    """
+    print("---------------------\n")
+    print(method, level, "ranking of", str(document_id) + (" (already read)" if entry.get('already_read') else ""))
+    for x in ranking_matches(entry, scope):
+        print('   {:<23}{:50}'.format(x[1], x[0]))
 
 def write_html_rankings(rankings, scope, html):
     """
     Writes the rankings info to an HMTL file for easier perusal
     """
     for i in rankings.keys():
-        mean = numpy.mean([x[1] for x in rankings[i]['ranking']])
-        sd = numpy.std([x[1] for x in rankings[i]['ranking']])
-        html.add_title(str(i))
-        if isinstance(rankings[i]['raw_txt'], list):
-            html.add_text("<br><br>".join(str(v) for v in rankings[i]['raw_txt']))
+        write_html_ranking_entry(i, rankings[i], scope, html)
+
+def write_html_ranking_entry(document_id, entry, scope, html):
+    """
+    Writes the ranking of one unread unit to an HTML file
+    The raw text of a match is fetched from the entry's text store only if it passes the scope threshold
+    """
+    html.add_title(str(document_id) + (" (already read)" if entry.get('already_read') else ""))
+    if isinstance(entry['raw_txt'], list):
+        html.add_lines(entry['raw_txt'])
+    else:
+        html.add_text(entry['raw_txt'])
+    for x in ranking_matches(entry, scope):
+        html.add_match(match_name=x[0], match_score=x[1], match_text=entry['texts'].get(x[0], ''))
+
+def stream_rankings(method, level, entries, scope, html):
+    """
+    Prints and writes to html each (document_id, rankings entry) pair as it arrives,
+    without keeping the rankings. Returns the number of entries
+    """
+    count = 0
+    for document_id, entry in entries:
+        print_ranking_entry(method, level, document_id, entry, scope)
+        write_html_ranking_entry(document_id, entry, scope, html)
+        count += 1
+    return count
+
+def write_report(outfile, name, sections, scope, report_options=None):
+    """
+    Writes an html report, sections is a list of (heading, rankings)
+    report_options are passed on to HTML_Generator (page_size, lazy_text)
+    """
+    with instruments.stage('html report'), \
+            HTML_Generator(outfile=outfile, name=name, **(report_options or {})) as html:
+        for heading, rankings in sections:
+            html.add_divide(heading)
+            write_html_rankings(rankings, scope, html)
+
+class RankJob(object):
+    """
+    The stages (analyses and report writes) of one rank command, run in a thread pool
+
+    Each stage may wait for the results of earlier stages, so a report is written as soon
+    as its own analyses are done. Stages are started in submission order, so a stage only
+    ever waits for stages that are already running, whatever the number of workers. Threads
+    rather than processes: the indexes and models live in this process, and the heavy
+    parts (sparse products, gensim similarity queries) run in numpy/scipy with the GIL released.
+    """
+
+    def __init__(self, workers=6):
+        """
+        Initializes the job and its thread pool
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cancelled = threading.Event()
+        self.stages = OrderedDict()  # stage name -> future
+        self.timings = OrderedDict()  # stage name -> seconds, for the stages that ran
+
+    def stage(self, name, function, *args, after=()):
+        """
+        Schedules function(*args, *results of the stages named in after), returns its future
+        """
+        dependencies = [self.stages[dependency] for dependency in after]
+
+        def run():
+            inputs = [dependency.result() for dependency in dependencies]
+            if self.cancelled.is_set():
+                raise CancelledError(name)
+            start = time.perf_counter()
+            with instruments.stage('job: ' + name):
+                result = function(*(args + tuple(inputs)))
+            self.timings[name] = time.perf_counter() - start
+            return result
+
+        self.stages[name] = self.executor.submit(run)
+        return self.stages[name]
+
+    def result(self, name):
+        return self.stages[name].result()
+
+    def wait(self):
+        """
+        Waits for every stage; if one fails (or the wait is interrupted) the stages that have
+        not started are cancelled, the running ones are waited for, and the error is raised
+        """
+        try:
+            for future in self.stages.values():
+                future.result()
+        except BaseException:
+            self.cancel()
+            # no stage may outlive the command, and overlap a later read / forget of the same indexes
+            self.executor.shutdown(wait=True)
+            raise
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def cancel(self):
+        """
+        Cancels the stages that have not started; running ones finish but their results are dropped
+        """
+        self.cancelled.set()
+        for future in self.stages.values():
+            future.cancel()
+
+    def timing_report(self):
+        return ", ".join("{} {:.2f}s".format(name, seconds) for name, seconds in self.timings.items())
+
+def cached_rankings(results, key, texts, function, *args):
+    """
+    function(*args), the rankings of a whole file, taken from (or else added to) the ResultCache results
+    under key; texts(entry) is the text store of an entry read from disk. results or key None just calls function
+    """
+    if results is None or key is None:
+        return function(*args)
+    rankings = results.get(key, texts)
+    if rankings is not None:
+        instruments.count('result cache hits')
+        return rankings
+    rankings = function(*args)
+    results.put(key, rankings)
+    return rankings
+
+def rank_concurrently(target, target_text, doc_assistant, parag_assistant, doc_lsi, parag_lsi, scope, k1=1.2,
+                      b=0.75, report_options=None, workers=6, skip_duplicates=False, results=None):
+    """
+    The rank command: the four analyses and the two html reports as concurrent stages of a RankJob
+    Returns the job, whose 'doc bm25', 'doc lsi', 'parag bm25' and 'parag lsi' stages hold the rankings
+    With skip_duplicates, paragraphs that are near duplicates of read ones are marked already read
+    by both paragraph analyses instead of being scored (see ReadingAssistant.duplicate_entry)
+    results is an optional ResultCache: an analysis already done on a file with the same content,
+    settings and read files (the collection generation, see ReadingAssistant.collection_hash)
+    is taken from it. The LSI analyses of a stale model (see LsiService.settled) are neither
+    taken from nor added to it: they would be cached under the key of the new read files
+    """
+    duplicates = parag_assistant.duplicate_entry if skip_duplicates else None
+    parag_method = " skip duplicates" if skip_duplicates else ""
+    keys = dict.fromkeys(('doc bm25', 'doc lsi', 'parag bm25', 'parag lsi'))
+    if results is not None:
+        target_hash = file_hash(target)
+        generation = doc_assistant.collection_hash()
+        keys = {'doc bm25': (target_hash, 'document', 'bm25', k1, b, generation),
+                'doc lsi': (target_hash, 'document', 'lsi ' + doc_lsi.similarity, k1, b, generation),
+                'parag bm25': (target_hash, 'paragraph', 'bm25' + parag_method, k1, b, generation),
+                'parag lsi': (target_hash, 'paragraph', 'lsi ' + parag_lsi.similarity + parag_method, k1, b, generation)}
+        for name, lsi in (('doc lsi', doc_lsi), ('parag lsi', parag_lsi)):
+            if not lsi.settled():
+                keys[name] = None
+
+    def bm25_texts(assistant):
+        return lambda entry: assistant.text_store
+
+    def lsi_texts(lsi):
+        # near duplicate entries list read paragraphs of the bm25 index; LsiService.texts does not
+        # load (or train) the model, which lsi.current() would on a cache hit
+        return lambda entry: parag_assistant.text_store if entry.get('already_read') else lsi.texts()
+
+    job = RankJob(workers)
+    job.stage('doc bm25', cached_rankings, results, keys['doc bm25'], bm25_texts(doc_assistant),
+              doc_assistant.score_document, target, k1, b)
+    job.stage('doc lsi', cached_rankings, results, keys['doc lsi'], lsi_texts(doc_lsi),
+              doc_lsi.query, target, target_text)
+    job.stage('parag bm25', cached_rankings, results, keys['parag bm25'], bm25_texts(parag_assistant),
+              parag_assistant.score_document, target, k1, b, 'matrix', None, None, 256, skip_duplicates)
+    job.stage('parag lsi', cached_rankings, results, keys['parag lsi'], lsi_texts(parag_lsi),
+              parag_lsi.query, target, target_text, duplicates)
+
+    def bm25_report(doc_rankings, parag_rankings):
+        write_report("output-bm25.html", target,
+                     [("BM25 Document, >= " + str(scope) + " standard deviations", doc_rankings),
+                      ("BM25 Paragraph, >= " + str(scope) + " standard deviations", parag_rankings)],
+                     scope, report_options)
+
+    def lsi_report(doc_rankings, parag_rankings):
+        write_report("output-lsi.html", target,
+                     [("LSI Document, >= " + str(scope) + " standard deviations", doc_rankings),
+                      ("LSI Paragraph, >= " + str(scope) + " standard deviations", parag_rankings)],
+                     scope, report_options)
+
+    job.stage('bm25 report', bm25_report, after=('doc bm25', 'parag bm25'))
+    job.stage('lsi report', lsi_report, after=('doc lsi', 'parag lsi'))
+    job.wait()
+    return job
+
+def stream_rank(target, doc_assistant, parag_assistant, doc_lsi, parag_lsi, scope, k1=1.2, b=0.75, top_k=25,
+                report_options=None, skip_duplicates=False):
+    """
+    The rank command for very large unread files
+    The document-level analyses run as usual (a document is a single unit). The paragraph-level
+    ones read the file lazily, score it in batches keeping the top_k matches per paragraph,
+    and go straight to the console and the html files, one paragraph at a time. Nothing is added
+    to the ranking caches, which a file this large would only flush.
+    skip_duplicates is as in rank_concurrently
+    """
+    report_options = report_options or {}
+    duplicates = parag_assistant.duplicate_entry if skip_duplicates else None
+    with HTML_Generator(outfile="output-bm25.html", name=target, **report_options) as bm25_html, \
+            HTML_Generator(outfile="output-lsi.html", name=target, **report_options) as lsi_html:
+        bm25_html.add_divide("BM25 Document, >= " + str(scope) + " standard deviations")
+        stream_rankings("BM25", "document",
+                        doc_assistant.iter_rankings(iter_documents(target, "document"), k1, b, cache=False),
+                        scope, bm25_html)
+        lsi_html.add_divide("LSI Document, >= " + str(scope) + " standard deviations")
+        stream_rankings("LSI", "document", doc_lsi.iter_query(target, cache=False), scope, lsi_html)
+
+        bm25_html.add_divide("BM25 Paragraph, >= " + str(scope) + " standard deviations")
+        stream_rankings("BM25", "paragraph",
+                        parag_assistant.score_document_stream(target, k1, b, top_k, skip_duplicates=skip_duplicates),
+                        scope, bm25_html)
+        lsi_html.add_divide("LSI Paragraph, >= " + str(scope) + " standard deviations")
+        stream_rankings("LSI", "paragraph", parag_lsi.iter_query(target, top_k, duplicates=duplicates, cache=False),
+                        scope, lsi_html)
+
+def batch_rank(arg_read_path, unread_files, arg_k1=1.2, arg_b=0.75, scope=2, per_file=False, workers=1, top_k=25,
+               out_dir=".", snapshot_dir=".reading_assistant", report_options=None, lsi_similarity='dense',
+               skip_duplicates=False):
+    """
+    Ranks many unread files in one non-interactive run
+    The BM25 indexes and LSI models are built (or restored) once. The BM25 queries of all
+    files, at each level, go through the matrix engine in shared batches; LSI queries and
+    report writes run on a pool of workers threads, one file per task. Each unit keeps its
+    top_k matches. Writes output-batch-bm25.html and output-batch-lsi.html in out_dir, or
+    with per_file one <file>-bm25.html / <file>-lsi.html pair per unread file.
+    skip_duplicates is as in rank_concurrently
+    Returns {stage: seconds} and prints throughput stats
+    """
+    timings = OrderedDict()
+    start = time.perf_counter()
+    token_cache = TokenCache(cache_dir=os.path.join(snapshot_dir, "tokens"))
+    doc_reading_assistant, parag_reading_assistant = load_reading_assistants(
+        arg_read_path, ("document", "paragraph"), workers=workers, snapshot_dir=snapshot_dir, token_cache=token_cache)
+    doc_lsi = LsiService(arg_read_path, level="document", model_dir=snapshot_dir, token_cache=token_cache)
+    parag_lsi = LsiService(arg_read_path, level="paragraph", model_dir=snapshot_dir, token_cache=token_cache,
+                           similarity=lsi_similarity)
+    doc_lsi.current()
+    parag_lsi.current()
+    timings['load'] = time.perf_counter() - start
+
+    # bm25, all units of all files in shared batches: file -> level -> rankings
+    start = time.perf_counter()
+    bm25 = dict((f, {'document': OrderedDict(), 'paragraph': OrderedDict()}) for f in unread_files)
+    units = {'document': 0, 'paragraph': 0}
+    for level, assistant in (("document", doc_reading_assistant), ("paragraph", parag_reading_assistant)):
+        owners = {}
+
+        def new_docs():
+            for f in unread_files:
+                for doc in split_document(f, level, token_cache):
+                    owners[doc.document_id] = f
+                    yield doc
+
+        for document_id, entry in assistant.iter_rankings(new_docs(), arg_k1, arg_b, 'matrix', top_k,
+                                                          skip_duplicates=skip_duplicates and level == "paragraph"):
+            bm25[owners.pop(document_id)][level][document_id] = entry
+            units[level] += 1
+    timings['bm25'] = time.perf_counter() - start
+
+    # lsi, one file per task
+    start = time.perf_counter()
+
+    duplicates = parag_reading_assistant.duplicate_entry if skip_duplicates else None
+
+    def lsi_file(f):
+        text_file = read_text_file(f, token_cache)
+        return dict((service.level, OrderedDict(service.iter_query(
+            f, top_k, text_file, verbose=False, duplicates=duplicates if service is parag_lsi else None)))
+                    for service in (doc_lsi, parag_lsi))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        lsi = dict(zip(unread_files, executor.map(lsi_file, unread_files)))
+    timings['lsi'] = time.perf_counter() - start
+
+    # reports
+    start = time.perf_counter()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    heading = " {} {}, >= " + str(scope) + " standard deviations"
+    reports = []
+    for method, results in (("BM25", bm25), ("LSI", lsi)):
+        sections = dict((f, [(os.path.basename(f) + heading.format(method, level.capitalize()), results[f][level])
+                             for level in ("document", "paragraph")]) for f in unread_files)
+        if per_file:
+            reports.extend((os.path.join(out_dir, "{}-{}.html".format(os.path.basename(f), method.lower())),
+                            f, sections[f]) for f in unread_files)
         else:
-            html.add_text(rankings[i]['raw_txt'])
-        for x in rankings[i]['ranking']:
-            if x[1] > mean + (scope * sd):
-                html.add_match(match_name=x[0], match_score=x[1], match_text=x[2])
+            reports.append((os.path.join(out_dir, "output-batch-{}.html".format(method.lower())),
+                            "{} unread files".format(len(unread_files)),
+                            [section for f in unread_files for section in sections[f]]))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(write_report, [r[0] for r in reports], [r[1] for r in reports], [r[2] for r in reports],
+                          [scope] * len(reports), [report_options] * len(reports)))
+    timings['reports'] = time.perf_counter() - start
+
+    total = sum(timings.values())
+    size = sum(os.path.getsize(f) for f in unread_files)
+    print("Ranked {} files ({} paragraphs, {:.1f} MB) in {:.2f}s with {} workers: {:.1f} files/s, {:.0f} paragraphs/s".format(
+        len(unread_files), units['paragraph'], size / 1e6, total, workers, len(unread_files) / total if total else 0.0,
+        units['paragraph'] / total if total else 0.0))
+    print("Stages: " + ", ".join("{} {:.2f}s".format(stage, seconds) for stage, seconds in timings.items()))
+    print("Reports: " + ", ".join(report[0] for report in reports[:4]) + (" ..." if len(reports) > 4 else ""))
+    return timings
+
+def snapshot_path(snapshot_dir, level):
+    """
+    Where the index snapshot of a level is kept
+    """
+    return os.path.join(snapshot_dir, "index-{}.snapshot".format(level))
+
+def main(arg_read_path, arg_unread_path, arg_k1, arg_b, snapshot_dir=".reading_assistant", profile=None,
+         metrics_log=None, lsi_similarity='dense', skip_duplicates=False):
 
-def main(arg_read_path, arg_unread_path, arg_k1, arg_b):
+    # tokenized files shared by bm25 and lsi, kept on disk between runs
+    token_cache = TokenCache(cache_dir=os.path.join(snapshot_dir, "tokens"))
 
-    # initialize document-level bm25
-    doc_reading_assistant = ReadingAssistant(arg_read_path, level="document")
-    doc_reading_assistant.load_documents()
+    # initialize document-level and paragraph-level bm25 (from the last run's snapshots when there are
+    # some, otherwise parsing every read file once, in parallel)
+    doc_reading_assistant, parag_reading_assistant = load_reading_assistants(
+        arg_read_path, ("document", "paragraph"), snapshot_dir=snapshot_dir, token_cache=token_cache)
 
-    # initialize paragraph-level bm25
-    parag_reading_assistant = ReadingAssistant(arg_read_path, level="paragraph")
-    parag_reading_assistant.load_documents()
+    # lsi models per level, trained on first use and kept up to date by read / forget (the paragraph
+    # level, by far the larger, with the similarity index of choice)
+    doc_lsi = LsiService(arg_read_path, level="document", model_dir=snapshot_dir, token_cache=token_cache)
+    parag_lsi = LsiService(arg_read_path, level="paragraph", model_dir=snapshot_dir, token_cache=token_cache,
+                           similarity=lsi_similarity)
+
+    # sentence-level bm25, built on first use since it holds many more units
+    sent_reading_assistant = None
 
     # scope (standard deviation) for ranking specificity
     scope = 2
 
+    # html reports: match texts are only rendered when opened, and no pagination until 'set pages'
+    report_options = {'page_size': None, 'lazy_text': True}
+
+    # rankings of the files ranked before, by content, settings and read files, kept on disk between runs,
+    # so ranking a file again (e.g. after 'set scope') only rewrites the reports
+    results = ResultCache(cache_dir=os.path.join(snapshot_dir, "results"))
+
     # user interaction code
     while True:
 
@@ -317,11 +1190,14 @@ def main(arg_read_path, arg_unread_path, arg_k1, arg_b):
 
         n = raw_input("Please use one of the following commands:\n"
                        "  rank [unread_file_#]            --> Compares new document to previously-read documents\n"
+                       "  rank sentences [unread_file_#]  --> Compares each sentence of a new document to previously-read sentences\n"
                        "  read [unread_file_#]            --> add the document from the unread list to the read list\n"
                        "  forget [read_file_#]            --> remove a document from the read list\n"
                        "  view document [document name]   --> prints the document\n"
                        "  view paragraph [paragraph name] --> prints the paragraph\n"
-                       "  set scope [integer]             --> only documents above this number of standard deviations above mean ranking score are returned\n" 
+                       "  set scope [integer]             --> only documents above this number of standard deviations above mean ranking score are returned\n"
+                       "  set pages [integer]             --> split html reports into pages of this many sections (0: one page)\n"
+                       "  set duplicates [on|off]         --> mark paragraphs nearly identical to read ones as already read instead of ranking them\n"
                        "  exit                            --> Exits the program\n"
                        "> ")
         print()
@@ -331,45 +1207,65 @@ def main(arg_read_path, arg_unread_path, arg_k1, arg_b):
 
         try:
 
-            # new document command
-            if n.startswith('rank'):
+            # new document command, sentence by sentence
+            if n.startswith('rank sentences'):
+                target = os.path.join(arg_unread_path, unread_file_list[int(n[15:].strip())])
+                if sent_reading_assistant is None:
+                    print('You sharpen your pencil for some very close reading...')
+                    sent_reading_assistant, = load_reading_assistants(
+                        arg_read_path, ("sentence",), snapshot_dir=snapshot_dir, token_cache=token_cache)
+
+                with instrumented(profile, metrics_log, command='rank sentences', file=target):
+                    # scored in batches with one matrix product each, keeping only the best matches per sentence
+                    sent_bm25_rankings = cached_rankings(
+                        results, (file_hash(target), 'sentence', 'bm25', arg_k1, arg_b,
+                                  sent_reading_assistant.collection_hash()),
+                        lambda entry: sent_reading_assistant.text_store,
+                        sent_reading_assistant.score_document, target, arg_k1, arg_b, 'matrix', 25)
+                    print("========================================================================= Your Results =========================================================================")
+                    print_rankings("BM25", "sentence", sent_bm25_rankings, scope)
+                    print("================================================================================================================================================================")
+
+                    write_report("output-sentences.html", target,
+                                 [("BM25 Sentence, >= " + str(scope) + " standard deviations", sent_bm25_rankings)],
+                                 scope, report_options)
+
+                print("\nSentence by sentence, output-sentences.html fills with the things you have seen before.  ")
+
+            # new document command, streamed for very large files
+            elif n.startswith('rank') and os.path.getsize(
+                    os.path.join(arg_unread_path, unread_file_list[int(n[5:].strip())])) > STREAM_THRESHOLD_BYTES:
                 target = os.path.join(arg_unread_path, unread_file_list[int(n[5:].strip())])
+                print('That is a hefty tome, you settle in and read it one paragraph at a time...')
+                with instrumented(profile, metrics_log, command='rank stream', file=target):
+                    print("========================================================================= Your Results =========================================================================")
+                    stream_rank(target, doc_reading_assistant, parag_reading_assistant, doc_lsi, parag_lsi, scope,
+                                k1=arg_k1, b=arg_b, report_options=report_options, skip_duplicates=skip_duplicates)
+                    print("================================================================================================================================================================")
+                print("\nDropping your pen and rubbing your temples, you look over output-bm25.html and output-lsi.html, and smile knowing the analysis is done.  ")
 
-                # do the BM25 document-level analysis
-                doc_bm25_rankings = doc_reading_assistant.score_document(target, k1=arg_k1, b=arg_b)
-
-                # initialize lsi + do the analysis
-                doc_lsi_rankings = gensim_lsi(arg_read_path, target, 'document')
-
-                # do the BM25 paragraph-level analysis
-                parag_bm25_rankings = parag_reading_assistant.score_document(target, k1=arg_k1, b=arg_b)
-
-                # do paragraph level lsi analysis
-                parag_lsi_rankings = gensim_lsi(arg_read_path, target, 'paragraph')
-
-                # show the user
-                print("========================================================================= Your Results =========================================================================")
-                print_rankings("BM25", "paragraph", parag_bm25_rankings, scope)
-                print_rankings("LSI", "paragraph", parag_lsi_rankings, scope)
-                print_rankings("BM25", "document", doc_bm25_rankings, scope)
-                print_rankings("LSI", "document", doc_lsi_rankings, scope)
-                print("================================================================================================================================================================")
-
-                # output BM25 html file for more viewing
-                html_gen = HTML_Generator(outfile="output-bm25.html", name=target)
-                html_gen.add_divide("BM25 Document, >= " + str(scope) + " standard deviations")
-                write_html_rankings(doc_bm25_rankings, scope, html_gen)
-                html_gen.add_divide("BM25 Paragraph, >= " + str(scope) + " standard deviations")
-                write_html_rankings(parag_bm25_rankings, scope, html_gen)
-                html_gen.close_file()
-
-                # output LSI html file for more viewing
-                html_gen = HTML_Generator(outfile="output-lsi.html", name=target)
-                html_gen.add_divide("LSI Document, >= " + str(scope) + " standard deviations")
-                write_html_rankings(doc_lsi_rankings, scope, html_gen)
-                html_gen.add_divide("LSI Paragraph, >= " + str(scope) + " standard deviations")
-                write_html_rankings(parag_lsi_rankings, scope, html_gen)
-                html_gen.close_file()
+            # new document command
+            elif n.startswith('rank'):
+                target = os.path.join(arg_unread_path, unread_file_list[int(n[5:].strip())])
+                with instrumented(profile, metrics_log, command='rank', file=target):
+                    # read the file once for both LSI levels
+                    target_text = read_text_file(target, token_cache)
+
+                    # do the BM25 and LSI analyses at document and paragraph level, and write the BM25 and
+                    # LSI html files for more viewing, all at the same time (ctrl-c cancels what has not started)
+                    start = time.perf_counter()
+                    job = rank_concurrently(target, target_text, doc_reading_assistant, parag_reading_assistant,
+                                            doc_lsi, parag_lsi, scope, k1=arg_k1, b=arg_b, report_options=report_options,
+                                            skip_duplicates=skip_duplicates, results=results)
+
+                    # show the user
+                    print("========================================================================= Your Results =========================================================================")
+                    print_rankings("BM25", "paragraph", job.result('parag bm25'), scope)
+                    print_rankings("LSI", "paragraph", job.result('parag lsi'), scope)
+                    print_rankings("BM25", "document", job.result('doc bm25'), scope)
+                    print_rankings("LSI", "document", job.result('doc lsi'), scope)
+                    print("================================================================================================================================================================")
+                    print("\nStages: {}; all done in {:.2f}s".format(job.timing_report(), time.perf_counter() - start))
 
                 print("\nDropping your pen and rubbing your temples, you look over output-bm25.html and output-lsi.html, and smile knowing the analysis is done.  ")
 
@@ -385,6 +1281,16 @@ def main(arg_read_path, arg_unread_path, arg_k1, arg_b):
                 # add to the inverted index (once it's in the read path)
                 doc_reading_assistant.add_document(dst_loc)
                 parag_reading_assistant.add_document(dst_loc)
+                dst_text = read_text_file(dst_loc, token_cache)
+                doc_lsi.add_document(dst_loc, dst_text)
+                parag_lsi.add_document(dst_loc, dst_text)
+                doc_reading_assistant.save_snapshot(snapshot_path(snapshot_dir, "document"))
+                parag_reading_assistant.save_snapshot(snapshot_path(snapshot_dir, "paragraph"))
+                if sent_reading_assistant is not None:
+                    sent_reading_assistant.add_document(dst_loc)
+                    sent_reading_assistant.save_snapshot(snapshot_path(snapshot_dir, "sentence"))
+                # the read files changed, so did the generation in the result keys
+                results.clear()
             # add document to read list
             elif n.startswith('forget'):
                 target_file = read_file_list[int(n[7:].strip())]
@@ -393,6 +1299,14 @@ def main(arg_read_path, arg_unread_path, arg_k1, arg_b):
                 # remove from the inverted index while still in the read path
                 doc_reading_assistant.remove_document(src_loc)
                 parag_reading_assistant.remove_document(src_loc)
+                doc_lsi.remove_document(src_loc)
+                parag_lsi.remove_document(src_loc)
+                doc_reading_assistant.save_snapshot(snapshot_path(snapshot_dir, "document"))
+                parag_reading_assistant.save_snapshot(snapshot_path(snapshot_dir, "paragraph"))
+                if sent_reading_assistant is not None:
+                    sent_reading_assistant.remove_document(src_loc)
+                    sent_reading_assistant.save_snapshot(snapshot_path(snapshot_dir, "sentence"))
+                results.clear()
                 print('You wander about, seeing glimpses of {} everywhere, but remembering nothing...'.format(src_loc))
                 os.rename(src_loc, dst_loc)
             elif n.startswith('set scope'):
@@ -400,6 +1314,18 @@ def main(arg_read_path, arg_unread_path, arg_k1, arg_b):
                 new_scope = int(n[10:].strip())
                 scope = new_scope
                 print('Perhaps another perspective will help...')
+            elif n.startswith('set pages'):
+                # update html report pagination
+                page_size = int(n[10:].strip())
+                report_options['page_size'] = page_size if page_size > 0 else None
+                print('You reach for a fresh stack of paper...')
+            elif n.startswith('set duplicates'):
+                # skip (or not) the paragraphs already read nearly word for word
+                skip_duplicates = n[15:].strip() == 'on'
+                if skip_duplicates:
+                    print('A strong sense of deja vu: you will skim what you have read before...')
+                else:
+                    print('You resolve to read every word, familiar or not...')
             elif n.startswith('view document'):
                 document_id = n[14:]
                 print('Good idea, let\'s take a look at ' + document_id)
@@ -426,6 +1352,8 @@ def main(arg_read_path, arg_unread_path, arg_k1, arg_b):
             else:
                 print("...you stare at the screen blankly, wondering why it it says \'invalid command.\'")
 
+        except (CancelledError, KeyboardInterrupt):
+            print("...you put the pencil down, the analysis is abandoned.")
         except Exception as e:
             print("...sorry, you did something strange:\n".format(sys.exc_info()[0]))
             print("Maybe this will give you a hint:\n")
@@ -436,13 +1364,82 @@ if __name__ == "__main__":
     Run from the command line, specifying level of analysis and path to read and unread documents.
     """
 
+    usage = ("\nUsage: python reading_assistant.py read_docs_path unread_docs_path [k1] [b] [--batch [pattern]] [--per-file] [--workers n] [--out dir]\n"
+             "           [--instrument] [--profile cprofile|tracemalloc] [--metrics-log file]\n"
+             "           [--lsi-backend dense|sharded|lsh|ivf] [--skip-duplicates]\n"
+             "    ... read_docs_path   : path containing text files that have been read by the user\n"
+             "    ... unread_docs_path : path containing text files that have not been read by the user\n"              
+             "    ... [k1]             : is the k1 value for BM25. Default: 1.2\n"
+             "    ... [b] (optional)   : is the b value for BM25. Default: 0.75\n"
+             "    ... [--batch]        : rank every unread file (or those matching pattern) without prompting\n"
+             "    ... [--per-file]     : with --batch, one report pair per file instead of one combined pair\n"
+             "    ... [--workers]      : with --batch, number of parallel workers. Default: 1\n"
+             "    ... [--out]          : with --batch, folder for the reports. Default: .\n"
+             "    ... [--instrument]   : print stage timings and counters after each rank (or " + INSTRUMENT_ENV + "=1)\n"
+             "    ... [--profile]      : run each rank under cProfile or tracemalloc (or " + PROFILE_ENV + "=mode)\n"
+             "    ... [--metrics-log]  : append each rank's timings and counters to file as JSON lines (or " + METRICS_LOG_ENV + "=file)\n"
+             "    ... [--lsi-backend]  : paragraph-level LSI similarity index: dense or sharded (exact), lsh or ivf\n"
+             "                           (approximate, faster on large collections). Default: dense\n"
+             "    ... [--skip-duplicates] : mark paragraphs nearly identical to read ones as already read instead of\n"
+             "                           ranking them (or 'set duplicates on')\n\n")
+
+    # batch options, taken out of the positional arguments
+    args = sys.argv[1:]
+    batch_pattern = None
+    per_file = False
+    workers = 1
+    out_dir = "."
+    profile = os.environ.get(PROFILE_ENV) or None
+    metrics_log = os.environ.get(METRICS_LOG_ENV) or None
+    lsi_similarity = 'dense'
+    skip_duplicates = False
+    if '--batch' in args:
+        i = args.index('--batch')
+        batch_pattern = '*'
+        if i + 1 < len(args) and not args[i + 1].startswith('--'):
+            batch_pattern = args.pop(i + 1)
+        args.pop(i)
+    if '--per-file' in args:
+        args.remove('--per-file')
+        per_file = True
+    if '--workers' in args:
+        i = args.index('--workers')
+        workers = int(args.pop(i + 1))
+        args.pop(i)
+    if '--out' in args:
+        i = args.index('--out')
+        out_dir = args.pop(i + 1)
+        args.pop(i)
+    if '--instrument' in args:
+        args.remove('--instrument')
+        instruments.enabled = True
+    if '--profile' in args:
+        i = args.index('--profile')
+        profile = args.pop(i + 1) if i + 1 < len(args) else ''
+        args.pop(i)
+    if profile is not None and profile not in PROFILE_MODES:
+        print("Unknown profile mode {} (--profile or {}), use one of: {}".format(profile, PROFILE_ENV, ", ".join(PROFILE_MODES)))
+        print(usage)
+        sys.exit(1)
+    if '--metrics-log' in args:
+        i = args.index('--metrics-log')
+        metrics_log = args.pop(i + 1)
+        args.pop(i)
+        instruments.enabled = True
+    if '--lsi-backend' in args:
+        i = args.index('--lsi-backend')
+        lsi_similarity = args.pop(i + 1)
+        args.pop(i)
+        if lsi_similarity not in SIMILARITY_BACKENDS:
+            print("Unknown --lsi-backend {}, use one of: {}".format(lsi_similarity, ", ".join(sorted(SIMILARITY_BACKENDS))))
+            sys.exit(1)
+    if '--skip-duplicates' in args:
+        args.remove('--skip-duplicates')
+        skip_duplicates = True
+    sys.argv[1:] = args
+
     if len(sys.argv) < 3:
-        print("\nUsage: python reading_assistant.py read_docs_path unread_docs_path [k1] [b] \n"
-              "    ... read_docs_path   : path containing text files that have been read by the user\n"
-              "    ... unread_docs_path : path containing text files that have not been read by the user\n"              
-              "    ... [k1]             : is the k1 value for BM25. Default: 1.2\n"
-              "    ... [b] (optional)   : is the b value for BM25. Default: 0.75\n\n"
-              )
+        print(usage)
 
     else:
         # tidy up some of the command line args
@@ -455,8 +1452,8 @@ if __name__ == "__main__":
         arg_k1 = 1.2
         arg_b = 0.75
         if len(sys.argv) == 5:
-            arg_k1 = sys.argv[3]
-            arg_b = sys.argv[4]
+            arg_k1 = float(sys.argv[3])
+            arg_b = float(sys.argv[4])
 
         outstr = "\nReading Assistant\n" \
                  "    read: {}\n" \
@@ -469,5 +1466,16 @@ if __name__ == "__main__":
 
         #print (outstr)
 
-        # call main with command line args
-        main(arg_read_path=arg_read_path, arg_unread_path=arg_unread_path, arg_k1=arg_k1, arg_b=arg_b)
+        if batch_pattern is not None:
+            # rank the whole unread folder (or the files matching the pattern) in one go
+            unread_files = sorted(f for f in glob.glob(os.path.join(arg_unread_path, batch_pattern))
+                                  if isfile(f) and not os.path.basename(f).startswith('.'))
+            with instrumented(profile, metrics_log, command='batch', files=len(unread_files)):
+                batch_rank(arg_read_path, unread_files, arg_k1, arg_b, per_file=per_file, workers=workers,
+                           out_dir=out_dir, report_options={'lazy_text': True}, lsi_similarity=lsi_similarity,
+                           skip_duplicates=skip_duplicates)
+        else:
+            # call main with command line args
+            main(arg_read_path=arg_read_path, arg_unread_path=arg_unread_path, arg_k1=arg_k1, arg_b=arg_b,
+                 profile=profile, metrics_log=metrics_log, lsi_similarity=lsi_similarity,
+                 skip_duplicates=skip_duplicates)
@@ -0,0 +1,331 @@
+import sys
+import json
+import time
+import asyncio
+import contextlib
+from urllib.parse import urlsplit, parse_qs
+
+from reading_assistant import *
+
+# request bodies are never used, only skipped: anything larger is refused rather than read
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class ReadWriteLock(object):
+    """
+    asyncio reader/writer lock: any number of ranks at a time, or one read / forget alone
+
+    Writers are preferred: once a writer waits, new readers queue behind it, so a stream
+    of rank requests cannot hold off a read or forget for ever.
+    """
+
+    def __init__(self):
+        """
+        Initializes an unlocked lock
+        """
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        self.condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def reading(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writer and not self.waiting_writers)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def writing(self):
+        async with self.condition:
+            self.waiting_writers += 1
+            try:
+                await self.condition.wait_for(lambda: not self.writer and not self.readers)
+            finally:
+                self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class HttpError(Exception):
+    """
+    An error answered to the client with an HTTP status
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class ReadingAssistantServer(object):
+    """
+    A long-running local HTTP/JSON server over warm document- and paragraph-level indexes
+
+    GET  /files                           --> read and unread file names
+    GET  /rank?file=NAME[&scope=2]        --> BM25 and LSI matches of an unread file, both levels
+    POST /read?file=NAME                  --> moves an unread file to the read folder and indexes it
+    POST /forget?file=NAME                --> moves a read file back to the unread folder
+    GET  /view?level=document|paragraph&id=ID --> raw and processed text of a read unit
+
+    Ranks run their four analyses on a thread pool and share the indexes under a reader/writer
+    lock; read and forget take the lock exclusively while they change the indexes.
+    """
+
+    def __init__(self, read_path, unread_path, k1=1.2, b=0.75, snapshot_dir=".reading_assistant", workers=8):
+        """
+        Initializes the server, the indexes and models are loaded by load()
+        """
+        self.read_path = read_path
+        self.unread_path = unread_path
+        self.k1 = k1
+        self.b = b
+        self.snapshot_dir = snapshot_dir
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = None
+        self.token_cache = TokenCache(cache_dir=os.path.join(snapshot_dir, "tokens"))
+        self.assistants = {}
+        self.lsi = {}
+
+    def load(self):
+        """
+        Builds (or restores) the indexes and LSI models, and warms the caches of the first query
+        """
+        doc_reading_assistant, parag_reading_assistant = load_reading_assistants(
+            self.read_path, ("document", "paragraph"), snapshot_dir=self.snapshot_dir, token_cache=self.token_cache)
+        self.assistants = {'document': doc_reading_assistant, 'paragraph': parag_reading_assistant}
+        for level in ("document", "paragraph"):
+            self.lsi[level] = LsiService(self.read_path, level=level, model_dir=self.snapshot_dir,
+                                         token_cache=self.token_cache)
+        self.warm()
+
+    def warm(self):
+        """
+        Rebuilds what the next rank would otherwise build (matrix, document list, LSI model),
+        so that concurrent ranks after a change do not each rebuild it
+        """
+        self.assistants['paragraph'].score_matrix([], self.k1, self.b)
+        for assistant in self.assistants.values():
+            assistant.read_document_list
+        for service in self.lsi.values():
+            service.current()
+
+    def checked_file(self, folder, fname):
+        """
+        The path of fname in folder, if fname is one of the listed files there
+        """
+        if fname is None:
+            raise HttpError(400, "missing 'file' parameter")
+        if fname not in list_files(folder):
+            raise HttpError(404, "no such file: {}".format(fname))
+        return os.path.join(folder, fname)
+
+    def files(self):
+        return {'read': sorted(list_files(self.read_path)), 'unread': sorted(list_files(self.unread_path))}
+
+    async def rank(self, fname, scope=2):
+        """
+        The four analyses of an unread file, run side by side
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        async with self.lock.reading():
+            # checked under the lock, so that a concurrent read or forget of the file answers 404
+            target = self.checked_file(self.unread_path, fname)
+            target_text = await loop.run_in_executor(self.executor, read_text_file, target, self.token_cache)
+
+            async def timed(name, function, *args):
+                stage_start = time.perf_counter()
+                result = await loop.run_in_executor(self.executor, function, *args)
+                return name, result, time.perf_counter() - stage_start
+
+            stages = await asyncio.gather(
+                timed('doc bm25', self.assistants['document'].score_document, target, self.k1, self.b),
+                timed('parag bm25', self.assistants['paragraph'].score_document, target, self.k1, self.b, 'matrix'),
+                timed('doc lsi', self.lsi['document'].query, target, target_text),
+                timed('parag lsi', self.lsi['paragraph'].query, target, target_text))
+        results = dict((name, result) for name, result, _ in stages)
+        response = {'file': fname, 'scope': scope}
+        for method in ('bm25', 'lsi'):
+            response[method] = {}
+            for level, prefix in (('document', 'doc'), ('paragraph', 'parag')):
+                rankings = results['{} {}'.format(prefix, method)]
+                response[method][level] = dict(
+                    (str(unit), [{'id': x[0], 'score': float(x[1])} for x in ranking_matches(entry, scope)])
+                    for unit, entry in rankings.items())
+        response['timings'] = dict((name, seconds) for name, _, seconds in stages)
+        response['timings']['total'] = time.perf_counter() - start
+        return response
+
+    async def read(self, fname):
+        """
+        Moves an unread file to the read folder and adds it to the indexes and models
+        """
+        loop = asyncio.get_running_loop()
+        async with self.lock.writing():
+            src_loc = self.checked_file(self.unread_path, fname)
+            dst_loc = os.path.join(self.read_path, fname)
+            await loop.run_in_executor(self.executor, self.read_file, src_loc, dst_loc)
+        return {'read': fname}
+
+    def read_file(self, src_loc, dst_loc):
+        os.rename(src_loc, dst_loc)
+        dst_text = read_text_file(dst_loc, self.token_cache)
+        for level in ("document", "paragraph"):
+            self.assistants[level].add_document(dst_loc)
+            self.lsi[level].add_document(dst_loc, dst_text)
+            self.assistants[level].save_snapshot(snapshot_path(self.snapshot_dir, level))
+        self.warm()
+
+    async def forget(self, fname):
+        """
+        Removes a read file from the indexes and models and moves it back to the unread folder
+        """
+        loop = asyncio.get_running_loop()
+        async with self.lock.writing():
+            src_loc = self.checked_file(self.read_path, fname)
+            dst_loc = os.path.join(self.unread_path, fname)
+            await loop.run_in_executor(self.executor, self.forget_file, src_loc, dst_loc)
+        return {'forgotten': fname}
+
+    def forget_file(self, src_loc, dst_loc):
+        for level in ("document", "paragraph"):
+            self.assistants[level].remove_document(src_loc)
+            self.lsi[level].remove_document(src_loc)
+            self.assistants[level].save_snapshot(snapshot_path(self.snapshot_dir, level))
+        os.rename(src_loc, dst_loc)
+        self.warm()
+
+    async def view(self, level, unit_id):
+        """
+        Raw and processed text of a read document or paragraph
+        """
+        if level not in self.assistants:
+            raise HttpError(400, "level must be document or paragraph")
+        async with self.lock.reading():
+            doc = self.assistants[level].read_documents.get(unit_id)
+            if doc is None:
+                raise HttpError(404, "no such {}: {}".format(level, unit_id))
+            return {'id': unit_id, 'level': level, 'raw_txt': self.assistants[level].raw_text(unit_id),
+                    'processed_txt': doc.processed_text}
+
+    async def route(self, method, target):
+        """
+        Answers one request, returns (status, JSON-able payload)
+        """
+        url = urlsplit(target)
+        query = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        if url.path == '/files' and method == 'GET':
+            return 200, self.files()
+        if url.path == '/rank' and method == 'GET':
+            try:
+                scope = float(query.get('scope', 2))
+            except ValueError:
+                raise HttpError(400, "scope must be a number")
+            return 200, await self.rank(query.get('file'), scope)
+        if url.path == '/read' and method == 'POST':
+            return 200, await self.read(query.get('file'))
+        if url.path == '/forget' and method == 'POST':
+            return 200, await self.forget(query.get('file'))
+        if url.path == '/view' and method == 'GET':
+            return 200, await self.view(query.get('level'), query.get('id'))
+        raise HttpError(404, "no such endpoint: {} {}".format(method, url.path))
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves the HTTP/1.1 requests of one connection (kept alive unless the client asks otherwise)
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                try:
+                    if length < 0:
+                        raise HttpError(400, "bad Content-Length: {}".format(headers['content-length']))
+                    if length > MAX_BODY_BYTES:
+                        raise HttpError(413, "request body over {} bytes".format(MAX_BODY_BYTES))
+                    if length:
+                        await reader.readexactly(length)
+                    status, payload = await self.route(method, target)
+                except HttpError as e:
+                    status, payload = e.status, {'error': str(e)}
+                    if not 0 <= length <= MAX_BODY_BYTES:
+                        # the body was not read, so the next request cannot be found in the stream
+                        keep_alive = False
+                except Exception as e:
+                    status, payload = 500, {'error': "{}: {}".format(type(e).__name__, e)}
+                body = json.dumps(payload).encode('utf8')
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                             "Connection: {}\r\n\r\n".format(status, 'OK' if status == 200 else 'Error', len(body),
+                                                            'keep-alive' if keep_alive else 'close').encode('latin-1'))
+                writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8642):
+        """
+        Loads the indexes and serves until cancelled
+        """
+        self.lock = ReadWriteLock()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.load)
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print('The reading room is open at http://{}:{}/ ...'.format(host, port))
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    """
+    Run from the command line: python server.py read_docs_path unread_docs_path [k1] [b] [--host h] [--port p]
+    """
+    args = sys.argv[1:]
+    host, port = '127.0.0.1', 8642
+    if '--host' in args:
+        i = args.index('--host')
+        host = args.pop(i + 1)
+        args.pop(i)
+    if '--port' in args:
+        i = args.index('--port')
+        port = int(args.pop(i + 1))
+        args.pop(i)
+    if len(args) < 2:
+        print("\nUsage: python server.py read_docs_path unread_docs_path [k1] [b] [--host h] [--port p]\n"
+              "    ... serves rank / read / forget / view as JSON on http://127.0.0.1:8642/ by default\n")
+    else:
+        arg_k1, arg_b = (float(args[2]), float(args[3])) if len(args) == 4 else (1.2, 0.75)
+        server = ReadingAssistantServer(os.path.join(args[0], ''), os.path.join(args[1], ''), arg_k1, arg_b)
+        try:
+            asyncio.run(server.serve(host, port))
+        except KeyboardInterrupt:
+            print('...the lights go out in the reading room.')
@@ -0,0 +1,369 @@
+import os
+import time
+import math
+import shutil
+import weakref
+import tempfile
+import numpy
+from gensim import matutils
+from instrumentation import instruments
+
+
+def top_positions(scores, k):
+    """
+    Positions of the k highest scores, in increasing order, in linear time
+    Among equal scores at the cut the lowest positions are kept, as a stable sort of all scores would
+    k is clamped to the number of scores, k <= 0 gives no positions
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    kth = numpy.partition(scores, len(scores) - k)[len(scores) - k]
+    above = numpy.flatnonzero(scores > kth)
+    tied = numpy.flatnonzero(scores == kth)[:k - len(above)]
+    return numpy.sort(numpy.concatenate((above, tied)))
+
+
+def unit_vector_chunks(vectors, num_features, chunk_size=4096):
+    """
+    Turns gensim sparse vectors (e.g. lsi[corpus]) into float32 arrays of at most chunk_size unit-length
+    rows, normalized one by one exactly as MatrixSimilarity does, so no backend needs them all at once
+    """
+    rows = []
+    for vector in vectors:
+        rows.append(matutils.unitvec(matutils.sparse2full(vector, num_features)))
+        if len(rows) == chunk_size:
+            yield numpy.asarray(rows, dtype=numpy.float32)
+            rows = []
+    if rows:
+        yield numpy.asarray(rows, dtype=numpy.float32)
+
+
+def query_vector(vector, num_features):
+    """
+    A gensim sparse query vector as a unit-length float32 array, normalized as MatrixSimilarity does
+    """
+    return numpy.asarray(matutils.sparse2full(matutils.unitvec(vector), num_features), dtype=numpy.float32)
+
+
+def block_rows(units, block_bytes):
+    """
+    How many queries to score at once so that their float32 similarities with units take about block_bytes
+    """
+    return max(1, block_bytes // max(4 * units, 1))
+
+
+def exact_top(positions, sims, top_k=None):
+    """
+    (positions, similarities, moments) of the top_k of sims, or of all of them without top_k
+    moments is the (mean, sd) of all sims when only some are kept, None otherwise
+    """
+    if top_k is not None and top_k < len(sims):
+        keep = top_positions(sims, top_k)
+        return positions[keep], sims[keep], (float(numpy.mean(sims)), float(numpy.std(sims)))
+    return positions, sims, None
+
+
+class DenseSimilarity(object):
+    """
+    Brute force: every unit vector in one in-memory float32 matrix, a query is one matrix-vector product
+    """
+
+    approximate = False
+
+    def __init__(self, chunks, num_features):
+        """
+        Stacks the chunks (see unit_vector_chunks) into the matrix
+        """
+        blocks = list(chunks)
+        self.vectors = numpy.vstack(blocks) if blocks else numpy.zeros((0, num_features), dtype=numpy.float32)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def similarities(self, query):
+        """
+        Cosine similarity of the unit query vector with every unit, by position
+        """
+        return numpy.dot(self.vectors, query)
+
+    def search(self, query, top_k=None):
+        """
+        Returns (positions, similarities, moments) of the best top_k units (all units without top_k),
+        positions in increasing order; moments is the (mean, sd) of all similarities, or None
+        when every unit is returned
+        """
+        sims = self.similarities(query)
+        return exact_top(numpy.arange(len(sims)), sims, top_k)
+
+    def search_batch(self, queries, top_k=None, block_bytes=1 << 26):
+        """
+        Yields search(query, top_k) for each row of queries, scoring a block of queries (about
+        block_bytes of similarities) with one matrix product
+        """
+        positions = numpy.arange(len(self.vectors))
+        rows = block_rows(len(self.vectors), block_bytes)
+        for start in range(0, len(queries), rows):
+            for sims in numpy.dot(queries[start:start + rows], self.vectors.T):
+                yield exact_top(positions, sims, top_k)
+
+
+class ShardedSimilarity(object):
+    """
+    Brute force over unit vectors kept on disk in .npy shards of shard_size rows, memory mapped
+
+    A query walks the shards one at a time, keeping the best top_k of each and running sums
+    for the moments, so only one shard of similarities is in memory at once and the vectors
+    themselves stay in the page cache rather than on the heap. The shards live in a fresh
+    temporary folder (under directory, if given) removed when the index is garbage collected.
+    """
+
+    approximate = False
+
+    def __init__(self, chunks, num_features, directory=None, shard_size=65536):
+        """
+        Writes the chunks (see unit_vector_chunks) to shards
+        """
+        self.num_features = num_features
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = tempfile.mkdtemp(prefix='lsi-shards-', dir=directory)
+        self.finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+        self.shards = []
+        self.offsets = [0]
+        pending = []
+        for chunk in chunks:
+            pending.append(chunk)
+            while sum(len(block) for block in pending) >= shard_size:
+                block = numpy.vstack(pending)
+                self.write_shard(block[:shard_size])
+                pending = [block[shard_size:]]
+        if pending and sum(len(block) for block in pending):
+            self.write_shard(numpy.vstack(pending))
+
+    def write_shard(self, block):
+        shard_path = os.path.join(self.path, "shard-{}.npy".format(len(self.shards)))
+        numpy.save(shard_path, block)
+        self.shards.append(numpy.load(shard_path, mmap_mode='r'))
+        self.offsets.append(self.offsets[-1] + len(block))
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def similarities(self, query):
+        """
+        Cosine similarity of the unit query vector with every unit, by position
+        """
+        if not self.shards:
+            return numpy.zeros(0, dtype=numpy.float32)
+        return numpy.concatenate([numpy.dot(shard, query) for shard in self.shards])
+
+    def search(self, query, top_k=None):
+        """
+        See DenseSimilarity.search
+        """
+        n = len(self)
+        if top_k is None or top_k >= n:
+            return exact_top(numpy.arange(n), self.similarities(query), top_k)
+        total = squared_total = 0.0
+        positions, sims = [], []
+        for offset, shard in zip(self.offsets, self.shards):
+            shard_sims = numpy.dot(shard, query)
+            total += float(numpy.sum(shard_sims, dtype=numpy.float64))
+            squared_total += float(numpy.dot(shard_sims.astype(numpy.float64), shard_sims))
+            keep = top_positions(shard_sims, top_k)
+            positions.append(keep + offset)
+            sims.append(shard_sims[keep])
+        positions, sims = numpy.concatenate(positions), numpy.concatenate(sims)
+        keep = top_positions(sims, top_k)
+        mean = total / n
+        return positions[keep], sims[keep], (mean, math.sqrt(max(0.0, squared_total / n - mean * mean)))
+
+    def search_batch(self, queries, top_k=None, block_bytes=1 << 26):
+        """
+        Yields search(query, top_k) for each row of queries, scoring a block of queries (about
+        block_bytes of similarities) against each shard with one matrix product
+        """
+        positions = numpy.arange(len(self))
+        rows = block_rows(len(self), block_bytes)
+        for start in range(0, len(queries), rows):
+            block = queries[start:start + rows]
+            if self.shards:
+                block_sims = numpy.hstack([numpy.dot(block, shard.T) for shard in self.shards])
+            else:
+                block_sims = numpy.zeros((len(block), 0), dtype=numpy.float32)
+            for sims in block_sims:
+                yield exact_top(positions, sims, top_k)
+
+
+class ApproximateSimilarity(object):
+    """
+    Base of the approximate backends: candidates(query) picks a few units, only those are compared
+
+    The unit vectors are kept in memory to score the candidates exactly. The moments of all
+    similarities are still exact without comparing every unit: the mean similarity is the query
+    times the mean unit vector, the mean squared similarity q.G.q with G the mean of the unit
+    vectors' outer products (a num_features x num_features matrix).
+    """
+
+    approximate = True
+
+    def __init__(self, chunks, num_features):
+        """
+        Stacks the chunks (see unit_vector_chunks) and computes the moment statistics
+        """
+        blocks = list(chunks)
+        self.vectors = numpy.vstack(blocks) if blocks else numpy.zeros((0, num_features), dtype=numpy.float32)
+        vectors = self.vectors.astype(numpy.float64)
+        n = max(len(vectors), 1)
+        self.mean_vector = vectors.sum(axis=0) / n
+        self.gram = numpy.dot(vectors.T, vectors) / n
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def similarities(self, query):
+        """
+        Brute force cosine similarity with every unit, for recall checks
+        """
+        return numpy.dot(self.vectors, query)
+
+    def moments(self, query):
+        """
+        Exact (mean, sd) of the similarities of query with all units
+        """
+        query = query.astype(numpy.float64)
+        mean = float(numpy.dot(self.mean_vector, query))
+        return mean, math.sqrt(max(0.0, float(numpy.dot(query, numpy.dot(self.gram, query))) - mean * mean))
+
+    def search(self, query, top_k=None):
+        """
+        Returns (positions, similarities, moments) of the best top_k candidates (all candidates without
+        top_k), positions in increasing order; moments is always the exact (mean, sd) of all similarities
+        """
+        candidates = self.candidates(query)
+        instruments.count('lsi candidates', len(candidates))
+        sims = numpy.dot(self.vectors[candidates], query)
+        if top_k is not None and top_k < len(candidates):
+            keep = top_positions(sims, top_k)
+            candidates, sims = candidates[keep], sims[keep]
+        return candidates, sims, self.moments(query)
+
+    def search_batch(self, queries, top_k=None, block_bytes=None):
+        """
+        Yields search(query, top_k) for each row of queries; each query has its own candidates
+        """
+        for query in queries:
+            yield self.search(query, top_k)
+
+
+class LshSimilarity(ApproximateSimilarity):
+    """
+    Random-hyperplane LSH: units whose signs against bits random hyperplanes agree share a bucket
+
+    Each of tables hash tables has its own hyperplanes; the candidates of a query are the units
+    in its bucket in every table, plus (multi-probe) the buckets reached by flipping each of its
+    probes least certain bits. Buckets are kept as the unit positions sorted by hash code, so a
+    lookup is a binary search. bits defaults to about 32 units per bucket.
+    """
+
+    def __init__(self, chunks, num_features, bits=None, tables=8, probes=2, seed=0):
+        """
+        Hashes the chunks (see unit_vector_chunks) into the tables
+        """
+        ApproximateSimilarity.__init__(self, chunks, num_features)
+        if bits is None:
+            bits = min(24, max(1, int(round(math.log2(max(len(self.vectors), 1) / 32.0)))))
+        self.bits = bits
+        self.probes = min(probes, bits)
+        # all tables' hyperplanes in one matrix, so a query is projected with one product
+        self.planes = numpy.random.RandomState(seed).standard_normal((tables * bits, num_features)).astype(numpy.float32)
+        self.shape = (tables, bits)
+        self.powers = 1 << numpy.arange(bits, dtype=numpy.int64)
+        self.tables = []  # (sorted codes, unit positions in that order)
+        for table in range(tables):
+            codes = numpy.dot(numpy.dot(self.vectors, self.planes[table * bits:(table + 1) * bits].T) > 0, self.powers)
+            order = numpy.argsort(codes, kind='stable')
+            self.tables.append((codes[order], order))
+
+    def candidates(self, query):
+        projections = numpy.dot(self.planes, query).reshape(self.shape)
+        codes = numpy.dot(projections > 0, self.powers)
+        # each table's own bucket, then those one flip of its least certain bits away
+        flips = self.powers[numpy.argsort(numpy.abs(projections), axis=1)[:, :self.probes]]
+        probes = numpy.concatenate((codes[:, None], codes[:, None] ^ flips), axis=1)
+        found = []
+        for (table_codes, order), table_probes in zip(self.tables, probes):
+            starts = numpy.searchsorted(table_codes, table_probes, 'left')
+            ends = numpy.searchsorted(table_codes, table_probes, 'right')
+            found.extend(order[start:end] for start, end in zip(starts, ends) if end > start)
+        return numpy.unique(numpy.concatenate(found)) if found else numpy.zeros(0, dtype=numpy.int64)
+
+
+class IvfSimilarity(ApproximateSimilarity):
+    """
+    Inverted-file index: a coarse quantizer of lists centroids (spherical k-means) splits the units
+    into lists, a query only compares the units of its probes closest lists
+
+    The centroids are trained on a sample of at most 64 units per list, every unit is then
+    assigned to its closest centroid. lists defaults to the square root of the number of
+    units, probes to a tenth of the lists (at least 2).
+    """
+
+    def __init__(self, chunks, num_features, lists=None, probes=None, iterations=10, seed=0, chunk_size=65536):
+        """
+        Trains the quantizer and fills the lists from the chunks (see unit_vector_chunks)
+        """
+        ApproximateSimilarity.__init__(self, chunks, num_features)
+        n = len(self.vectors)
+        if lists is None:
+            lists = int(math.sqrt(n))
+        lists = max(1, min(lists, n))
+        self.probes = min(lists, probes if probes is not None else max(2, lists // 10))
+        random_state = numpy.random.RandomState(seed)
+        sample = self.vectors[random_state.choice(n, min(n, 64 * lists), replace=False)] if n else self.vectors
+        self.centroids = sample[:lists].copy() if n else numpy.zeros((1, num_features), dtype=numpy.float32)
+        for _ in range(iterations):
+            assignment = numpy.argmax(numpy.dot(sample, self.centroids.T), axis=1)
+            for i in range(len(self.centroids)):
+                members = sample[assignment == i]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    norm = numpy.linalg.norm(centroid)
+                    if norm > 0:
+                        self.centroids[i] = centroid / norm
+        assignment = numpy.concatenate([numpy.argmax(numpy.dot(self.vectors[start:start + chunk_size], self.centroids.T), axis=1)
+                                        for start in range(0, n, chunk_size)]) if n else numpy.zeros(0, dtype=numpy.int64)
+        self.order = numpy.argsort(assignment, kind='stable')
+        self.offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(assignment, minlength=len(self.centroids)))))
+
+    def candidates(self, query):
+        closest = top_positions(numpy.dot(self.centroids, query), self.probes)
+        found = [self.order[self.offsets[i]:self.offsets[i + 1]] for i in closest]
+        return numpy.sort(numpy.concatenate(found)) if found else numpy.zeros(0, dtype=numpy.int64)
+
+
+# --lsi-backend names
+SIMILARITY_BACKENDS = {'dense': DenseSimilarity, 'sharded': ShardedSimilarity, 'lsh': LshSimilarity,
+                       'ivf': IvfSimilarity}
+
+
+def recall_at_k(backend, queries, k=10):
+    """
+    How well backend.search finds the true top k of brute force, for each unit query vector of queries
+    Returns {'recall': fraction of the true top k found, 'search_ms' / 'brute_force_ms': mean time per query}
+    """
+    found = wanted = 0
+    search_seconds = brute_force_seconds = 0.0
+    for query in queries:
+        start = time.perf_counter()
+        positions = backend.search(query, k)[0]
+        search_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        sims = backend.similarities(query)
+        exact = top_positions(sims, k)
+        brute_force_seconds += time.perf_counter() - start
+        found += len(numpy.intersect1d(positions, exact))
+        wanted += len(exact)
+    return {'recall': found / wanted if wanted else 1.0, 'search_ms': 1e3 * search_seconds / max(len(queries), 1),
+            'brute_force_ms': 1e3 * brute_force_seconds / max(len(queries), 1)}
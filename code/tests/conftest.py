@@ -0,0 +1,42 @@
+import os
+import sys
+import random
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ("patient mask contact tracing quarantine clinic order update base staff testing symptoms travel "
+         "isolation screening vaccine report guidance housing school family gate visitor").split()
+
+
+def write_corpus(directory, files, paragraphs, seed, words=WORDS):
+    """
+    Writes files text files of paragraphs random paragraphs (a few sentences of Zipf-ish random words),
+    returns their paths
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rng = random.Random(seed)
+    paths = []
+    for i in range(files):
+        lines = []
+        for _ in range(paragraphs):
+            sentences = [" ".join(words[min(int(rng.expovariate(0.15)), len(words) - 1)]
+                                  for _ in range(rng.randint(4, 12))) for _ in range(rng.randint(1, 3))]
+            lines.append(". ".join(sentences).capitalize() + ".")
+        path = os.path.join(directory, "file-{}-{}.txt".format(seed, i))
+        with open(path, 'w') as f:
+            f.write("\n\n".join(lines) + "\n")
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    """
+    (read folder with a trailing '/', list of unread file paths) of a small random corpus
+    """
+    read_path = os.path.join(str(tmp_path), "read", "")
+    write_corpus(read_path, 4, 12, seed=1)
+    unread_files = write_corpus(os.path.join(str(tmp_path), "unread"), 2, 6, seed=2)
+    return read_path, unread_files
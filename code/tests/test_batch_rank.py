@@ -0,0 +1,54 @@
+import os
+import pytest
+import reading_assistant
+from reading_assistant import ReadingAssistant, batch_rank
+
+
+def capture_reports(monkeypatch):
+    reports = {}
+    write_report = reading_assistant.write_report
+
+    def capture(outfile, name, sections, scope, report_options=None):
+        reports[os.path.basename(outfile)] = sections
+        write_report(outfile, name, sections, scope, report_options)
+
+    monkeypatch.setattr(reading_assistant, 'write_report', capture)
+    return reports
+
+
+def test_batch_rank_matches_single_file_rankings(corpus, tmp_path, monkeypatch):
+    read_path, unread_files = corpus
+    reports = capture_reports(monkeypatch)
+    out_dir = str(tmp_path / "out")
+    timings = batch_rank(read_path, unread_files, top_k=5, out_dir=out_dir,
+                         snapshot_dir=str(tmp_path / "snapshots"))
+    assert list(timings) == ['load', 'bm25', 'lsi', 'reports']
+    assert sorted(os.listdir(out_dir)) == ["output-batch-bm25.html", "output-batch-lsi.html"]
+
+    # one document and one paragraph section per file, in file order, as ranking the files one by one
+    sections = reports["output-batch-bm25.html"]
+    assert len(sections) == 2 * len(unread_files)
+    for i, path in enumerate(unread_files):
+        for (heading, rankings), level in zip(sections[2 * i:2 * i + 2], ("document", "paragraph")):
+            assert heading.startswith(os.path.basename(path) + " BM25 " + level.capitalize())
+            assistant = ReadingAssistant(read_path, level)
+            assistant.load_documents()
+            expected = assistant.score_document(path, engine='matrix', top_k=5)
+            assert list(rankings) == list(expected)
+            for unit_id, entry in expected.items():
+                assert rankings[unit_id]['ranking'] == pytest.approx(entry['ranking'], abs=1e-9)
+    lsi_sections = reports["output-batch-lsi.html"]
+    assert [list(rankings) for _, rankings in lsi_sections] == [list(rankings) for _, rankings in sections]
+
+
+def test_batch_rank_per_file_reports(corpus, tmp_path):
+    read_path, unread_files = corpus
+    out_dir = str(tmp_path / "out")
+    batch_rank(read_path, unread_files, per_file=True, workers=2, out_dir=out_dir,
+               snapshot_dir=str(tmp_path / "snapshots"))
+    names = [os.path.basename(path) for path in unread_files]
+    assert sorted(os.listdir(out_dir)) == sorted(
+        "{}-{}.html".format(name, method) for name in names for method in ("bm25", "lsi"))
+    with open(os.path.join(out_dir, names[0] + "-bm25.html")) as f:
+        html = f.read()
+    assert names[0] + "_pg0" in html
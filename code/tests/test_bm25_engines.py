@@ -0,0 +1,39 @@
+import pytest
+from reading_assistant import ReadingAssistant
+
+
+def scores_by_id(ranking):
+    return dict((doc_id, score) for doc_id, score in ranking)
+
+
+@pytest.mark.parametrize('level', ['document', 'paragraph'])
+@pytest.mark.parametrize('engine', ['taat', 'matrix'])
+def test_engines_match_naive(corpus, level, engine):
+    read_path, unread_files = corpus
+    assistant = ReadingAssistant(read_path, level)
+    assistant.load_documents()
+    for path in unread_files:
+        expected = assistant.score_document(path, engine='naive')
+        got = assistant.score_document(path, engine=engine)
+        assert list(got) == list(expected)
+        for unit_id, entry in expected.items():
+            ranking = got[unit_id]['ranking']
+            assert scores_by_id(ranking) == pytest.approx(scores_by_id(entry['ranking']), abs=1e-9)
+            scores = [score for _, score in ranking]
+            assert scores == sorted(scores, reverse=True)
+
+
+@pytest.mark.parametrize('engine', ['maxscore', 'matrix'])
+def test_top_k_matches_naive(corpus, engine):
+    read_path, unread_files = corpus
+    assistant = ReadingAssistant(read_path, 'paragraph')
+    assistant.load_documents()
+    expected = assistant.score_document(unread_files[0], engine='naive')
+    got = assistant.score_document(unread_files[0], engine=engine, top_k=5)
+    for unit_id, entry in expected.items():
+        naive_scores = [score for _, score in entry['ranking']]
+        top = [score for _, score in got[unit_id]['ranking']]
+        assert top == pytest.approx(naive_scores[:5], abs=1e-9)
+        mean, sd = got[unit_id]['moments']
+        assert mean == pytest.approx(sum(naive_scores) / len(naive_scores), abs=1e-9)
+
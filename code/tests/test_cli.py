@@ -0,0 +1,17 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reading_assistant.py")
+
+
+@pytest.mark.parametrize("args, env", [(["--profile", "cprofiler"], {}), (["--profile"], {}),
+                                       ([], {'READING_ASSISTANT_PROFILE': 'heap'})])
+def test_unknown_profile_mode_is_refused_with_usage(tmp_path, args, env):
+    result = subprocess.run([sys.executable, SCRIPT, str(tmp_path), str(tmp_path)] + args, cwd=str(tmp_path),
+                            env=dict(os.environ, **env), capture_output=True, text=True, timeout=120)
+    assert result.returncode == 1
+    assert "Unknown profile mode" in result.stdout
+    assert "Usage:" in result.stdout
@@ -0,0 +1,48 @@
+import json
+from instrumentation import Instruments, instruments
+from reading_assistant import ReadingAssistant
+
+
+def test_stages_and_counters_are_recorded_when_enabled(tmp_path):
+    timers = Instruments(enabled=True)
+    for _ in range(2):
+        with timers.stage('parse'):
+            pass
+    timers.count('postings touched', 5)
+    timers.count('postings touched', 3)
+    report = timers.report()
+    assert report['stages']['parse']['calls'] == 2
+    assert report['stages']['parse']['seconds'] >= 0.0
+    assert report['counters'] == {'postings touched': 8}
+
+    path = str(tmp_path / "metrics.jsonl")
+    timers.log(path, command='rank')
+    with open(path) as f:
+        record = json.loads(f.readline())
+    assert record['command'] == 'rank' and record['counters'] == {'postings touched': 8}
+
+    timers.reset()
+    assert timers.report() == {'stages': {}, 'counters': {}}
+
+
+def test_nothing_is_recorded_when_disabled():
+    timers = Instruments()
+    with timers.stage('parse'):
+        pass
+    timers.count('postings touched', 5)
+    assert timers.report() == {'stages': {}, 'counters': {}}
+
+
+def test_scoring_records_its_stage(corpus, monkeypatch):
+    read_path, unread_files = corpus
+    assistant = ReadingAssistant(read_path, 'paragraph')
+    assistant.load_documents()
+    monkeypatch.setattr(instruments, 'enabled', True)
+    instruments.reset()
+    try:
+        rankings = assistant.score_document(unread_files[0], engine='taat')
+        report = instruments.report()
+    finally:
+        instruments.reset()
+    assert report['stages']['bm25 score']['calls'] == 1
+    assert report['counters']['units ranked'] == len(rankings)
@@ -0,0 +1,32 @@
+import os
+import reading_assistant
+from reading_assistant import ReadingAssistant, load_reading_assistants
+
+
+def index_state(assistant):
+    inv_idx = assistant.inv_idx
+    return (inv_idx.index, inv_idx.number_of_documents, inv_idx.document_lengths, inv_idx.term_bounds,
+            sorted(assistant.read_documents), assistant.file_signatures)
+
+
+def test_parallel_load_matches_load_documents(corpus, monkeypatch):
+    read_path, _ = corpus
+    monkeypatch.setattr(reading_assistant, 'PARALLEL_LOAD_MIN_BYTES', 0)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 2)
+    loaded = load_reading_assistants(read_path, ("document", "paragraph"), workers=2)
+    for assistant in loaded:
+        expected = ReadingAssistant(read_path, assistant.level)
+        expected.load_documents()
+        assert index_state(assistant) == index_state(expected)
+
+
+def test_small_folder_is_loaded_in_process(corpus, monkeypatch):
+    read_path, _ = corpus
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("a process pool was started for a small read folder")
+
+    monkeypatch.setattr(reading_assistant, 'ProcessPoolExecutor', no_pool)
+    document, paragraph = load_reading_assistants(read_path, ("document", "paragraph"), workers=4)
+    assert document.inv_idx.number_of_documents == len(os.listdir(read_path))
+    assert paragraph.inv_idx.number_of_documents > document.inv_idx.number_of_documents
@@ -0,0 +1,112 @@
+import os
+import threading
+import pytest
+from gensim.similarities import MatrixSimilarity
+import gensimlsi
+from gensimlsi import LsiIndex, LsiService, ReadUnreadTxtFiles
+
+
+def test_queries_get_the_previous_index_while_retraining(corpus, monkeypatch):
+    read_path, unread_files = corpus
+    service = LsiService(read_path, 'paragraph', num_topics=5)
+    previous = service.current()
+
+    # hold the background retrain until the queries are done
+    release = threading.Event()
+    train = LsiIndex.train.__func__
+
+    def slow_train(cls, *args, **kwargs):
+        release.wait(30)
+        return train(cls, *args, **kwargs)
+
+    monkeypatch.setattr(gensimlsi.LsiIndex, 'train', classmethod(slow_train))
+    forgotten = sorted(os.listdir(read_path))[0]
+    service.remove_document(os.path.join(read_path, forgotten))
+    assert service.current() is previous
+    assert service.query(unread_files[0])
+    assert service.rebuild_thread.is_alive()
+
+    release.set()
+    service.wait()
+    assert service.rebuild_thread is None
+    retrained = service.current()
+    assert retrained is not previous
+    assert not any(name.startswith(forgotten) for name in retrained.names)
+
+
+def test_units_changed_during_retrain_are_trained_again(corpus, monkeypatch):
+    read_path, _ = corpus
+    service = LsiService(read_path, 'paragraph', num_topics=5)
+    service.current()
+    first, second = sorted(os.listdir(read_path))[:2]
+
+    started = threading.Event()
+    release = threading.Event()
+    train = LsiIndex.train.__func__
+
+    def slow_train(cls, *args, **kwargs):
+        started.set()
+        release.wait(30)
+        return train(cls, *args, **kwargs)
+
+    monkeypatch.setattr(gensimlsi.LsiIndex, 'train', classmethod(slow_train))
+    service.remove_document(os.path.join(read_path, first))
+    started.wait(30)
+    service.remove_document(os.path.join(read_path, second))
+    release.set()
+    service.wait()
+    names = service.current().names
+    assert not any(name.startswith(first) or name.startswith(second) for name in names)
+
+
+def test_forgotten_units_are_not_ranked_while_retraining(corpus, monkeypatch):
+    read_path, unread_files = corpus
+    service = LsiService(read_path, 'paragraph', num_topics=5)
+    forgotten = sorted(os.listdir(read_path))[0]
+    assert any(name.startswith(forgotten) for entry in service.query(unread_files[0]).values()
+               for name, _ in entry['ranking'])
+
+    release = threading.Event()
+    train = LsiIndex.train.__func__
+
+    def slow_train(cls, *args, **kwargs):
+        release.wait(30)
+        return train(cls, *args, **kwargs)
+
+    monkeypatch.setattr(gensimlsi.LsiIndex, 'train', classmethod(slow_train))
+    service.remove_document(os.path.join(read_path, forgotten))
+    try:
+        assert service.rebuild_thread.is_alive()
+        for rankings in (service.query(unread_files[0]),
+                         dict(service.iter_query(unread_files[0], top_k=5, verbose=False))):
+            assert rankings
+            for entry in rankings.values():
+                assert entry['ranking']
+                assert not any(name.startswith(forgotten) for name, _ in entry['ranking'])
+    finally:
+        release.set()
+        service.wait()
+    assert not service.removed_names
+
+
+@pytest.mark.parametrize('top_k', [None, 5])
+def test_batched_queries_match_one_query_at_a_time(corpus, top_k):
+    read_path, unread_files = corpus
+    index = LsiService(read_path, 'paragraph', num_topics=5).current()
+    # per query, as gensim does it: project each unit and compare it with the whole corpus
+    similarities = MatrixSimilarity(index.lsi[index.corpus], num_features=index.lsi.num_topics)
+    batched = list(index.iter_query(unread_files[0], 'paragraph', top_k=top_k, verbose=False, batch_size=4,
+                                    cache=False))
+    units = list(ReadUnreadTxtFiles(unread_files[0], 'paragraph'))
+    assert len(batched) == len(units) == 6
+    for unit, (name, entry) in zip(units, batched):
+        assert name == unit.name
+        sims = similarities[index.lsi[index.dictionary.doc2bow(unit.word_list)]]
+        expected = sorted(zip(index.names, sims.tolist()), key=lambda x: -x[1])[:top_k]
+        ranking = entry['ranking']
+        assert len(ranking) == len(expected)
+        assert [score for _, score in ranking] == pytest.approx([score for _, score in expected], abs=1e-5)
+        assert dict(ranking) == pytest.approx(dict((name, float(sims[index.names.index(name)]))
+                                                   for name, _ in ranking), abs=1e-5)
+        if top_k is not None:
+            assert entry['moments'] == pytest.approx((sims.mean(), sims.std()), abs=1e-5)
@@ -0,0 +1,64 @@
+import os
+import pytest
+from conftest import write_corpus
+from reading_assistant import ReadingAssistant, split_document, snapshot_path
+from instrumentation import instruments
+
+
+def assert_bounds_exact(inv_idx):
+    assert set(inv_idx.term_bounds) == set(inv_idx.index)
+    for word, postings in inv_idx.index.items():
+        assert inv_idx.term_bounds[word] == inv_idx.posting_bounds(postings)
+
+
+def test_term_bounds_follow_reads_forgets_and_snapshots(corpus, tmp_path):
+    read_path, unread_files = corpus
+    path = snapshot_path(str(tmp_path / "snapshots"), 'paragraph')
+    assistant = ReadingAssistant(read_path, 'paragraph')
+    assistant.load_documents(path)
+    assert_bounds_exact(assistant.inv_idx)
+    assistant.add_document(unread_files[0])
+    assert_bounds_exact(assistant.inv_idx)
+    assistant.remove_document(os.path.join(read_path, sorted(os.listdir(read_path))[0]))
+    assert_bounds_exact(assistant.inv_idx)
+    assistant.save_snapshot(path)
+    restored = ReadingAssistant(read_path, 'paragraph')
+    assert restored.load_snapshot(path)
+    assert restored.inv_idx.term_bounds == assistant.inv_idx.term_bounds
+
+
+def test_upper_bounds_hold(corpus):
+    read_path, unread_files = corpus
+    assistant = ReadingAssistant(read_path, 'paragraph')
+    assistant.load_documents()
+    scorer = assistant.scorer
+    scorer.refresh(1.2, 0.75)
+    for word, postings in assistant.inv_idx.index.items():
+        best = max(scorer.weight(word, doc_id, tf, 1.2, 0.75) for doc_id, tf in postings.items())
+        assert best <= scorer.upper_bound(word, 1.2, 0.75) + 1e-12
+
+
+def test_top_k_prunes(tmp_path):
+    read_path = os.path.join(str(tmp_path), "read", "")
+    write_corpus(read_path, 20, 30, seed=1)
+    unread_file = write_corpus(str(tmp_path / "unread"), 1, 10, seed=2)[0]
+    assistant = ReadingAssistant(read_path, 'paragraph')
+    assistant.load_documents()
+    enabled = instruments.enabled
+    instruments.enabled = True
+    try:
+        full = pruned = 0
+        for doc in split_document(unread_file, 'paragraph'):
+            instruments.reset()
+            scores = assistant.scorer.score(doc.processed_text)
+            full += instruments.counters['postings touched']
+            instruments.reset()
+            hits, moments = assistant.scorer.top_k(doc.processed_text, 5)
+            pruned += instruments.counters['postings touched']
+            best = sorted(scores.values(), reverse=True)[:5]
+            assert [score for _, score in hits] == pytest.approx(best, abs=1e-9)
+            assert moments.mean == pytest.approx(sum(scores.values()) / assistant.inv_idx.number_of_documents)
+    finally:
+        instruments.enabled = enabled
+        instruments.reset()
+    assert pruned < full / 2
@@ -0,0 +1,73 @@
+import os
+import random
+from conftest import WORDS
+from near_duplicates import MinHashIndex
+from reading_assistant import ReadingAssistant
+
+
+def random_text(rng, words=60):
+    return " ".join(rng.choice(WORDS) + str(rng.randint(0, 50)) for _ in range(words))
+
+
+def test_near_identical_pair_matches_and_unrelated_pair_does_not():
+    rng = random.Random(0)
+    original, unrelated = random_text(rng), random_text(rng)
+    # one word changed at the end: 57 of the 59 distinct shingles are shared
+    near_copy = original.rsplit(" ", 1)[0] + " changed"
+    index = MinHashIndex()
+    index.add("original", original)
+    matches = index.query(near_copy)
+    assert [unit_id for unit_id, _ in matches] == ["original"]
+    assert matches[0][1] >= index.threshold
+    assert index.query(unrelated) == []
+
+
+def test_threshold_separates_candidates():
+    rng = random.Random(1)
+    original = random_text(rng)
+    words = original.split()
+    # the last 10 words rewritten: Jaccard 0.7, a candidate but below the default threshold
+    edited = " ".join(words[:50] + random_text(rng, 10).split())
+    index = MinHashIndex()
+    index.add("original", original)
+    assert index.query(edited) == []
+    loose = MinHashIndex(threshold=0.5)
+    loose.add("original", original)
+    assert [unit_id for unit_id, _ in loose.query(edited)] == ["original"]
+
+
+def test_removed_units_are_not_matched():
+    index = MinHashIndex()
+    text = random_text(random.Random(2))
+    index.add("unit", text)
+    assert index.query(text) == [("unit", 1.0)]
+    index.remove("unit")
+    assert index.query(text) == [] and len(index) == 0
+    assert all(not bucket for bucket in index.buckets)
+
+
+def test_copied_paragraph_is_flagged_already_read(corpus, tmp_path):
+    read_path, unread_files = corpus
+    source = sorted(os.listdir(read_path))[0]
+    with open(os.path.join(read_path, source)) as f:
+        copied = [line for line in f.read().split("\n") if line][3]
+    with open(unread_files[0]) as f:
+        distinct = [line for line in f.read().split("\n") if line][:2]
+    path = str(tmp_path / "memo.txt")
+    with open(path, 'w') as f:
+        f.write("\n\n".join([distinct[0], copied, distinct[1]]) + "\n")
+
+    assistant = ReadingAssistant(read_path, 'paragraph')
+    assistant.load_documents()
+    entry = assistant.duplicate_entry(copied)
+    assert entry['already_read'] and entry['ranking'][0] == (source + "_pg3", 1.0)
+    rankings = assistant.score_document(path, engine='matrix', skip_duplicates=True)
+    assert [unit_id for unit_id, entry in rankings.items() if entry.get('already_read')] == ["memo.txt_pg1"]
+    assert rankings["memo.txt_pg1"]['ranking'][0][0] == source + "_pg3"
+    for unit_id in ("memo.txt_pg0", "memo.txt_pg2"):
+        assert assistant.duplicate_entry(rankings[unit_id]['raw_txt']) is None
+        assert len(rankings[unit_id]['ranking']) == len(assistant.read_documents)
+
+    # once its source is forgotten the paragraph is new again
+    assistant.remove_document(os.path.join(read_path, source))
+    assert assistant.duplicate_entry(copied) is None
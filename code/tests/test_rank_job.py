@@ -0,0 +1,25 @@
+import time
+import pytest
+from concurrent.futures import CancelledError
+from reading_assistant import RankJob
+
+
+def test_failed_job_waits_for_running_stages():
+    finished = []
+
+    def slow():
+        time.sleep(0.3)
+        finished.append('slow')
+
+    def fail():
+        raise RuntimeError("broken stage")
+
+    job = RankJob(workers=2)
+    job.stage('fail', fail)
+    job.stage('slow', slow)
+    job.stage('after', finished.append, 'after', after=('fail',))
+    with pytest.raises(RuntimeError):
+        job.wait()
+    assert finished == ['slow']
+    with pytest.raises((CancelledError, RuntimeError)):
+        job.result('after')
@@ -0,0 +1,59 @@
+import numpy
+from reading_assistant import ReadingAssistant
+from gensimlsi import LsiService
+from ranking_cache import RankingCache
+
+TEXT_FIELDS = ('raw_txt', 'processed_txt', 'texts')
+
+
+def test_cached_rankings_match_fresh_ones(corpus):
+    read_path, unread_files = corpus
+    assistant = ReadingAssistant(read_path, 'paragraph')
+    assistant.load_documents()
+    first = assistant.score_document(unread_files[0], engine='matrix', top_k=5)
+    assert len(assistant.ranking_cache) == len(first)
+    # only the ids, scores and moments are kept, not the texts
+    for ids, scores, moments, size in assistant.ranking_cache.entries.values():
+        assert isinstance(ids, tuple) and isinstance(scores, numpy.ndarray) and len(moments) == 2
+    again = assistant.score_document(unread_files[0], engine='matrix', top_k=5)
+    assistant.ranking_cache.clear()
+    fresh = assistant.score_document(unread_files[0], engine='matrix', top_k=5)
+    for unit_id, entry in fresh.items():
+        for field in ('ranking', 'moments') + TEXT_FIELDS:
+            assert again[unit_id][field] == entry[field]
+
+
+def test_lsi_cached_rankings_match_fresh_ones(corpus):
+    read_path, unread_files = corpus
+    index = LsiService(read_path, 'paragraph', num_topics=5).current()
+    first = dict(index.iter_query(unread_files[0], 'paragraph', top_k=5, verbose=False))
+    again = dict(index.iter_query(unread_files[0], 'paragraph', top_k=5, verbose=False))
+    for unit_id, entry in first.items():
+        assert again[unit_id] is not entry
+        for field in ('ranking', 'moments', 'raw_txt', 'texts'):
+            assert again[unit_id][field] == entry[field]
+
+
+def test_cache_is_bounded_by_bytes():
+    ranking = [("doc-{}".format(i), float(i)) for i in range(100)]
+    size = RankingCache.entry_bytes(tuple(x[0] for x in ranking), numpy.zeros(100))
+    cache = RankingCache(max_bytes=3 * size)
+    for i in range(5):
+        cache.put(i, {'ranking': ranking, 'raw_txt': "x" * 100000})
+    assert sorted(cache.entries) == [2, 3, 4]
+    assert cache.bytes == 3 * size
+    assert cache.get(0) is None
+    assert cache.get(4) == {'ranking': ranking}
+    cache.put('large', {'ranking': ranking * 4})
+    assert 'large' not in cache.entries
+
+
+def test_streams_are_not_cached(corpus):
+    read_path, unread_files = corpus
+    assistant = ReadingAssistant(read_path, 'paragraph')
+    assistant.load_documents()
+    assert list(assistant.score_document_stream(unread_files[0]))
+    assert len(assistant.ranking_cache) == 0
+    service = LsiService(read_path, 'paragraph', num_topics=5)
+    assert list(service.iter_query(unread_files[0], 5, verbose=False, cache=False))
+    assert len(service.current().ranking_cache) == 0
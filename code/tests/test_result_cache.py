@@ -0,0 +1,114 @@
+import os
+import threading
+import pytest
+import gensimlsi
+from gensimlsi import LsiIndex, LsiService
+from reading_assistant import ReadingAssistant, rank_concurrently, read_text_file
+from ranking_cache import ResultCache
+
+STAGES = ('doc bm25', 'doc lsi', 'parag bm25', 'parag lsi')
+
+
+def session(read_path, snapshot_dir):
+    """
+    (document and paragraph ReadingAssistants, document and paragraph LsiServices) of a new session
+    """
+    assistants = []
+    for level in ('document', 'paragraph'):
+        assistant = ReadingAssistant(read_path, level)
+        assistant.load_documents()
+        assistants.append(assistant)
+    services = [LsiService(read_path, level, num_topics=5, model_dir=snapshot_dir)
+                for level in ('document', 'paragraph')]
+    return assistants, services
+
+
+def rank_in(assistants, services, target, results):
+    job = rank_concurrently(target, read_text_file(target), assistants[0], assistants[1], services[0], services[1],
+                            2, workers=2, results=results)
+    return dict((name, job.result(name)) for name in STAGES)
+
+
+def rank(read_path, target, snapshot_dir, results):
+    return rank_in(*session(read_path, snapshot_dir), target=target, results=results)
+
+
+def assert_same_rankings(got, expected):
+    for name in STAGES:
+        assert list(got[name]) == list(expected[name])
+        for unit_id, entry in expected[name].items():
+            ranking = got[name][unit_id]['ranking']
+            assert ranking == entry['ranking']
+            for match_id, _ in ranking:
+                assert got[name][unit_id]['texts'].get(match_id) == entry['texts'].get(match_id)
+
+
+@pytest.mark.parametrize('tier', ['memory', 'disk'])
+def test_result_cache_hit_does_not_touch_the_lsi_model(corpus, tmp_path, monkeypatch, tier):
+    read_path, unread_files = corpus
+    monkeypatch.chdir(str(tmp_path))
+    snapshot_dir = os.path.join(str(tmp_path), "snapshots")
+    results = ResultCache(cache_dir=os.path.join(snapshot_dir, "results"))
+    fresh = rank(read_path, unread_files[0], snapshot_dir, results)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the LSI model was loaded on a cache hit")
+
+    monkeypatch.setattr(LsiService, 'current', fail)
+    monkeypatch.setattr(gensimlsi.LsiIndex, 'train', classmethod(fail))
+    monkeypatch.setattr(gensimlsi.LsiIndex, 'load', classmethod(fail))
+    if tier == 'disk':
+        results = ResultCache(cache_dir=os.path.join(snapshot_dir, "results"))
+    assert_same_rankings(rank(read_path, unread_files[0], snapshot_dir, results), fresh)
+
+
+def test_texts_without_a_saved_model_build_it_on_first_lookup(corpus):
+    read_path, unread_files = corpus
+    service = LsiService(read_path, 'paragraph', num_topics=5)
+    texts = service.texts()
+    assert service.lsi_index is None
+    name = service.current().names[0]
+    assert texts.get(name) == service.current().texts[name]
+    assert texts.get('no such unit', '') == ''
+
+
+def test_rankings_of_a_stale_lsi_model_are_not_cached(corpus, tmp_path, monkeypatch):
+    read_path, unread_files = corpus
+    monkeypatch.chdir(str(tmp_path))
+    snapshot_dir = os.path.join(str(tmp_path), "snapshots")
+    assistants, services = session(read_path, snapshot_dir)
+    for service in services:
+        service.current()
+
+    # forget a file, and hold the retrain until it has been ranked against the stale models
+    release = threading.Event()
+    train = LsiIndex.train.__func__
+
+    def slow_train(cls, *args, **kwargs):
+        release.wait(30)
+        return train(cls, *args, **kwargs)
+
+    monkeypatch.setattr(gensimlsi.LsiIndex, 'train', classmethod(slow_train))
+    forgotten = os.path.join(read_path, sorted(os.listdir(read_path))[0])
+    os.rename(forgotten, os.path.join(str(tmp_path), os.path.basename(forgotten)))
+    for assistant, service in zip(assistants, services):
+        assistant.remove_document(forgotten)
+        service.remove_document(forgotten)
+    assert not services[0].settled() and not services[1].settled()
+    rank_in(assistants, services, unread_files[0], ResultCache(cache_dir=os.path.join(snapshot_dir, "results")))
+    release.set()
+    for service in services:
+        service.wait()
+        assert service.settled()
+
+    # a new session gets the rankings of the retrained model, and caches those
+    assistants, services = session(read_path, snapshot_dir)
+    results = ResultCache(cache_dir=os.path.join(snapshot_dir, "results"))
+    for _ in range(2):
+        got = rank_in(assistants, services, unread_files[0], results)
+        for name, service in zip(('doc lsi', 'parag lsi'), services):
+            expected = service.query(unread_files[0])
+            assert list(got[name]) == list(expected)
+            for unit_id, entry in expected.items():
+                assert got[name][unit_id]['ranking'] == entry['ranking']
+    assert len(results.entries) == len(STAGES)
@@ -0,0 +1,60 @@
+import os
+import pytest
+from reading_assistant import DocumentProcessor, ReadingAssistant, snapshot_path
+
+
+def test_sentences_split_with_back_references(tmp_path):
+    path = str(tmp_path / "memo.txt")
+    with open(path, 'w') as f:
+        f.write("Masks at the gate. Testing on base.\n\n\n\nVisitors by appointment. A. Staff report daily.\n")
+    docs = DocumentProcessor(path, 'sentence').get_docs()
+    assert [doc.document_id for doc in docs] == [
+        "memo.txt_pg0_s0", "memo.txt_pg0_s1", "memo.txt_pg1_s0", "memo.txt_pg1_s1"]
+    assert [doc.paragraph_id for doc in docs] == ["memo.txt_pg0", "memo.txt_pg0", "memo.txt_pg1", "memo.txt_pg1"]
+    assert all(doc.article_id == "memo.txt" for doc in docs)
+    assert docs[1].unprocessed_text == "Testing on base"
+    assert docs[1].processed_text == [["testing", "on", "base"]]
+    # paragraphs are numbered as at paragraph level
+    paragraphs = DocumentProcessor(path, 'paragraph').get_docs()
+    assert [doc.document_id for doc in paragraphs] == ["memo.txt_pg0", "memo.txt_pg1"]
+
+
+def test_sentence_index_follows_reads_and_forgets(corpus, tmp_path):
+    read_path, unread_files = corpus
+    assistant = ReadingAssistant(read_path, 'sentence')
+    assistant.load_documents()
+    paragraphs = ReadingAssistant(read_path, 'paragraph')
+    paragraphs.load_documents()
+    assert set(doc.paragraph_id for doc in assistant.read_document_list) == set(paragraphs.read_documents)
+    assert len(assistant.read_documents) > len(paragraphs.read_documents)
+
+    new_file = os.path.basename(unread_files[0])
+    assistant.add_document(unread_files[0])
+    added = [doc_id for doc_id in assistant.read_documents if doc_id.startswith(new_file + "_pg")]
+    assert added and set(assistant.inv_idx.article_documents[new_file]) == set(added)
+
+    forgotten = sorted(os.listdir(read_path))[0]
+    assistant.remove_document(os.path.join(read_path, forgotten))
+    assert not any(doc.article_id == forgotten for doc in assistant.read_document_list)
+    for postings in assistant.inv_idx.index.values():
+        assert not any(doc_id.startswith(forgotten + "_pg") for doc_id in postings)
+
+    # the snapshot keeps the paragraph back-references
+    path = snapshot_path(str(tmp_path / "snapshots"), 'sentence')
+    assistant.save_snapshot(path)
+    restored = ReadingAssistant(read_path, 'sentence')
+    assert restored.load_snapshot(path)
+    assert dict((doc_id, doc.paragraph_id) for doc_id, doc in restored.read_documents.items()) == \
+        dict((doc_id, doc.paragraph_id) for doc_id, doc in assistant.read_documents.items())
+
+
+def test_sentence_top_k_matches_naive(corpus):
+    read_path, unread_files = corpus
+    assistant = ReadingAssistant(read_path, 'sentence')
+    assistant.load_documents()
+    expected = assistant.score_document(unread_files[0], engine='naive')
+    got = assistant.score_document(unread_files[0], engine='matrix', top_k=5)
+    assert list(got) == list(expected)
+    for unit_id, entry in expected.items():
+        naive_scores = [score for _, score in entry['ranking']]
+        assert [score for _, score in got[unit_id]['ranking']] == pytest.approx(naive_scores[:5], abs=1e-9)
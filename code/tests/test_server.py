@@ -0,0 +1,135 @@
+import os
+import json
+import asyncio
+
+from server import ReadingAssistantServer, ReadWriteLock, HttpError, MAX_BODY_BYTES
+
+
+class Writer(object):
+    """
+    Collects what handle_connection writes
+    """
+
+    def __init__(self):
+        self.data = b''
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def answer(tmp_path, request):
+    """
+    The (status, payloads) of the responses of a server connection given request bytes
+    """
+    async def serve():
+        server = ReadingAssistantServer(str(tmp_path / "read") + "/", str(tmp_path / "unread") + "/",
+                                        snapshot_dir=str(tmp_path / "snapshots"), workers=1)
+        reader = asyncio.StreamReader()
+        reader.feed_data(request)
+        reader.feed_eof()
+        writer = Writer()
+        await server.handle_connection(reader, writer)
+        server.executor.shutdown()
+        return writer
+    writer = asyncio.run(serve())
+    responses = []
+    for response in writer.data.split(b'HTTP/1.1 ')[1:]:
+        head, _, body = response.partition(b'\r\n\r\n')
+        responses.append((int(head.split()[0]), json.loads(body)))
+    return responses
+
+
+def test_bad_content_length_is_answered_400_and_closes(tmp_path):
+    responses = answer(tmp_path, b"POST /read?file=x HTTP/1.1\r\nContent-Length: lots\r\n\r\n"
+                                 b"GET /nowhere HTTP/1.1\r\n\r\n")
+    assert [status for status, _ in responses] == [400]
+    responses = answer(tmp_path, b"POST /read?file=x HTTP/1.1\r\nContent-Length: -5\r\n\r\n")
+    assert [status for status, _ in responses] == [400]
+
+
+def test_oversized_body_is_refused_unread(tmp_path):
+    request = "POST /read?file=x HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(MAX_BODY_BYTES + 1)
+    assert [status for status, _ in answer(tmp_path, request.encode('latin-1'))] == [413]
+
+
+def test_small_body_is_skipped_and_connection_kept(tmp_path):
+    responses = answer(tmp_path, b"POST /nowhere HTTP/1.1\r\nContent-Length: 4\r\n\r\nbody"
+                                 b"GET /nowhere HTTP/1.1\r\n\r\n")
+    assert [status for status, _ in responses] == [404, 404]
+
+
+def run_loaded(corpus, tmp_path, requests):
+    """
+    Loads a server over the corpus and awaits requests(server), returning its result
+    """
+    read_path, unread_files = corpus
+    server = ReadingAssistantServer(read_path, os.path.join(os.path.dirname(unread_files[0]), ""),
+                                    snapshot_dir=str(tmp_path / "snapshots"), workers=2)
+    server.load()
+
+    async def serve():
+        server.lock = ReadWriteLock()
+        try:
+            return await requests(server)
+        finally:
+            server.executor.shutdown()
+    return asyncio.run(serve())
+
+
+async def status(server, method, target):
+    try:
+        return (await server.route(method, target))[0]
+    except HttpError as e:
+        return e.status
+
+
+def test_rank_read_and_forget_endpoints(corpus, tmp_path):
+    read_path, unread_files = corpus
+    name = os.path.basename(unread_files[0])
+
+    async def requests(server):
+        _, ranked = await server.route('GET', '/rank?file={}&scope=1'.format(name))
+        assert ranked['file'] == name and ranked['scope'] == 1
+        for method in ('bm25', 'lsi'):
+            assert list(ranked[method]['document']) == [name]
+            assert len(ranked[method]['paragraph']) == 6
+        assert await status(server, 'GET', '/rank?file=nothing.txt') == 404
+        assert await status(server, 'GET', '/rank') == 400
+
+        assert await server.route('POST', '/read?file=' + name) == (200, {'read': name})
+        assert name in os.listdir(read_path)
+        assert name in server.assistants['document'].read_documents
+        assert await status(server, 'GET', '/rank?file=' + name) == 404
+        _, viewed = await server.route('GET', '/view?level=paragraph&id={}_pg0'.format(name))
+        assert viewed['id'] == name + '_pg0'
+
+        assert await server.route('POST', '/forget?file=' + name) == (200, {'forgotten': name})
+        assert name not in os.listdir(read_path)
+        assert not any(doc.article_id == name for doc in server.assistants['paragraph'].read_document_list)
+        assert await status(server, 'POST', '/forget?file=' + name) == 404
+        return await status(server, 'GET', '/rank?file=' + name)
+
+    assert run_loaded(corpus, tmp_path, requests) == 200
+
+
+def test_concurrent_changes_of_one_file_answer_404(corpus, tmp_path):
+    read_path, unread_files = corpus
+    name = os.path.basename(unread_files[0])
+
+    async def requests(server):
+        reads = await asyncio.gather(status(server, 'POST', '/read?file=' + name),
+                                     status(server, 'POST', '/read?file=' + name))
+        forgets = await asyncio.gather(status(server, 'POST', '/forget?file=' + name),
+                                                status(server, 'POST', '/forget?file=' + name))
+        read_then_rank = await asyncio.gather(status(server, 'POST', '/read?file=' + name),
+                                              status(server, 'GET', '/rank?file=' + name))
+        return reads, forgets, read_then_rank
+
+    assert run_loaded(corpus, tmp_path, requests) == ([200, 404], [200, 404], [200, 404])
@@ -0,0 +1,59 @@
+import numpy
+import pytest
+from gensim.similarities import MatrixSimilarity
+from benchmark import clustered_unit_vectors
+from similarity_index import (DenseSimilarity, ShardedSimilarity, LshSimilarity, IvfSimilarity, top_positions,
+                              unit_vector_chunks, query_vector, recall_at_k)
+
+
+def sparse_vectors(n, features, seed):
+    random_state = numpy.random.RandomState(seed)
+    return [[(j, float(random_state.standard_normal())) for j in sorted(random_state.choice(features, 6, replace=False))]
+            for _ in range(n)]
+
+
+def test_top_positions_clamps_k():
+    scores = numpy.array([0.5, 0.9, 0.1, 0.9])
+    assert list(top_positions(scores, 2)) == [1, 3]
+    assert list(top_positions(scores, 10)) == [0, 1, 2, 3]
+    assert len(top_positions(scores, 0)) == 0
+    assert len(top_positions(numpy.zeros(0), 3)) == 0
+
+
+@pytest.mark.parametrize('backend', ['dense', 'sharded'])
+def test_exact_backends_match_gensim(backend, tmp_path):
+    features = 20
+    units, queries = sparse_vectors(200, features, seed=0), sparse_vectors(5, features, seed=1)
+    expected = MatrixSimilarity(units, num_features=features)
+    if backend == 'dense':
+        index = DenseSimilarity(unit_vector_chunks(units, features, chunk_size=64), features)
+    else:
+        index = ShardedSimilarity(unit_vector_chunks(units, features, chunk_size=64), features,
+                                  directory=str(tmp_path), shard_size=48)
+        assert len(index.shards) == 5
+    assert len(index) == len(units)
+    vectors = numpy.asarray([query_vector(query, features) for query in queries])
+    for query, vector, (positions, sims, moments) in zip(queries, vectors, index.search_batch(vectors, 10)):
+        gensim_sims = expected[query]
+        numpy.testing.assert_allclose(index.similarities(vector), gensim_sims, atol=1e-6)
+        numpy.testing.assert_array_equal(positions, top_positions(gensim_sims, 10))
+        numpy.testing.assert_allclose(sims, gensim_sims[positions], atol=1e-6)
+        assert moments == pytest.approx((gensim_sims.mean(), gensim_sims.std()), abs=1e-6)
+        single = index.search(vector, 10)
+        numpy.testing.assert_array_equal(single[0], positions)
+        assert single[2] == pytest.approx(moments, abs=1e-6)
+
+
+@pytest.mark.parametrize('backend', [LshSimilarity, IvfSimilarity])
+def test_approximate_backends_recall(backend):
+    vectors = clustered_unit_vectors(10100, 200, clusters=1000, seed=0)
+    data, queries = vectors[:10000], vectors[10000:]
+    index = backend([data[i:i + 4096] for i in range(0, len(data), 4096)], 200)
+    assert recall_at_k(index, queries, 10)['recall'] >= 0.75
+    # the moments are exact even though only candidates are compared
+    dense = DenseSimilarity([data], 200)
+    positions, sims, moments = index.search(queries[0], 10)
+    exact = dense.similarities(queries[0])
+    assert list(positions) == sorted(positions) and len(positions) == 10
+    numpy.testing.assert_allclose(sims, exact[positions], atol=1e-6)
+    assert moments == pytest.approx((exact.mean(), exact.std()), abs=1e-5)
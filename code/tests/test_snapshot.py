@@ -0,0 +1,71 @@
+import os
+import pytest
+from conftest import write_corpus
+import index_snapshot
+from reading_assistant import ReadingAssistant
+
+
+def index_state(assistant):
+    inv_idx = assistant.inv_idx
+    return (inv_idx.index, inv_idx.number_of_documents, pytest.approx(inv_idx.average_document_length),
+            inv_idx.document_lengths, sorted(assistant.read_documents))
+
+
+def test_edit_only_read_file_then_restart(tmp_path):
+    read_path = os.path.join(str(tmp_path), "read", "")
+    path, = write_corpus(read_path, 1, 5, seed=3)
+    snapshot = os.path.join(str(tmp_path), "index-paragraph.snapshot")
+    ReadingAssistant(read_path, 'paragraph').load_documents(snapshot)
+
+    with open(path, 'a') as f:
+        f.write("\nA brand new paragraph about quarantine orders.\n")
+    restarted = ReadingAssistant(read_path, 'paragraph')
+    restarted.load_documents(snapshot)
+
+    fresh = ReadingAssistant(read_path, 'paragraph')
+    fresh.load_documents()
+    assert index_state(restarted) == index_state(fresh)
+    assert restarted.inv_idx.number_of_documents == 6
+
+
+def test_delete_every_read_file_then_restart(tmp_path):
+    read_path = os.path.join(str(tmp_path), "read", "")
+    paths = write_corpus(read_path, 2, 3, seed=4)
+    snapshot = os.path.join(str(tmp_path), "index-document.snapshot")
+    ReadingAssistant(read_path, 'document').load_documents(snapshot)
+
+    for path in paths:
+        os.remove(path)
+    restarted = ReadingAssistant(read_path, 'document')
+    restarted.load_documents(snapshot)
+    assert restarted.inv_idx.number_of_documents == 0
+    assert restarted.inv_idx.average_document_length == 0
+    assert restarted.inv_idx.index == {}
+
+
+def test_snapshot_round_trip(corpus, tmp_path):
+    read_path, _ = corpus
+    snapshot = os.path.join(str(tmp_path), "index-paragraph.snapshot")
+    built = ReadingAssistant(read_path, 'paragraph')
+    built.load_documents(snapshot)
+    restored = ReadingAssistant(read_path, 'paragraph')
+    assert restored.load_snapshot(snapshot)
+    assert index_state(restored) == index_state(built)
+
+
+def test_touched_file_is_hashed_once(tmp_path, monkeypatch):
+    read_path = os.path.join(str(tmp_path), "read", "")
+    paths = write_corpus(read_path, 2, 3, seed=5)
+    snapshot = os.path.join(str(tmp_path), "index-document.snapshot")
+    ReadingAssistant(read_path, 'document').load_documents(snapshot)
+
+    stat = os.stat(paths[0])
+    os.utime(paths[0], (stat.st_atime, stat.st_mtime + 60))
+    hashed = []
+    file_hash = index_snapshot.file_hash
+    monkeypatch.setattr(index_snapshot, 'file_hash', lambda path: hashed.append(path) or file_hash(path))
+    for _ in range(2):
+        restarted = ReadingAssistant(read_path, 'document')
+        restarted.load_documents(snapshot)
+        assert restarted.inv_idx.number_of_documents == 2
+    assert hashed == [paths[0]]
@@ -0,0 +1,43 @@
+import os
+import pytest
+from text_store import MmapTextStore
+from gensimlsi import LsiService
+
+
+def test_round_trip(tmp_path):
+    path = os.path.join(str(tmp_path), "units.texts")
+    items = [('a_pg0', "First paragraph.\n"), ('a_pg1', "Zweiter Absatz, grüße.\n"), ('b', "")]
+    MmapTextStore.write(path, items)
+    store = MmapTextStore(path)
+    assert sorted(store.items()) == sorted(items)
+    assert store.get('missing', 'default') == 'default'
+    assert not os.path.exists(path + '.offsets')
+
+
+def test_damaged_store_is_refused(tmp_path):
+    path = os.path.join(str(tmp_path), "units.texts")
+    MmapTextStore.write(path, [('a', "some text " * 100)])
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 10)
+    with pytest.raises(ValueError):
+        MmapTextStore(path)
+
+
+def test_two_file_layout_is_refused(tmp_path):
+    path = os.path.join(str(tmp_path), "units.texts")
+    with open(path, 'wb') as f:
+        f.write(b"texts written back to back")
+    with pytest.raises(ValueError):
+        MmapTextStore(path)
+
+
+def test_service_retrains_over_a_damaged_store(corpus, tmp_path):
+    read_path, unread_files = corpus
+    model_dir = os.path.join(str(tmp_path), "models")
+    trained = LsiService(read_path, 'paragraph', num_topics=5, model_dir=model_dir)
+    names = trained.current().names
+    with open(os.path.join(model_dir, "lsi-paragraph.index.texts"), 'r+b') as f:
+        f.truncate(20)
+    restarted = LsiService(read_path, 'paragraph', num_topics=5, model_dir=model_dir)
+    assert restarted.current().names == names
+    assert MmapTextStore(os.path.join(model_dir, "lsi-paragraph.index.texts"))
@@ -0,0 +1,73 @@
+import os
+import io
+import pickle
+from conftest import write_corpus
+from token_cache import TokenCache
+from reading_assistant import split_document
+from gensimlsi import TextFile, read_text_file
+
+
+class PlainUnpickler(pickle.Unpickler):
+    """
+    Refuses every class, so only plain data can be read
+    """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("{}.{} in a token cache file".format(module, name))
+
+
+def test_cached_tokens_are_plain_data(corpus, tmp_path):
+    read_path, _ = corpus
+    cache_dir = str(tmp_path / "tokens")
+    path = os.path.join(read_path, sorted(os.listdir(read_path))[0])
+    cache = TokenCache(cache_dir=cache_dir)
+    for level in ('document', 'paragraph'):
+        cached = split_document(path, level, cache)
+        direct = split_document(path, level)
+        assert [(d.document_id, d.processed_text, d.unprocessed_text, d.article_id) for d in cached] == \
+            [(d.document_id, d.processed_text, d.unprocessed_text, d.article_id) for d in direct]
+    text_file = read_text_file(path, cache)
+    assert (text_file.paragraphs, text_file.txt) == (TextFile(path).paragraphs, TextFile(path).txt)
+
+    files = os.listdir(cache_dir)
+    assert len(files) == 3
+    for fname in files:
+        with open(os.path.join(cache_dir, fname), 'rb') as f:
+            PlainUnpickler(io.BytesIO(f.read())).load()
+
+    # a new session reads them back from disk
+    again = TokenCache(cache_dir=cache_dir)
+    assert [d.processed_text for d in split_document(path, 'paragraph', again)] == \
+        [d.processed_text for d in split_document(path, 'paragraph')]
+    assert again.hits == 1 and again.misses == 0
+
+
+def test_memory_tier_is_bounded_by_bytes(corpus):
+    read_path, _ = corpus
+    paths = [os.path.join(read_path, fname) for fname in sorted(os.listdir(read_path))]
+    sizes = []
+    cache = TokenCache(max_bytes=10 ** 9)
+    for path in paths:
+        split_document(path, 'paragraph', cache)
+        sizes.append(cache.bytes - sum(sizes))
+    assert all(size > os.path.getsize(path) for size, path in zip(sizes, paths))
+
+    cache = TokenCache(max_bytes=sum(sizes[-2:]))
+    for path in paths:
+        split_document(path, 'paragraph', cache)
+    assert len(cache.entries) == 2
+    assert cache.bytes <= cache.max_bytes
+    assert sum(size for _, size in cache.entries.values()) == cache.bytes
+
+
+def test_disk_tier_keeps_the_most_recent_files(tmp_path):
+    paths = write_corpus(str(tmp_path / "read"), 12, 2, seed=6)
+    cache_dir = str(tmp_path / "tokens")
+    cache = TokenCache(cache_dir=cache_dir, max_disk_entries=10)
+    for path in paths:
+        split_document(path, 'document', cache)
+    files = os.listdir(cache_dir)
+    assert len(files) <= 10
+    # the last file tokenized is still on disk
+    assert TokenCache(cache_dir=cache_dir).load(next(reversed(cache.entries))) is not None
+
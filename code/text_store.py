@@ -0,0 +1,136 @@
+import os
+import mmap
+import pickle
+import struct
+import threading
+from collections import OrderedDict
+
+# MmapTextStore file layout: MAGIC, format version, start and length of the pickled offsets, the texts, the offsets
+TEXTS_MAGIC = b'RATXT'
+TEXTS_VERSION = 1
+TEXTS_PREAMBLE = struct.Struct('>5sHQQ')
+
+
+class TextStore(object):
+    """
+    Raw texts of the read units, looked up by id only when a report needs them
+
+    Rankings carry (id, score) pairs and a reference to the store of their collection.
+    The text of a unit is materialized by lookup(id) the first time it is asked for
+    (for a read Document, joining its lines) and kept in a small LRU.
+    """
+
+    def __init__(self, lookup, max_entries=1024):
+        """
+        Initializes an empty store, lookup(id) returns the raw text of a unit
+        """
+        self.lookup = lookup
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, unit_id, default=None):
+        """
+        Raw text of a unit, or default if the collection no longer has it
+        """
+        with self.lock:
+            if unit_id in self.entries:
+                self.entries.move_to_end(unit_id)
+                return self.entries[unit_id]
+        try:
+            text = self.lookup(unit_id)
+        except KeyError:
+            return default
+        with self.lock:
+            self.entries[unit_id] = text
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return text
+
+    def clear(self):
+        """
+        Drops the materialized texts, when units are removed or replaced
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+class MmapTextStore(object):
+    """
+    Raw texts written back to back in a file and memory mapped
+
+    Only the offsets are kept in memory; a text is decoded from the mapping when it is
+    asked for, so a large collection's texts cost no memory until a report shows them.
+    The offsets are pickled at the end of the same file, which is replaced in one rename,
+    so texts and offsets always come from the same write.
+    """
+
+    def __init__(self, path):
+        """
+        Opens a store written with MmapTextStore.write
+        Raises ValueError if the file is not one, or is damaged
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < TEXTS_PREAMBLE.size:
+                raise ValueError("not a text store: {}".format(path))
+            magic, version, offsets_start, offsets_length = TEXTS_PREAMBLE.unpack(f.read(TEXTS_PREAMBLE.size))
+            if magic != TEXTS_MAGIC or version != TEXTS_VERSION:
+                raise ValueError("not a text store: {}".format(path))
+            if offsets_start < TEXTS_PREAMBLE.size or offsets_start + offsets_length != size:
+                raise ValueError("damaged text store: {}".format(path))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.offsets = pickle.loads(self.mm[offsets_start:])  # id -> (start, end)
+        except (EOFError, pickle.UnpicklingError):
+            raise ValueError("damaged text store: {}".format(path))
+        if any(end > offsets_start for _, end in self.offsets.values()):
+            raise ValueError("damaged text store: {}".format(path))
+
+    @staticmethod
+    def write(path, items):
+        """
+        Writes (id, raw text) pairs and their offsets to path
+        """
+        offsets = {}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(TEXTS_PREAMBLE.pack(TEXTS_MAGIC, TEXTS_VERSION, 0, 0))
+            position = TEXTS_PREAMBLE.size
+            for unit_id, text in items:
+                data = text.encode('utf8')
+                f.write(data)
+                offsets[unit_id] = (position, position + len(data))
+                position += len(data)
+            pickle.dump(offsets, f, protocol=pickle.HIGHEST_PROTOCOL)
+            offsets_length = f.tell() - position
+            f.seek(0)
+            f.write(TEXTS_PREAMBLE.pack(TEXTS_MAGIC, TEXTS_VERSION, position, offsets_length))
+        os.replace(tmp_path, path)
+        # offsets of the previous two-file layout
+        if os.path.isfile(path + '.offsets'):
+            os.remove(path + '.offsets')
+
+    def __contains__(self, unit_id):
+        return unit_id in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, unit_id, default=None):
+        """
+        Raw text of a unit, or default if the store does not have it
+        """
+        span = self.offsets.get(unit_id)
+        if span is None:
+            return default
+        start, end = span
+        return self.mm[start:end].decode('utf8')
+
+    def items(self):
+        """
+        All (id, raw text) pairs, decoding every text
+        """
+        for unit_id in self.offsets:
+            yield unit_id, self.get(unit_id)
@@ -0,0 +1,231 @@
+import io
+import os
+import sys
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+# bumped when the cached values change shape, so older pickles on disk are not read
+TOKENS_VERSION = 2
+
+
+def value_bytes(value):
+    """
+    Estimated memory of a cached value: nested tuples and lists of strings and numbers
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(value_bytes(item) for item in value)
+    return size
+
+
+class CachedFile(object):
+    """
+    A file looked up in a TokenCache: its content hash, and its bytes once somebody needs them
+    """
+
+    def __init__(self, cache, path, content_hash, data=None):
+        """
+        Initializes the handle, see TokenCache.open
+        """
+        self.cache = cache
+        self.path = path
+        self.name = path.split("/")[-1]
+        self.content_hash = content_hash
+        self._data = data
+
+    @property
+    def data(self):
+        """
+        The raw bytes of the file, read at most once
+        """
+        if self._data is None:
+            with open(self.path, 'rb') as f:
+                self._data = f.read()
+            self.cache.remember_data(self.content_hash, self._data)
+        return self._data
+
+    def text(self, encoding, errors='strict'):
+        """
+        The decoded file content with universal newlines, like reading it in text mode
+        """
+        return io.StringIO(self.data.decode(encoding, errors), newline=None).read()
+
+    def get(self, analyzer, build):
+        """
+        The output of analyzer for this file: build(self) the first time, cached afterwards
+        build must return plain data (tuples, lists, strings, numbers), not instances of the
+        caller's classes: the same disk tier is read by the command line (where they would be
+        __main__ classes) and by the server, and the memory tier is bounded by value_bytes
+        """
+        return self.cache.lookup((self.content_hash, self.name, analyzer), lambda: build(self))
+
+
+class TokenCache(object):
+    """
+    Tokenized files keyed by content hash, file name and analyzer, with LRU eviction
+
+    The BM25 and LSI paths tokenize differently, so each stores its own output (an
+    'analyzer') under the same file key: a file is read once however many analyzers
+    use it, and a file whose content did not change is never tokenized again. The
+    memory tier is bounded by the estimated size of its values (max_bytes). With a
+    cache_dir, entries are also pickled to disk and survive restarts; the
+    max_disk_entries most recently used are kept.
+    """
+
+    def __init__(self, max_bytes=128 * 1024 * 1024, cache_dir=None, max_disk_entries=4096):
+        """
+        Initializes an empty cache
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()  # key -> (value, estimated bytes)
+        self.bytes = 0
+        # files in cache_dir, counted on the first save
+        self.disk_entries = None
+        # (path, mtime, size) -> content hash, so unchanged files are not even re-read to be hashed
+        self.hashes = {}
+        # content hash -> bytes of the last few files opened, so analyzers running one after
+        # another on the same file share one read
+        self.recent_data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        """
+        Only the settings travel to worker processes, not the entries or the lock
+        """
+        return {'max_bytes': self.max_bytes, 'cache_dir': self.cache_dir, 'max_disk_entries': self.max_disk_entries}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'], state['cache_dir'], state['max_disk_entries'])
+
+    def open(self, path):
+        """
+        Returns a CachedFile for path
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+        content_hash = self.hashes.get(key)
+        if content_hash is not None:
+            return CachedFile(self, path, content_hash, self.recent_data.get(content_hash))
+        with open(path, 'rb') as f:
+            data = f.read()
+        content_hash = hashlib.sha1(data).hexdigest()
+        self.hashes[key] = content_hash
+        self.remember_data(content_hash, data)
+        return CachedFile(self, path, content_hash, data)
+
+    def remember_data(self, content_hash, data, keep=4):
+        """
+        Keeps the bytes of the last few files read
+        """
+        with self.lock:
+            self.recent_data[content_hash] = data
+            self.recent_data.move_to_end(content_hash)
+            while len(self.recent_data) > keep:
+                self.recent_data.popitem(last=False)
+
+    def lookup(self, key, build):
+        """
+        Cached value for key, from memory, then disk, then build()
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+        value = self.load(key)
+        if value is None:
+            self.misses += 1
+            value = build()
+            self.save(key, value)
+        else:
+            self.hits += 1
+        size = value_bytes(value)
+        if size > self.max_bytes:
+            return value
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+        return value
+
+    def disk_path(self, key):
+        content_hash, name, analyzer = key
+        digest = hashlib.sha1("{}\0{}\0{}".format(name, analyzer, TOKENS_VERSION).encode('utf8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, "{}-{}.tokens".format(content_hash, digest))
+
+    def load(self, key):
+        """
+        Value for key from the disk tier, or None
+        """
+        if self.cache_dir is None:
+            return None
+        path = self.disk_path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except Exception:
+            # damaged, or pickled by another version of the code: tokenize again
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def save(self, key, value):
+        """
+        Writes value to the disk tier, if there is one
+        """
+        if self.cache_dir is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self.disk_path(key)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self.disk_entries is None:
+                self.disk_entries = sum(1 for fname in os.listdir(self.cache_dir) if fname.endswith(".tokens"))
+            else:
+                self.disk_entries += 1
+            if self.disk_entries > self.max_disk_entries:
+                self.disk_entries = self.evict_disk()
+
+    def evict_disk(self):
+        """
+        Drops the least recently used files of the disk tier, down to 90% of max_disk_entries so that
+        the folder is not listed again on every save; returns the number of files left
+        """
+        paths = [os.path.join(self.cache_dir, fname) for fname in os.listdir(self.cache_dir)
+                 if fname.endswith(".tokens")]
+        keep = self.max_disk_entries * 9 // 10
+        if len(paths) <= keep:
+            return len(paths)
+
+        def last_used(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return 0.0
+        paths.sort(key=last_used)
+        for old_path in paths[:len(paths) - keep]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+        return keep